@@ -14,21 +14,45 @@
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
-import argparse, tempfile, os, shutil, pickle, sys, re, glob, json, subprocess, shlex, time, multiprocessing as mp
-import parsegbk, makeseqsql, makehmmsql, seqsql2fa, extractdbgenes, getrnagenes, setlog
+import argparse, tempfile, os, shutil, pickle, sys, re, glob, json, subprocess, shlex, time, hashlib, math, multiprocessing as mp
+import parsegbk, makeseqsql, makehmmsql, seqsql2fa, extractdbgenes, getrnagenes, autotrim, placement, astralservice, sptreeplace, setlog
+import sqlite3 as sql
+from seqstore import SeqStore
 import ete3methods, rangerdtl
+from hmmcache import HmmCache
+from stagecache import StageCache
+from refbundle import RefBundle, getcutvals, getmodeldata, parsegmatrix
 from combine_results import *
 from subprocess import Popen, PIPE
-from threading import Timer
+from threading import Timer, Thread, Condition
+from multiprocessing.pool import ThreadPool
+from multiprocessing.connection import wait
 from distutils.dir_util import copy_tree
 
 
-def makequerydb(infasta,tdir,fname,orgname,idprfx=""):
-    makeseqsql.runlist([tdir+infasta],tdir+fname+".db",transonly=True,orgname=orgname)
-    seqsql2fa.writefasta(tdir+fname+".db",tdir+fname+".faa",idprfx=idprfx)
-    seqsql2fa.writefasta(tdir+fname+".db",tdir+fname+".fna",nuc=True,idprfx=idprfx)
-
-def trimal(infil,outfile):
+def makequerydb(bundle,tdir,fname,orgname,idprfx=""):
+    #Query sequences are kept in memory, hmm hit tables are joined against an in-memory sqlite copy
+    seqs = SeqStore.fromgenes(bundle,orgname)
+    seqs.writefasta(tdir+fname+".faa",idprfx=idprfx)
+    seqs.writefasta(tdir+fname+".fna",nuc=True,idprfx=idprfx)
+    return seqs.tosql(sql.connect(":memory:"))
+
+def exportquerydb(querydb,fname):
+    #if set to directory write in-memory query db to disk
+    dbg = os.getenv("DEBUG_QUERYDB",False)
+    if dbg and os.path.isdir(dbg):
+        log.debug("Found DEBUG_QUERYDB saving to: %s"%dbg)
+        dbconn = sql.connect(os.path.join(dbg,fname+".db"))
+        querydb.backup(dbconn)
+        dbconn.close()
+    elif dbg:
+        log.debug("Found DEBUG_QUERYDB but directory is invalid. Set to a valid directory")
+
+def useautotrim():
+    #in-process port of trimal -automated1 (autotrim.py), set ARTS_AUTOTRIM=0 to always run the binary
+    return str(os.getenv("ARTS_AUTOTRIM",True)).lower() not in ("0","false","no")
+
+def trimalbinary(infil,outfile):
     cmd = ["trimal","-automated1","-in",infil,"-out",outfile]
     with open(os.devnull,"w") as devnull:
         try:
@@ -39,53 +63,61 @@ def trimal(infil,outfile):
             log.error("TrimAl: error, could not process %s - %s"%(outfile,e))
             return False
 
+def trimal(infil,outfile):
+    if useautotrim():
+        try:
+            autotrim.trimfile(infil,outfile)
+            log.debug("AutoTrim: finished %s"%outfile)
+            return True
+        except ValueError as e:
+            #alignments autotrim rejects are left to the binary to reproduce its exact behaviour
+            log.debug("AutoTrim: %s - %s, running trimal"%(outfile,e))
+        except IOError as e:
+            log.error("AutoTrim: error, could not process %s - %s"%(outfile,e))
+            return False
+    return trimalbinary(infil,outfile)
+
 # def getgenes(infile,tdir,outfile):
 #     #Use gbk only for now
 #     foundorg, genus = parsegbk.convertgenes(infile,tdir,plasmid=True,userecnum=True,clust=True,rename=outfile)
 #     return foundorg, genus
 
-def raxmlEPA(outdir,inalgn,reftree):
-    #Run raxml EPA
-    cmd="raxmlHPC-SSE3 -f v -m GTRGAMMA -p 12345 -w %s -t %s -s %s -n %s"%(outdir,reftree,inalgn,os.path.split(reftree)[-1])
-    try:
-        with open(os.devnull,"w") as devnull:
-            subprocess.call(cmd.split(),stdout=devnull)
-        log.debug("RAxML-EPA: finished %s"%inalgn)
-        return True
-    except subprocess.CalledProcessError as e:
-        log.error("RAxML-EPA: error, could not process %s - %s"%(inalgn,e))
-        return False
-
-def mergealign(refalgn,newseqs,outfile,cpu=1):
-    #ofil = tempfile.NamedTemporaryFile(dir=os.path.split(outfile)[0])
+def mergealigntext(refalgn,newseqs,cpu=1):
+    #returns the alignment from mafft stdout
     cmd = ["mafft","--quiet","--add",newseqs,refalgn]
     if cpu>1:
         cmd[1:1] = ["--thread","%s"%cpu]
-    # if os.path.isfile(outfile+".tmafft"):
-    #     cmd[1:1] = ["--treein", outfile+".tmafft"]
     try:
-        # ofil = tempfile.NamedTemporaryFile(dir=os.path.split(newseqs)[0])
-        with open(outfile,"w") as ofil:
-            subprocess.call(cmd,stdout=ofil)
-        log.debug("MAFFT: finished %s"%newseqs)
-        return True
-    except subprocess.CalledProcessError as e:
-        log.error("MAFFT: error, failed to align %s"%outfile)
+        proc = Popen(cmd,stdout=PIPE,universal_newlines=True)
+        algn = proc.communicate()[0]
+    except OSError as e:
+        log.error("MAFFT: error, failed to align %s - %s"%(newseqs,e))
+        return False
+    if proc.returncode or not algn:
+        log.error("MAFFT: error, failed to align %s"%newseqs)
         return False
+    log.debug("MAFFT: finished %s"%newseqs)
+    return algn
 
-def getcutvals(fname):
-    cut_vals={}
-    with open(fname,"r") as fil:
-        non_decimal = re.compile(r'[^\d.]+')
-        for line in fil:
-            if line.startswith("NAME"):
-                modelname=line.split()[1]
-                if modelname not in cut_vals:
-                    cut_vals[modelname]={}
-            if line.startswith("GA ") or line.startswith("TC ") or line.startswith("NC "):
-                cv=line.split()
-                cut_vals[modelname][cv[0]]=[float(non_decimal.sub('',cv[1])),float(non_decimal.sub('',cv[2]))]
-    return cut_vals
+def trimaligntext(algn,outfile):
+    #trim alignment text, the trimal binary needs it on disk first
+    if useautotrim():
+        try:
+            autotrim.trimtext(algn,outfile)
+            log.debug("AutoTrim: finished %s"%outfile)
+            return True
+        except ValueError as e:
+            log.debug("AutoTrim: %s - %s, running trimal"%(outfile,e))
+    with open(outfile+".aln","w") as ofil:
+        ofil.write(algn)
+    return trimalbinary(outfile+".aln",outfile)
+
+def scratchroot():
+    #short lived per gene files go to memory backed storage when available
+    for x in (os.getenv("ARTS_SCRATCH",""),"/dev/shm"):
+        if x and os.path.isdir(x) and os.access(x,os.W_OK):
+            return os.path.realpath(x)
+    return tempfile.gettempdir()
 
 def converthmm(hmmfile,outfile):
     if hmmfile and os.path.exists(hmmfile):
@@ -125,25 +157,6 @@ def concathmms(hmmdbs,tdir=None):
     else:
         return False
 
-def parsegmatrix(fname,avgs=True):
-    temp={}
-    with open(fname,"r") as fil:
-        for line in fil:
-            if line.startswith("#Gene"):
-                temp["_orgs"]=line.strip().split("\t")[5:]
-            if line.startswith("#Singles"):
-                if "," in line:
-                    temp["_singles"]=set(line.strip().split("\t")[1].split(","))
-            elif not line.startswith("#"):
-                x = line.strip().split("\t")
-                if avgs:
-                    temp[x[0]]=[float(v) for v in x[1:5]]
-                    # temp[x[0]].append(float(x[4])/len(x[5:]))
-                    temp[x[0]].extend([float(v) for v in x[5:]])
-                else:
-                    temp[x[0]]=[float(x[1])]
-    return temp
-
 def getdupgenes(refgm,genematrix,maxcount=3,minsr=0.2,minubiq=0.2):
     glist = list(set(refgm.keys())&set(genematrix.keys()))
     duplist = []
@@ -159,41 +172,342 @@ def getdupgenes(refgm,genematrix,maxcount=3,minsr=0.2,minubiq=0.2):
             duplist.append(k)
     return duplist
 
-def runhmmer(fname,hmmdb,tdir,cut=None,mcpu=1):
-    tf = tempfile.NamedTemporaryFile(prefix="domrslt_",suffix=".domhr",dir=tdir,delete=False)
-    tf.close()
-    with open(tf.name+".log","w") as logfil:
-        cmd=["hmmsearch", "--domtblout", tf.name, "--noali", "--notextw", hmmdb, fname]
+#hmmsearch threading stops scaling past this many cores, larger budgets are split into model shards
+HMMSHARDCPU = 4
+#use hmmscan against pressed models when models outnumber query sequences by this factor
+HMMSCANRATIO = 10
+
+def hmmsearch(fname,hmmdb,outfile,cut=None,mcpu=1):
+    with open(outfile+".log","w") as logfil:
+        cmd=["hmmsearch", "--domtblout", outfile, "--noali", "--notextw", hmmdb, fname]
         if mcpu>1:
             cmd[1:1] = ["--cpu", str(mcpu)]
         if cut and cut.lower() in ("ga","tc","nc"):
             cmd[1:1] = ["--cut_%s"%cut.lower()]
         else:
             cmd[1:1] = ["-E","0.01"]
-        subprocess.call(cmd, stdout=logfil, stderr=logfil)
+        return subprocess.call(cmd, stdout=logfil, stderr=logfil)
+
+def hmmscan(fname,hmmdb,outfile,nseqs,cut=None,mcpu=1):
+    with open(outfile+".log","w") as logfil:
+        #Z set to the number of sequences keeps evalues on the hmmsearch scale
+        cmd=["hmmscan", "--domtblout", outfile, "--noali", "--notextw", "-Z", str(nseqs), hmmdb, fname]
+        if mcpu>1:
+            cmd[1:1] = ["--cpu", str(mcpu)]
+        if cut and cut.lower() in ("ga","tc","nc"):
+            cmd[1:1] = ["--cut_%s"%cut.lower()]
+        else:
+            cmd[1:1] = ["-E","0.01"]
+        return subprocess.call(cmd, stdout=logfil, stderr=logfil)
+
+def scantosearch(infile,outfile,fname,hmmdb):
+    """Rewrite hmmscan domtblout in hmmsearch layout (sequence as target, model order, sequence descriptions)"""
+    seqdesc = {}
+    with open(fname,"r") as fil:
+        for line in fil:
+            if line[0]==">":
+                x = line[1:].strip().split(None,1)
+                seqdesc[x[0]] = x[1] if len(x)>1 else "-"
+    models = {}
+    with open(hmmdb,"r") as fil:
+        for line in fil:
+            if line.startswith("NAME"):
+                models.setdefault(line.split()[1],len(models))
+    header = []
+    footer = []
+    rows = []
+    with open(infile,"r") as fil:
+        for line in fil:
+            if line[0]=="#":
+                (footer if rows else header).append(line)
+                continue
+            x = line.split(None,22)
+            rows.append(x[3:6]+x[0:3]+x[6:22]+[seqdesc.get(x[3],"-")])
+    rows.sort(key=lambda x: (models.get(x[3],len(models)),-float(x[7])))
+    with open(outfile,"w") as ofil:
+        ofil.writelines(header)
+        for x in rows:
+            ofil.write(" ".join(x)+"\n")
+        ofil.writelines(footer)
+
+def choosescan(fname,hmmdb):
+    """Number of query sequences if hmmscan should be used, otherwise 0"""
+    with open(fname,"r") as fil:
+        nseqs = sum(1 for line in fil if line[0]==">")
+    with open(hmmdb,"r") as fil:
+        nmodels = sum(1 for line in fil if line.startswith("NAME"))
+    if nseqs and nmodels >= HMMSCANRATIO*nseqs:
+        return nseqs
+    return 0
+
+def splithmms(hmmdb,outprfx,nshards):
+    """Stream hmm file into at most nshards files of consecutive models with similar size"""
+    target = os.path.getsize(hmmdb)/float(nshards)
+    shards = []
+    ofil = None
+    with open(hmmdb,"r") as ifil:
+        for line in ifil:
+            if ofil is None:
+                shards.append("%s%d.hmm"%(outprfx,len(shards)))
+                ofil = open(shards[-1],"w")
+            ofil.write(line)
+            if line.startswith("//") and ofil.tell() >= target and len(shards) < nshards:
+                ofil.close()
+                ofil = None
+    if ofil:
+        ofil.close()
+    return shards
+
+def mergedomtbl(flist,outfile):
+    """Concatenate domtblout hit lines in shard order, keeping header of first and footer of last"""
+    with open(outfile,"w") as ofil:
+        for i,fname in enumerate(flist):
+            if not os.path.exists(fname):
+                log.error("Hmmsearch shard missing: %s"%fname)
+                continue
+            with open(fname,"r") as ifil:
+                inheader = True
+                for line in ifil:
+                    if line[0]!="#":
+                        inheader = False
+                        ofil.write(line)
+                    elif (inheader and i==0) or (not inheader and i==len(flist)-1):
+                        ofil.write(line)
+
+def domtblok(fname):
+    """True if hmmer finished the table (ends with '# [ok]')"""
+    try:
+        with open(fname,"rb") as fil:
+            fil.seek(max(0,os.path.getsize(fname)-64))
+            return fil.read().rstrip().endswith(b"[ok]")
+    except (IOError,OSError):
+        return False
+
+def runhmmer(fname,hmmdb,tdir,cut=None,mcpu=1,cache=None):
+    tf = tempfile.NamedTemporaryFile(prefix="domrslt_",suffix=".domhr",dir=tdir,delete=False)
+    tf.close()
+    #Few query sequences against many models: scan sequences against cached pressed models
+    nseqs = choosescan(fname,hmmdb) if cache else 0
+    pressed = cache.pressed(hmmdb) if nseqs else False
+    if pressed:
+        log.debug("Hmmscan: %s sequences against %s"%(nseqs,pressed))
+        hmmscan(fname,pressed,tf.name+".scan",nseqs,cut,mcpu)
+        scantosearch(tf.name+".scan",tf.name,fname,hmmdb)
+        os.rename(tf.name+".scan.log",tf.name+".log")
+        os.remove(tf.name+".scan")
+        return tf.name
+    shards = []
+    if mcpu > HMMSHARDCPU:
+        shards = splithmms(hmmdb,tf.name+".shard",mcpu//HMMSHARDCPU)
+    if len(shards) > 1:
+        #Models are independent (evalues depend on target count only) so shards run concurrently
+        log.debug("Hmmsearch: %s shards of %s"%(len(shards),hmmdb))
+        outfiles = [x+".domhr" for x in shards]
+        pool = ThreadPool(len(shards))
+        jobs = [pool.apply_async(hmmsearch, args=(fname,shard,outfile,cut,max(1,mcpu//len(shards)))) for shard,outfile in zip(shards,outfiles)]
+        pool.close()
+        pool.join()
+        failed = []
+        for job,outfile in zip(jobs,outfiles):
+            try:
+                job.get()
+            except Exception as e:
+                log.error("Hmmsearch shard %s failed (%s)"%(outfile,e))
+            if not domtblok(outfile):
+                failed.append(outfile)
+        mergedomtbl(outfiles,tf.name)
+        with open(tf.name+".log","w") as logfil:
+            for outfile in outfiles:
+                if os.path.exists(outfile+".log"):
+                    with open(outfile+".log","r") as ifil:
+                        shutil.copyfileobj(ifil,logfil)
+        for x in shards+outfiles+[x+".log" for x in outfiles]:
+            if os.path.exists(x):
+                os.remove(x)
+        #a partial merged table would silently drop the hits of unfinished shards
+        if failed:
+            raise IOError("%d of %d hmmsearch shards did not finish for %s"%(len(failed),len(shards),hmmdb))
+    else:
+        for x in shards:
+            os.remove(x)
+        hmmsearch(fname,hmmdb,tf.name,cut,mcpu)
     return tf.name
 
-def buildtrees(refdir, tdir, fname, cpu=1):
+def runsearches(searches,tdir,mcpu=1,cache=None,stages=None,required=()):
+    """Run independent hmmsearch jobs {name:(seqfile,hmmdb,cut)} concurrently within mcpu, returns {name:domtblout}.
+    Failed jobs are left out, except names in required whose exception is raised"""
+    results = {}
+    keys = {}
+    searches = dict(searches)
+    if stages and stages.enabled:
+        #identical sequences, models and cutoff of a previous job
+        for k,(fname,hmmdb,cut) in list(searches.items()):
+            keys[k] = stages.key("search",[fname,hmmdb],cut)
+            x = stages.fetch(keys[k],tdir)
+            if x:
+                results[k] = tdir+x
+                del searches[k]
+    if not searches:
+        return results
+    nproc = max(1,min(len(searches),mcpu))
+    sizes = {k:os.path.getsize(x[1]) if x[1] and os.path.isfile(x[1]) else 1 for k,x in searches.items()}
+    jobs = {}
+    pool = ThreadPool(nproc)
+    #largest model db first, cpus split by model db size when all jobs run at once
+    for k in sorted(searches.keys(),key=lambda k: sizes[k],reverse=True):
+        if nproc == len(searches):
+            cpu = max(1,int(mcpu*sizes[k]/sum(sizes.values())))
+        else:
+            cpu = max(1,mcpu//nproc)
+        fname,hmmdb,cut = searches[k]
+        jobs[k] = pool.apply_async(runhmmer,args=(fname,hmmdb,tdir,cut,cpu,cache))
+    pool.close()
+    pool.join()
+    for k,x in jobs.items():
+        try:
+            results[k] = x.get()
+        except Exception as e:
+            log.error("Hmmsearch failed for %s (%s)"%(searches[k][1],e))
+            if k in required:
+                raise
+            continue
+        if k in keys and domtblok(results[k]):
+            outfile = os.path.split(results[k])[-1]
+            stages.store(keys[k],tdir,[x for x in (outfile,outfile+".log") if os.path.exists(tdir+x)],outfile)
+    return results
+
+#external programs used by buildtrees, their versions are part of cached tree keys
+TREETOOLS = ["mafft","trimal","raxmlHPC-SSE3","epa-ng"]
+
+def treetools(stages):
+    return stages.tools(TREETOOLS)+stages.stamps([os.path.splitext(x.__file__)[0]+".py" for x in (autotrim,placement)])+[useautotrim(),os.getenv("ARTS_PLACEMENT","")]
+
+def readseqs(fname):
+    """Names and sequences of a fasta file in file order"""
+    names = []
+    seqs = []
+    with open(fname,"r") as fil:
+        for line in fil:
+            if line[0]==">":
+                names.append(line[1:].split(None,1)[0])
+                seqs.append([])
+            elif seqs:
+                seqs[-1].append(line.strip())
+    return names,["".join(x).upper() for x in seqs]
+
+def relabelseqs(text,old,new):
+    """Replace sequence names old[i] with new[i] in newick or fasta text"""
+    names = {x:y for x,y in zip(old,new) if x!=y}
+    if not names:
+        return text
+    pat = re.compile(r"(?<![\w|.-])(%s)(?![\w|.-])"%"|".join(re.escape(x) for x in sorted(names,key=len,reverse=True)))
+    return pat.sub(lambda m: names[m.group(1)],text)
+
+def cachedtree(stages, tdir, fname, key):
+    """Copy cached tree and alignments of identical query sequences, renamed to the current query names"""
+    names = stages.fetch(key,tdir)
+    if names is None:
+        return False
+    newnames = readseqs(tdir+"coregenes/"+fname)[0]
+    for x in ("trees/%s.tree"%os.path.splitext(fname)[0],"alignedcore/"+fname,"trimmedcore/"+fname):
+        if os.path.isfile(tdir+x):
+            with open(tdir+x,"r") as fil:
+                text = fil.read()
+            with open(tdir+x,"w") as ofil:
+                ofil.write(relabelseqs(text,names,newnames))
+    return True
+
+def buildtrees(refdir, tdir, fname, cpu=1, stages=None, keepalign=False, groups=None):
+    """Align and place query sequences of coregenes/fname, groups {outdir:[query names]} places queries of several
+    jobs together and writes each group's tree to outdir/trees (default: all queries to tdir)"""
     trimm = False
     rxml = False
     algn = False
-    if os.path.isfile(refdir+fname):
-        algn = mergealign(refdir+fname, tdir+"coregenes/"+fname,tdir+"alignedcore/"+fname,cpu)
-    if algn:
-        trimm = trimal(tdir+"alignedcore/"+fname, tdir+"trimmedcore/"+fname)
-    if trimm:
-        reftree = refdir+"trees/"+os.path.splitext(fname)[0]+".tree"
-        rxml = raxmlEPA(os.path.realpath(tdir+"raxml/"),tdir+"trimmedcore/"+fname,reftree)
-    labledtree = tdir+"raxml/RAxML_labelledTree.%s.tree"%os.path.splitext(fname)[0]
-    if rxml and os.path.exists(labledtree):
-        with open(labledtree,"r") as ifil, open(tdir+"trees/%s.tree"%os.path.splitext(fname)[0],"w") as ofil:
-            x = ifil.readline()       #x = ifil.next()
-            ofil.write(re.sub("\[I\d+?\]|\"|'|QUERY___","",x))
-        log.info("BuildTree: Finished %s"%os.path.split(fname)[-1])
-        return True
-    else:
-        log.error("BuildTree Failed: %s"%fname)
-        return False
+    treekey = None
+    gene = os.path.splitext(fname)[0]
+    names,seqs = readseqs(tdir+"coregenes/"+fname)
+    if not groups:
+        groups = {tdir:names}
+    elif stages and stages.enabled:
+        log.debug("BuildTree: tree cache is not used for grouped queries")
+        stages = None
+    if stages and stages.enabled and os.path.isfile(refdir+fname):
+        #placement only depends on query sequences and reference data, names are swapped in
+        treekey = stages.key("genetree",[],hashlib.sha1("\n".join(seqs).encode()).hexdigest(),
+                             stages.stamps([refdir+fname,refdir+"trees/"+os.path.splitext(fname)[0]+".tree"]),treetools(stages))
+        if cachedtree(stages,tdir,fname,treekey):
+            log.info("BuildTree: Finished %s (cached)"%os.path.split(fname)[-1])
+            return True
+    #mafft output is trimmed in memory, only the trimmed alignment and raxml files are written to scratch
+    sdir = tempfile.mkdtemp(prefix="arts-%s-"%gene,dir=scratchroot())+"/"
+    try:
+        if os.path.isfile(refdir+fname):
+            algn = mergealigntext(refdir+fname, tdir+"coregenes/"+fname, cpu)
+        if algn:
+            trimm = trimaligntext(algn, sdir+fname)
+        if trimm:
+            reftree = refdir+"trees/"+gene+".tree"
+            rxml = placement.getbackend().place(sdir,sdir+fname,reftree,groups,cpu)
+        if rxml and len(rxml) == len(groups):
+            for odir,tree in rxml.items():
+                with open(odir+"trees/%s.tree"%gene,"w") as ofil:
+                    ofil.write(re.sub("\[I\d+?\]|\"|'|QUERY___","",tree.strip())+"\n")
+                if keepalign:
+                    with open(odir+"alignedcore/"+fname,"w") as ofil:
+                        ofil.write(algn)
+                    shutil.copyfile(sdir+fname,odir+"trimmedcore/"+fname)
+            if treekey:
+                stages.store(treekey,tdir,["trees/%s.tree"%gene]+[x+fname for x in ("alignedcore/","trimmedcore/") if os.path.isfile(tdir+x+fname)],names)
+            log.info("BuildTree: Finished %s"%os.path.split(fname)[-1])
+            return True
+        else:
+            log.error("BuildTree Failed: %s"%fname)
+            return False
+    finally:
+        shutil.rmtree(sdir,ignore_errors=True)
+
+def treecost(refdir,fname):
+    #reference alignment size ~ number of reference sequences x alignment length
+    return os.path.getsize(refdir+fname) if os.path.isfile(refdir+fname) else 0
+
+def scheduletrees(refdir, tdir, flist, mcpu=1, stages=None, keepalign=False, groups=None):
+    """Build gene trees largest first within mcpu cores, large alignments get more mafft threads.
+    groups {fname:{outdir:[query names]}} is passed on to buildtrees. Returns {fname:success}"""
+    costs = {x:treecost(refdir,x) for x in flist}
+    total = float(sum(costs.values())) or 1.0
+    #enough threads that no single gene takes longer than an even share of all work
+    threads = {x:min(mcpu,max(1,int(math.ceil(mcpu*costs[x]/total)))) for x in flist}
+    pending = sorted(flist,key=lambda x: costs[x],reverse=True)
+    results = {}
+    state = {"free":mcpu}
+    cond = Condition()
+    def run(fname,cpu):
+        try:
+            ok = buildtrees(refdir,tdir,fname,cpu,stages,keepalign,groups.get(fname) if groups else None)
+        except Exception as e:
+            log.error("BuildTree Failed: %s (%s)"%(fname,e))
+            ok = False
+        with cond:
+            results[fname] = ok
+            state["free"] += cpu
+            log.info("BuildTree: Progress %s of %s"%(len(results),len(flist)))
+            cond.notify()
+    workers = []
+    with cond:
+        for fname in pending:
+            while state["free"] < 1:
+                cond.wait()
+            #never wait for a full allocation, remaining cores are filled by the next genes
+            cpu = min(threads[fname],state["free"])
+            state["free"] -= cpu
+            workers.append(Thread(target=run,args=(fname,cpu)))
+            workers[-1].start()
+    for x in workers:
+        x.join()
+    failed = sorted(x for x,ok in results.items() if not ok)
+    if failed:
+        log.warning("BuildTree: %s of %s trees failed: %s"%(len(failed),len(flist),", ".join(failed)))
+    return results
 
 def catTrees(flist,outfile):
     with open(outfile,"w") as ofil:
@@ -223,8 +537,12 @@ def makesptree(tlist,outdir,astjar=False):
     #Call Astral:
     log.info("Started building ASTRAL coalescent MLST tree...")
     if os.path.exists(outfile):
+        #persistent JVM started by runjobs, java is only launched here if there is none
+        if astjar and os.path.exists(astjar) and astralservice.runastral(outfile,outdir+"astMLST.tree",outdir+"astral.log",astjar):
+            log.info("Finished coalescent tree: %s"%outdir+"astMLST.tree")
+            return outdir+"astMLST.tree"
         if astjar and os.path.exists(astjar):
-            cmd = ["java","-Xmx3000M","-jar",astjar,"-i",outfile,"-o",outdir+"astMLST.tree","-t","0"]
+            cmd = ["java","-Xmx%s"%os.getenv("ARTS_ASTRAL_HEAP",astralservice.HEAP),"-jar",astjar,"-i",outfile,"-o",outdir+"astMLST.tree","-t","0"]
         else:
             log.warning("attempting to launch astral as 'astral'")
             cmd = ["astral","-i",outfile,"-o",outdir+"astMLST.tree","-t","0"]
@@ -239,6 +557,19 @@ def makesptree(tlist,outdir,astjar=False):
             raise
     return False
 
+def insertsptree(refdir,tlist,outdir,queryorg):
+    #query is inserted into the precomputed reference species tree by quartet scoring against its gene trees
+    outfile = catTrees(tlist,outdir+"allmlst_cat.nwk")
+    with open(refdir+sptreeplace.REFSPTREE,"r") as fil, open(outfile,"r") as gfil:
+        tree,score = sptreeplace.insertquery(fil.readline(),gfil.readlines(),queryorg)
+    if not tree:
+        log.warning("Could not place %s in reference species tree"%queryorg)
+        return False
+    with open(outdir+"astMLST.tree","w") as ofil:
+        ofil.write(tree+"\n")
+    log.info("Finished species tree: %s"%outdir+"astMLST.tree")
+    return outdir+"astMLST.tree"
+
 def checkbgcprox(clusters,gtypes=[],glist=[],modeldata={}):
     bgchits = {"cluster-%s"%bgc[0]:{"row":["cluster-%s"%bgc[0],bgc[1],bgc[2],"%s - %s"%(bgc[3],bgc[4])],"hits":[]} for bgc in clusters}
     corebgchits = {}
@@ -506,41 +837,6 @@ def writebgctable(temp,outfile):
         for x in temp["data"]:
             tfil.write("\t".join([str(y) for y in x])+"\n")
 
-#get model metadata from json, tsv or hmm file
-def getmodeldata(fname="",hmmname=""):
-    modeldata = {}
-    log.debug("Getting model metadata...")
-    if ".json" in fname.lower() and os.path.exists(fname):
-        with open(fname,"r") as fil:
-            modeldata = json.load(fil)
-    elif ".tsv" in fname.lower() and os.path.exists(fname):
-        with open(fname,"r") as fil:
-            for line in fil:
-                if not line.startswith("#"):
-                    x = line.strip().split("\t")
-                    if x[0] not in modeldata:
-                        modeldata[x[0]] = x[1:]
-    elif ".hmm" in hmmname.lower() and os.path.exists(hmmname):
-        with open(hmmname,"r") as fil:
-            x = ["N/A","N/A","N/A","N/A","N/A","N/A","N/A","N/A"]
-            for line in fil:
-                if line.startswith("ACC"):
-                    x[0] = " ".join(line.split()[1:])
-                if line.startswith("NAME"):
-                    x[1] = " ".join(line.split()[1:])
-                if line.startswith("DESC"):
-                    x[2] = " ".join(line.split()[1:])
-                if line.startswith("TC"):
-                    x[4] = line.split()[1]
-                if line.startswith("HMM "):
-                    if x[0] not in modeldata:
-                        modeldata[x[0]] = x[1:]
-                    x = ["N/A","N/A","N/A","N/A","N/A","N/A","N/A","N/A"]
-    else:
-        log.error("Could not get model metadata, ensure file is .json, .tsv, or .hmm")
-        return False
-    return modeldata
-
 #simple sub strings from location text
 def parsesourcelocation(x):
     x=x.strip()
@@ -563,9 +859,12 @@ def parsesourcelocation(x):
             loc = x[idx1+5:].split("_")
     return source,loc
 
+#state of batch jobs between per genome stages and the shared phylogeny
+BATCHSTATE = "batchstate.pickle"
+
 def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,cut=None,
                astjar=False,toconsole=False,mcpu=1,asrun=False,knownhmms=False,dufhmms=False,
-               custcorehmms=False,custhmms=False,aspath=None,options="phyl,kres,duf",custorgname=None,prebuilttrees=False,bcp=None, run_bsc=False):
+               custcorehmms=False,custhmms=False,aspath=None,options="phyl,kres,duf",custorgname=None,prebuilttrees=False,bcp=None, run_bsc=False,hmmcache=None,stagecache=None,keepalign=False,batch=False,fullsptree=False):
     try:
         #Set Working directory
         if type(rd) is str and not rd.endswith("/"):
@@ -592,7 +891,6 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
             os.mkdir(tdir+"coregenes")
             os.mkdir(tdir+"alignedcore")
             os.mkdir(tdir+"trimmedcore")
-            os.mkdir(tdir+"raxml")
             os.mkdir(tdir+"trees")
             os.mkdir(tdir+"tables")
 
@@ -624,8 +922,23 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
         if not os.path.isfile(infile):
             log.error("Error: No such input path %s"%infile)
             raise IOError
+        #outputs of finished stages are reused by jobs with identical inputs
+        stages = StageCache(stagecache)
+        querygenes = []
         try:
-            queryorg, querygenus, clusters, locus_names = parsegbk.convertgenes(infile,tdir,plasmid=True,userecnum=True,clust=True,rename=oldfname)
+            parsekey = stages.key("parse",[infile],".final.gbk" in infile)
+            prslt = stages.fetch(parsekey,tdir)
+            if prslt:
+                if prslt["fname"] != oldfname:
+                    for ext in (".fna",".clust.tsv"):
+                        os.rename(tdir+prslt["fname"]+ext,tdir+oldfname+ext)
+                queryorg, querygenus, clusters, querygenes = prslt["org"], prslt["genus"], prslt["clusters"], prslt["genes"]
+                asdir = os.path.abspath(os.path.join(infile, os.pardir))
+                locus_names = {os.path.join(asdir,k):x for k,x in prslt["loci"].items()}
+            else:
+                queryorg, querygenus, clusters, locus_names = parsegbk.convertgenes(infile,tdir,plasmid=True,userecnum=True,clust=True,rename=oldfname,stream=True,cpu=mcpu,bundle=querygenes)
+                stages.store(parsekey,tdir,[oldfname+".fna",oldfname+".clust.tsv"],{"fname":oldfname,"org":queryorg,"genus":querygenus,"clusters":clusters,"genes":querygenes,
+                             "loci":{os.path.split(k)[-1]:x for k,x in locus_names.items()}})
             with open(os.path.join(tdir,"locus_to_region.pickle"), "wb") as locus_file:
                 pickle.dump(locus_names, locus_file)
             if custorgname:
@@ -639,11 +952,19 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
             log.error("Biopython could not parse genbank. please ensure no external sequence references are present")
             log.exception("exception")
 
-        infasta = oldfname+".fna"
-        makequerydb(infasta,tdir,"queryseqs",orgname=queryorg)
+        querydb = makequerydb(querygenes,tdir,"queryseqs",orgname=queryorg)
         log.info("query: org=%s"%queryorg)
         log.info("query: genus=%s"%querygenus)
 
+        #merged and pressed models are reused between jobs when a cache directory is set
+        try:
+            cache = HmmCache(hmmcache)
+            if not cache.enabled:
+                cache = None
+        except OSError as e:
+            log.warning("Hmm model cache not available (%s)"%e)
+            cache = None
+
         #use list of hmmmodels if directory is specified
         # if hmmdbs and os.path.isdir(hmmdbs):
         #     if not hmmdbs.endswith("/"):
@@ -653,6 +974,9 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
         #     hmmdb = concathmms(hmmdbs,tdir)
         # elif hmmdbs:
         #     hmmdb = hmmdbs
+        #precompiled reference data (see refbundle.py), parsed from source files if missing
+        refdata = RefBundle.load(refdir)
+        refcorehmm = None
         if type(hmmdbs) is list and all([validatehmms(x) for x in hmmdbs]):
             hmmdb = concathmms(hmmdbs,tdir)
             modeldata = getmodeldata(hmmname=hmmdb)
@@ -660,9 +984,16 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
             hmmdb = os.path.join(refdir,"coremodels.hmm")
             if "expert" in options and os.path.exists(os.path.join(refdir,"coremodels_exp.hmm")):
                 hmmdb = os.path.join(refdir,"coremodels_exp.hmm")
-            modeldata = getmodeldata(fname=os.path.join(refdir,"model_metadata.json"),hmmname=hmmdb)
+            refcorehmm = hmmdb
+            modeldata = refdata.modeldata() if refdata else None
+            if modeldata is None:
+                modeldata = getmodeldata(fname=os.path.join(refdir,"model_metadata.json"),hmmname=hmmdb)
         if custcorehmms and validatehmms(custcorehmms):
-            hmmdb = concathmms([converthmm(hmmdb,os.path.join(tdir,"core.hmm")),converthmm(custcorehmms,os.path.join(tdir,"custcore.hmm"))],tdir)
+            mergedhmm = cache.merged([hmmdb,custcorehmms]) if cache else False
+            if mergedhmm:
+                hmmdb = mergedhmm
+            else:
+                hmmdb = concathmms([converthmm(hmmdb,os.path.join(tdir,"core.hmm")),converthmm(custcorehmms,os.path.join(tdir,"custcore.hmm"))],tdir)
             modeldata.update(getmodeldata(hmmname=custcorehmms))
             # with open(tdir+"model_metadata.json","w") as expfil:
             #     json.dump(modeldata,expfil,indent=2)
@@ -675,7 +1006,13 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
 
     try:
         #Set cutoff thresholds for core search
-        cut_vals = getcutvals(hmmdb)
+        cut_vals = refdata.cutvals(refcorehmm) if refdata and refcorehmm else None
+        if cut_vals is None:
+            cut_vals = getcutvals(hmmdb)
+        elif hmmdb != refcorehmm:
+            #custom core models were merged after the reference models
+            for k,x in getcutvals(custcorehmms).items():
+                cut_vals.setdefault(k,{}).update(x)
         log.debug("Setting thresholds...")
         if cut and cut.upper() in ("GA","NC"):
             log.debug("Setting %s cutoff..."%cut)
@@ -697,33 +1034,53 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
         log.warning("Could not set thresholds using default trusted cutoffs")
         cut = None
 
+    ### Start independent hmmsearches concurrently, results are added in the original order
+    searches = {}
+    if rnahmm and os.path.exists(rnahmm):
+        log.info("Starting RNA hmmsearch...")
+        searches["rna"] = (tdir+"queryseqs.fna",rnahmm,"tc")
+    try:
+        #Run Known resistance models and custom supplied models
+        if knownhmms and os.path.exists(knownhmms) and "kres" in options.lower():
+            #Confirm and add custom hmm models
+            log.info("Checking customhmms %s..."%custhmms)
+            if validatehmms(custhmms):
+                mergedhmm = cache.merged([knownhmms,custhmms]) if cache else False
+                if mergedhmm:
+                    knownhmms = mergedhmm
+                else:
+                    knownhmms = concathmms([converthmm(knownhmms,os.path.join(tdir,"kres.hmm")),converthmm(custhmms,os.path.join(tdir,"custres.hmm"))],tdir)
+                log.info("Combined knownhmms = %s"%knownhmms)
+            modeldata.update(getmodeldata(hmmname=knownhmms))
+            log.info("Start known resistance search...")
+            searches["kres"] = (tdir+"queryseqs.faa",knownhmms,"tc")
+    except Exception as e:
+        log.warning("Could not get known resistance hits")
+        log.exception("exception")
+    if dufhmms and os.path.exists(dufhmms) and "duf" in options.lower():
+        log.info("Start DUF search...")
+        searches["duf"] = (tdir+"queryseqs.faa",dufhmms,"tc")
+    if hmmdb:
+        log.info("Starting Core Gene hmmsearch... (%s)"%(hmmdb))
+        searches["core"] = (tdir+"queryseqs.faa",hmmdb,defaultcut)
+    domrslts = runsearches(searches,tdir,mcpu,cache,stages,required=["core"])
+
     try:
-        ### RUN RNA Search and add to sql
-        if rnahmm and os.path.exists(rnahmm):
-            log.info("Starting RNA hmmsearch...")
-            hmmdomrslt=runhmmer(tdir+"queryseqs.fna",rnahmm,tdir,cut="tc",mcpu=mcpu)
+        ### Add RNA results to sql
+        if "rna" in domrslts:
             log.info("Adding RNA hmmresults...")
-            makehmmsql.run(hmmdomrslt,tdir+"queryseqs.db",ev=0.1,rna=True)
+            makehmmsql.run(domrslts["rna"],querydb,ev=0.1,rna=True)
 
             ### Extract RNA hits
-            getrnagenes.runfile(tdir+"queryseqs.db",outdir=tdir+"coregenes")
+            getrnagenes.runfile(querydb,outdir=tdir+"coregenes")
     except Exception as e:
         log.warning("Could not get RNA hits")
         log.exception("exception")
 
     try:
-        #Run Known resistance models and custom supplied models
         knownhits={}
-        if knownhmms and os.path.exists(knownhmms) and "kres" in options.lower():
-            #Confirm and add custom hmm models
-            log.info("Checking customhmms %s..."%custhmms)
-            if validatehmms(custhmms):
-                knownhmms = concathmms([converthmm(knownhmms,os.path.join(tdir,"kres.hmm")),converthmm(custhmms,os.path.join(tdir,"custres.hmm"))],tdir)
-                log.info("Combined knownhmms = %s"%knownhmms)
-            modeldata.update(getmodeldata(hmmname=knownhmms))
-            log.info("Start known resistance search...")
-            hmmdomrslt=runhmmer(tdir+"queryseqs.faa",knownhmms,tdir,cut="tc",mcpu=mcpu)
-            os.rename(hmmdomrslt,tdir+"knownhits.domhr")
+        if "kres" in domrslts:
+            os.rename(domrslts["kres"],tdir+"knownhits.domhr")
             #write results to json file
             knownhits = {"data":[],"seqs":{}}
             with open(os.path.join(tdir,"knownhits.domhr"),"r") as fil, open(os.path.join(tdir,"tables","knownhits.json"),"w") as ofil, open(os.path.join(tdir,"tables","knownhits.tsv"),"w") as tfil:
@@ -751,12 +1108,10 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
         log.exception("exception")
 
     try:
-        #Run DUF models
+        #Add DUF results
         dufhits={}
-        if dufhmms and os.path.exists(dufhmms) and "duf" in options.lower():
-            log.info("Start DUF search...")
-            hmmdomrslt=runhmmer(tdir+"queryseqs.faa",dufhmms,tdir,cut="tc",mcpu=mcpu)
-            os.rename(hmmdomrslt,tdir+"dufhits.domhr")
+        if "duf" in domrslts:
+            os.rename(domrslts["duf"],tdir+"dufhits.domhr")
             #write results to json file
             dufhits = {"data":[],"seqs":{}}
             with open(os.path.join(tdir,"dufhits.domhr"),"r") as fil, open(os.path.join(tdir,"tables","dufhits.json"),"w") as ofil:
@@ -782,15 +1137,15 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
 
     log.info("Milestone_1_complete")
 
-    ### RUN CORE Search and add to sql
-    if hmmdb:
-        log.info("Starting Core Gene hmmsearch... (%s)"%(hmmdb))
-        hmmdomrslt=runhmmer(tdir+"queryseqs.faa",hmmdb,tdir,cut=defaultcut,mcpu=mcpu)
-        log.info("Adding hmmresults...")
-        makehmmsql.run(hmmdomrslt,tdir+"queryseqs.db",ev=0.1)
-    else:
+    ### Add CORE results to sql
+    if "core" not in domrslts:
         log.error("No hmm models found")
         raise IOError
+    corekey = stages.key("core",[tdir+"queryseqs.faa",tdir+"queryseqs.fna",domrslts["core"],domrslts.get("rna")],cut)
+    corecache = stages.fetch(corekey,tdir+"coregenes/")
+    #hit table is also needed on a cache hit (exported queryseqs.db and later stages read it)
+    log.info("Adding hmmresults...")
+    makehmmsql.run(domrslts["core"],querydb,ev=0.1)
 
     ### EXTRACT Core and Count duplicates and check proximity
     log.info("Extracting core genes...")
@@ -799,8 +1154,15 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
     corelist = {}
     try:
         # corelist = getcoregenes.writeall(tdir+"coregenes/",tdir+"queryseqs.db",filt2=cut)
-        corelist = extractdbgenes.writeall(tdir+"coregenes/",tdir+"queryseqs.db",filt2=cut)
-        refgm = parsegmatrix(refdir + "genematrix.txt")
+        if corecache is None:
+            corelist = extractdbgenes.writeall(tdir+"coregenes/",querydb,filt2=cut)
+            stages.store(corekey,tdir+"coregenes/",os.listdir(tdir+"coregenes"),corelist)
+        else:
+            corelist = corecache
+        exportquerydb(querydb,"queryseqs")
+        refgm = refdata.genematrix() if refdata else None
+        if refgm is None:
+            refgm = parsegmatrix(refdir + "genematrix.txt")
         log.debug("refgm::::%s"%refgm)
         genematrix = parsegmatrix(tdir+"coregenes/"+"genematrix.txt",avgs=False)
         log.debug("refgm::::%s"%genematrix)
@@ -835,35 +1197,84 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
         log.error("Could not write output tables")
         log.exception("exception")
 
+    #state needed to finish the query, batch jobs build their phylogeny together before finishing
+    state = {"tdir":tdir,"refdir":refdir,"options":options,"queryorg":queryorg,"querygenus":querygenus,"rslt":rslt,"corelist":corelist,
+             "knownhits":knownhits,"modeldata":modeldata,"astjar":astjar,"mcpu":mcpu,"prebuilttrees":prebuilttrees,"stagecache":stagecache,
+             "keepalign":keepalign,"fullsptree":fullsptree,"toconsole":toconsole}
+    if batch:
+        with open(tdir+BATCHSTATE,"wb") as fil:
+            pickle.dump(state,fil)
+        log.info("Batch: waiting for shared phylogeny")
+        return state
+    return finishquery(state)
+
+def genetreefiles(tdir):
+    #include 16s seqs, other rRNA genes are skipped
+    return sorted(os.path.split(x)[-1] for x in glob.glob(tdir+"coregenes/*.fna") if not x.endswith("_rRNA.fna") or x.endswith("RNA_16S_rRNA.fna"))
+
+def sptreefiles(tdir,singles):
+    tlist = [tdir+"trees/%s.tree"%x for x in singles]
+    if os.path.isfile(tdir+"trees/RNA_16S_rRNA.tree"):
+        tlist.append(tdir+"trees/RNA_16S_rRNA.tree")
+    return tlist
+
+def buildphylogeny(tdir, refdir, singles, stages, mcpu=1, astjar=False, prebuilttrees=False, keepalign=False, queryorg=None, fullsptree=False):
+    """Gene trees of all core genes and species tree of single copy genes, returns species tree file or False.
+    The query is inserted into the reference species tree if there is one, fullsptree rebuilds it with ASTRAL"""
+    if prebuilttrees and os.path.isdir(prebuilttrees):
+        for pbt in glob.glob(os.path.join(os.path.realpath(prebuilttrees),"*.tree")):
+            with open(pbt,"r") as ifil, open(tdir+"trees/%s.tree"%os.path.splitext(os.path.split(pbt)[-1])[0],"w") as ofil:
+                x = ifil.readline()          #x = ifil.next()
+                ofil.write(re.sub("\[I\d+?\]|\"|'|QUERY___","",x))
+    else:
+        ### Build trees
+        flist = genetreefiles(tdir)
+        reffiles = [refdir+x for x in flist]+[refdir+"trees/"+os.path.splitext(x)[0]+".tree" for x in flist]
+        treekey = stages.key("trees",[tdir+"coregenes/"+x for x in flist],flist,stages.stamps(reffiles),treetools(stages))
+        if stages.fetch(treekey,tdir) is None:
+            scheduletrees(refdir, tdir, flist, mcpu, stages, keepalign)
+            stages.store(treekey,tdir,[os.path.join(d,x) for d in ("trees","alignedcore","trimmedcore") for x in os.listdir(tdir+d)])
+
+    log.info("Milestone_3_complete")
+
+    ### Make Species tree (Astral Coalescent)
+    tlist = sptreefiles(tdir,singles)
+    insert = not fullsptree and queryorg and os.path.isfile(refdir+sptreeplace.REFSPTREE)
+    spkey = stages.key("sptree",tlist,[os.path.split(x)[-1] for x in tlist if os.path.isfile(x)],
+                        stages.stamps([astjar if type(astjar) is str else None]+glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)),"astral","*.jar"))),
+                        [queryorg,stages.stamps([refdir+sptreeplace.REFSPTREE,sptreeplace.__file__])] if insert else None)
+    sptree = stages.fetch(spkey,tdir)
+    if sptree:
+        sptree = tdir+sptree
+    else:
+        sptree = insertsptree(refdir,tlist,tdir,queryorg) if insert else False
+        if not sptree:
+            sptree = makesptree(tlist,tdir,astjar=astjar)
+        if sptree and os.path.isfile(sptree):
+            stages.store(spkey,tdir,[x for x in ("astMLST.tree","allmlst_cat.nwk","astral.log") if os.path.isfile(tdir+x)],"astMLST.tree")
+    log.info("Milestone_4_complete")
+    return sptree
+
+def finishquery(state, sptree=None):
+    """Phylogeny comparison and result export of a query prepared by startquery. sptree is given for batch jobs
+    whose gene trees and species tree were built with the whole batch"""
+    global log
+    tdir, refdir, rslt = state["tdir"], state["refdir"], state["rslt"]
+    queryorg, querygenus, mcpu = state["queryorg"], state["querygenus"], state["mcpu"]
+    corelist, knownhits, modeldata = state["corelist"], state["knownhits"], state["modeldata"]
+    #batch jobs finish in a new process
+    log = setlog.init(tdir+"arts-query.log",toconsole=state["toconsole"])
+    stages = StageCache(state["stagecache"])
+
     try:
         ## Phylogeny check
-        if refdir and "phyl" in options.lower() and "singles" in rslt and len(rslt["singles"]):
-            if prebuilttrees and os.path.isdir(prebuilttrees):
-                for pbt in glob.glob(os.path.join(os.path.realpath(prebuilttrees),"*.tree")):
-                    with open(pbt,"r") as ifil, open(tdir+"trees/%s.tree"%os.path.splitext(os.path.split(pbt)[-1])[0],"w") as ofil:
-                        x = ifil.readline()          #x = ifil.next()
-                        ofil.write(re.sub("\[I\d+?\]|\"|'|QUERY___","",x))
+        if refdir and "phyl" in state["options"].lower() and "singles" in rslt and len(rslt["singles"]):
+            if sptree:
+                log.info("Using gene trees and species tree built for batch")
+                log.info("Milestone_3_complete")
+                log.info("Milestone_4_complete")
             else:
-                ### Build trees
-                flist = [os.path.split(x)[-1] for x in glob.glob(tdir+"coregenes/*.fna") if not x.endswith("_rRNA.fna") or x.endswith("RNA_16S_rRNA.fna")] #include 16s seqs
-                if mcpu > 1:
-                    pool = mp.Pool(mcpu)
-                    for fname in flist:
-                        pool.apply_async(buildtrees, args=(refdir, tdir, fname))
-                    pool.close()
-                    pool.join()
-                else:
-                    for fname in flist:
-                        buildtrees(refdir, tdir, fname)
-
-            log.info("Milestone_3_complete")
-
-            ### Make Species tree (Astral Coalescent)
-            tlist = [tdir+"trees/%s.tree"%x for x in rslt["singles"]]
-            if os.path.isfile(tdir+"trees/RNA_16S_rRNA.tree"):
-                tlist.append(tdir+"trees/RNA_16S_rRNA.tree")
-            sptree = makesptree(tlist,tdir,astjar=astjar)
-            log.info("Milestone_4_complete")
+                sptree = buildphylogeny(tdir,refdir,rslt["singles"],stages,mcpu,state["astjar"],state["prebuilttrees"],state["keepalign"],queryorg,state["fullsptree"])
 
             if not sptree:
                 log.error("No species tree, terminating tree comparison")
@@ -873,10 +1284,14 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
                     #Get RANGER-DTL results
                     log.info("Starting RangerDTL comparison for %s..."%queryorg)
                     tlist = [os.path.realpath(x) for x in glob.glob(tdir+"trees/*.tree")]
-                    treedict,sptree = ete3methods.mergetrees(sptree,tlist,queryorg)
-                    orgrecs = rangerdtl.runallrdtl(sptree,queryorg,treedict,mcpu)
-                    with open(tdir+"dtlresults.json","w") as fil:
-                        json.dump(orgrecs,fil,indent=2)
+                    dtlkey = stages.key("dtl",[sptree]+sorted(tlist),sorted(os.path.split(x)[-1] for x in tlist),queryorg)
+                    orgrecs = stages.fetch(dtlkey,tdir)
+                    if orgrecs is None:
+                        treedict,sptree = ete3methods.mergetrees(sptree,tlist,queryorg)
+                        orgrecs = rangerdtl.runallrdtl(sptree,queryorg,treedict,mcpu)
+                        with open(tdir+"dtlresults.json","w") as fil:
+                            json.dump(orgrecs,fil,indent=2)
+                        stages.store(dtlkey,tdir,["dtlresults.json"],orgrecs)
 
                     #Update genematrix with list of incongruent phylogeny
                     rslt["phylogeny"], numhits = checkphylogeny(orgrecs,queryorg,querygenus)
@@ -907,12 +1322,11 @@ def startquery(infile=None,refdir=None,td=None,rd=None,hmmdbs=None,rnahmm=None,c
             os.rename(tdir+"astMLST.tree",tdir+"trees/SpeciesMLST.tree")
         if len(glob.glob(os.path.join(tdir,"trees","*.tree"))):
             shutil.make_archive(tdir+"alltrees","zip",tdir+"trees")
-            shutil.rmtree(os.path.join(tdir,"raxml")) #Save disk space
         if len(glob.glob(os.path.join(tdir,"trimmedcore","*.fna"))):
             shutil.make_archive(tdir+"aligned_core_genes","zip",tdir+"alignedcore")
             shutil.rmtree(os.path.join(tdir,"alignedcore")) #Save disk space
             shutil.rmtree(os.path.join(tdir,"trimmedcore")) #Save disk space
-        for x in [f for f in os.listdir(tdir) if f.startswith("queryseqs") or f.startswith("domrslt") or f.endswith(".hmm")]:
+        for x in [f for f in os.listdir(tdir) if f.startswith("queryseqs") or f.startswith("domrslt") or f.endswith(".hmm") or f == BATCHSTATE]:
             os.remove(os.path.join(tdir,x)) #Save disk space
     except Exception as e:
         log.error("Problem with export")
@@ -993,6 +1407,112 @@ def write_paths_to_file(result_dict,maindir):
         path_file.write(result_path + "\t" + input + "\n")
     path_file.close()
 
+def batchphylogeny(states, bdir, mcpu=1, astjar=False, keepalign=False, fullsptree=False):
+    """Align and place the queries of all batch jobs together per core gene and build one species tree with all queries.
+    Each job gets its own gene trees and the species tree with the other queries pruned, or its query inserted into
+    the reference species tree if there is one. Returns {tdir:species tree}"""
+    orgs = {}
+    for s in states:
+        orgs.setdefault(s["queryorg"],[]).append(s["tdir"])
+    jobs = []
+    for s in states:
+        if not (s["refdir"] and "phyl" in s["options"].lower() and len(s["rslt"].get("singles",[]))) or s["prebuilttrees"]:
+            continue
+        if len(orgs[s["queryorg"]]) > 1:
+            #leaves are named by organism, queries of the same name cannot share a tree
+            log.warning("Batch: organism %s is used by more than one query, building its phylogeny separately"%s["queryorg"])
+            continue
+        jobs.append(s)
+    if len(jobs) < 2:
+        return {}
+    refdir = jobs[0]["refdir"]
+    for d in ("coregenes","trees","alignedcore","trimmedcore"):
+        if not os.path.exists(bdir+d):
+            os.mkdir(bdir+d)
+    #queries of each gene grouped by the job they are written back to, bdir collects the single copy queries for the species tree
+    groups = {}
+    for s in jobs:
+        singles = set(x+".fna" for x in s["rslt"]["singles"])|set(["RNA_16S_rRNA.fna"])
+        for fname in genetreefiles(s["tdir"]):
+            names = readseqs(s["tdir"]+"coregenes/"+fname)[0]
+            if not names:
+                continue
+            with open(s["tdir"]+"coregenes/"+fname,"r") as fil, open(bdir+"coregenes/"+fname,"a") as ofil:
+                shutil.copyfileobj(fil,ofil)
+            groups.setdefault(fname,{})[s["tdir"]] = names
+            if fname in singles:
+                groups[fname].setdefault(bdir,[]).extend(names)
+    log.info("Batch: building %s gene trees for %s queries"%(len(groups),len(jobs)))
+    scheduletrees(refdir,bdir,sorted(groups),mcpu,keepalign=keepalign,groups=groups)
+    if not fullsptree and os.path.isfile(refdir+sptreeplace.REFSPTREE):
+        result = {}
+        for s in jobs:
+            sptree = insertsptree(refdir,sptreefiles(s["tdir"],s["rslt"]["singles"]),s["tdir"],s["queryorg"])
+            if sptree:
+                result[s["tdir"]] = sptree
+        return result
+    tlist = [bdir+"trees/%s.tree"%os.path.splitext(x)[0] for x in sorted(groups) if bdir in groups[x]]
+    sptree = makesptree(tlist,bdir,astjar=astjar)
+    if not sptree or not os.path.isfile(sptree):
+        log.error("Batch: no shared species tree, queries build their own")
+        return {}
+    with open(sptree,"r") as fil:
+        sptext = fil.readline()
+    result = {}
+    for s in jobs:
+        others = set(x["queryorg"] for x in jobs if x is not s)
+        with open(s["tdir"]+"astMLST.tree","w") as ofil:
+            ofil.write(placement.writenewick(placement.prune(placement.parsenewick(sptext),others))+"\n")
+        result[s["tdir"]] = s["tdir"]+"astMLST.tree"
+    return result
+
+def runprocs(tasks, nworkers=1):
+    """Run (function, kwargs) tasks in at most nworkers processes. Not daemonic so jobs can start their own pools"""
+    running = []
+    for func,kwargs in tasks:
+        while len(running) >= nworkers:
+            wait([x.sentinel for x in running])
+            running = [x for x in running if x.is_alive()]
+        proc = mp.Process(target=func,kwargs=kwargs)
+        proc.start()
+        running.append(proc)
+    for x in running:
+        x.join()
+
+def runbatch(jobs, kwargs, maindir, mcpu=1):
+    """Run jobs [(resultdir,input)] with per genome stages in parallel, one shared phylogeny and per genome comparisons"""
+    global log
+    log = setlog.init(os.path.join(maindir,"batch.log"),toconsole=True)
+    try:
+        mcpu = int(mcpu)
+    except ValueError:
+        mcpu = mp.cpu_count()
+    nworkers = max(1,min(len(jobs),mcpu))
+    wcpu = max(1,mcpu//nworkers)
+    combined_log.info("Batch: %s jobs in %s workers, %s cpus each"%(len(jobs),nworkers,wcpu))
+    runprocs([(startquery,dict(kwargs,infile=x,rd=d,mcpu=wcpu,batch=True)) for d,x in jobs],nworkers)
+    states = []
+    for d,x in jobs:
+        if os.path.isfile(os.path.join(d,BATCHSTATE)):
+            with open(os.path.join(d,BATCHSTATE),"rb") as fil:
+                states.append(pickle.load(fil))
+        else:
+            combined_log.error("Batch: %s failed before phylogeny (%s)"%(x,d))
+    combined_log.info("Batch: building shared phylogeny")
+    bdir = tempfile.mkdtemp(prefix="arts-batch-",dir=maindir)+"/"
+    try:
+        sptrees = batchphylogeny(states,bdir,mcpu,kwargs.get("astjar"),kwargs.get("keepalign"),kwargs.get("fullsptree"))
+        if os.path.isfile(bdir+"astMLST.tree"):
+            shutil.copyfile(bdir+"astMLST.tree",os.path.join(maindir,"batch_SpeciesMLST.tree"))
+    except Exception as e:
+        log.error("Batch: shared phylogeny failed, queries build their own (%s)"%e)
+        log.exception("exception")
+        sptrees = {}
+    finally:
+        shutil.rmtree(bdir,ignore_errors=True)
+    combined_log.info("Batch: finishing %s jobs"%len(states))
+    runprocs([(finishquery,{"state":s,"sptree":sptrees.get(s["tdir"])}) for s in states],nworkers)
+
 def call_startquery(args):
     #parse input function expects a string of comma seperated organisms as in "org1,org2,org3" or if its just one organism "org1"
     input_list = parse_input_orgs(args.input)
@@ -1012,22 +1532,23 @@ def call_startquery(args):
 
     global combined_log
     combined_log = setlog.init(os.path.join(main_dir, "combined.log",), toconsole=True, logname="combinedlog")
+    #startquery options shared by all inputs
+    kwargs = dict(refdir=args.refdir, td=args.tempdir, hmmdbs=args.hmmdblist, rnahmm=args.rnahmmdb, cut=args.thresh,
+                  astjar=args.astral, toconsole=True, asrun=args.runantismash, knownhmms=args.knownhmms, dufhmms=args.dufhmms,
+                  custcorehmms=args.custcorehmms, custhmms=args.customhmms, aspath=args.antismashpath,
+                  options=args.options, custorgname=args.orgname, prebuilttrees=args.prebuilttrees,
+                  bcp=args.bigscapepath, run_bsc=args.runbigscape, hmmcache=args.hmmcache, stagecache=args.stagecache, keepalign=args.keepalign,
+                  fullsptree=args.fullsptree)
 
     if len(input_list) == 1:
         if os.path.exists(os.path.join(main_dir, "combined.log")) ==True:
             os.remove(os.path.join(main_dir, "combined.log"))
         #if only one input call artspipeline once
         #run_bsc and bigscape path must be added to front end part since it will give argument errors otherwise
-        startquery(infile=args.input, refdir=args.refdir, td=args.tempdir, rd=args.resultdir, hmmdbs=args.hmmdblist,
-                   rnahmm=args.rnahmmdb, cut=args.thresh,
-                   astjar=args.astral, toconsole=True, mcpu=args.multicpu, asrun=args.runantismash,
-                   knownhmms=args.knownhmms, dufhmms=args.dufhmms,
-                   custcorehmms=args.custcorehmms, custhmms=args.customhmms, aspath=args.antismashpath,
-                   options=args.options, custorgname=args.orgname, prebuilttrees=args.prebuilttrees,
-                   bcp = args.bigscapepath, run_bsc = args.runbigscape)
+        startquery(infile=args.input, rd=args.resultdir, mcpu=args.multicpu, **kwargs)
     else:
+        jobs = []
         for input in input_list:
-            start_query_count += 1
             resultdir = os.path.join(main_dir, os.path.basename(args.resultdir) + "_" + str(tdir_increment))
             if os.path.exists(resultdir) != True:
                 os.mkdir(resultdir)
@@ -1037,15 +1558,17 @@ def call_startquery(args):
             result_directories.append(resultdir)
             result_dict[resultdir] = input
             tdir_increment += 1
-            combined_log.info("artspipeline number " + str(start_query_count) + " start")
-            startquery(infile=input, refdir=args.refdir, td=args.tempdir, rd=resultdir, hmmdbs=args.hmmdblist,
-                       rnahmm=args.rnahmmdb, cut=args.thresh,
-                       astjar=args.astral, toconsole=True, mcpu=args.multicpu, asrun=args.runantismash,
-                       knownhmms=args.knownhmms, dufhmms=args.dufhmms,
-                       custcorehmms=args.custcorehmms, custhmms=args.customhmms, aspath=args.antismashpath,
-                       options=args.options, custorgname=args.orgname, prebuilttrees=args.prebuilttrees,
-                       bcp=args.bigscapepath, run_bsc = args.runbigscape)
-            combined_log.info("artspipeline number " + str(start_query_count) + " end")
+            jobs.append((resultdir,input))
+        if args.batch:
+            combined_log.info("artspipeline batch of %s start"%len(jobs))
+            runbatch(jobs, kwargs, main_dir, args.multicpu)
+            combined_log.info("artspipeline batch end")
+        else:
+            for resultdir,input in jobs:
+                start_query_count += 1
+                combined_log.info("artspipeline number " + str(start_query_count) + " start")
+                startquery(infile=input, rd=resultdir, mcpu=args.multicpu, **kwargs)
+                combined_log.info("artspipeline number " + str(start_query_count) + " end")
         run_bsc = args.runbigscape
         combined_log.info("Run bigscape: %s %s"%(run_bsc,args.bigscapepath))
         if run_bsc:
@@ -1094,6 +1617,11 @@ if __name__ == '__main__':
     parser.add_argument("-asp", "--antismashpath", help="location of antismash 'run_antismash.py' script", default=False)
     parser.add_argument("-bcp", "--bigscapepath", help="location of bigscape 'bigscape.py' script", default=False)
     parser.add_argument("-rbsc", "--runbigscape",help="Run antismash results through bigscape", action='store_true', default=False )
+    parser.add_argument("-hc", "--hmmcache", help="Directory to cache merged and pressed hmm models between jobs (default: $ARTS_HMMCACHE or disabled)", default=None)
+    parser.add_argument("-sc", "--stagecache", help="Directory to reuse stage results of jobs with identical inputs (default: $ARTS_STAGECACHE or disabled)", default=None)
+    parser.add_argument("-ka", "--keepalign", help="Keep aligned and trimmed core gene alignments in results (default: False)", action='store_true', default=False)
+    parser.add_argument("-fs", "--fullsptree", help="Rebuild species tree with ASTRAL instead of inserting the query into the reference species tree (default: False)", action='store_true', default=False)
+    parser.add_argument("-b", "--batch", help="Run multiple inputs in parallel and build their phylogeny together (default: False)", action='store_true', default=False)
     args = parser.parse_args()
     call_startquery(args)
     # startquery(infile=args.input,refdir=args.refdir,td=args.tempdir,rd=args.resultdir,hmmdbs=args.hmmdblist,rnahmm=args.rnahmmdb,cut=args.thresh,
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+
+import argparse, os, re, json, socket, socketserver, subprocess, tempfile, shutil, time, zipfile, setlog
+from threading import Thread, Lock
+
+global log
+log = setlog.init(toconsole=True)
+
+#clients find a running service through this variable
+SOCKETENV = "ARTS_ASTRAL_SOCKET"
+HEAP = "3000M"
+
+#Runs ASTRAL's main class once per request line "input<TAB>output<TAB>log" and answers "OK" or "ERR ...".
+#The jar is loaded once and its main method kept for the life of the JVM. Calls to System.exit in the jar are
+#redirected to AstralWorker.Exit.exit when its classes are loaded, so an ASTRAL error ends the job and not the JVM.
+#ASTRAL's taxon names in GlobalMaps are reset before each job so runs do not see taxa of earlier inputs
+WORKER = r"""
+import java.io.*;
+import java.lang.reflect.*;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+
+public class AstralWorker {
+    //thrown in place of System.exit, an Error so that catch (Exception) in ASTRAL does not swallow it
+    public static class Exit extends Error {
+        public final int status;
+        public Exit(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+        public static void exit(int status) {
+            throw new Exit(status);
+        }
+    }
+
+    static class Loader extends URLClassLoader {
+        Loader(URL[] urls) {
+            super(urls, AstralWorker.class.getClassLoader());
+        }
+        protected Class<?> findClass(String name) throws ClassNotFoundException {
+            try (InputStream in = getResourceAsStream(name.replace('.', '/') + ".class")) {
+                if (in == null) {
+                    throw new ClassNotFoundException(name);
+                }
+                ByteArrayOutputStream buf = new ByteArrayOutputStream();
+                byte[] chunk = new byte[8192];
+                for (int n; (n = in.read(chunk)) > 0; ) {
+                    buf.write(chunk, 0, n);
+                }
+                byte[] b = redirectexit(buf.toByteArray());
+                return defineClass(name, b, 0, b.length);
+            } catch (IOException e) {
+                throw new ClassNotFoundException(name, e);
+            }
+        }
+    }
+
+    static int u2(byte[] b, int i) {
+        return ((b[i] & 0xff) << 8) | (b[i + 1] & 0xff);
+    }
+
+    //point the class of java/lang/System.exit(I)V method refs in the constant pool to AstralWorker$Exit
+    static byte[] redirectexit(byte[] b) {
+        int count = u2(b, 8);
+        String[] utf = new String[count];
+        int[] ref = new int[count];
+        int[] pos = new int[count];
+        int i = 10;
+        for (int k = 1; k < count; k++) {
+            int tag = b[i];
+            pos[k] = i;
+            if (tag == 1) {
+                utf[k] = new String(b, i + 3, u2(b, i + 1), StandardCharsets.UTF_8);
+                i += 3 + u2(b, i + 1);
+            } else if (tag == 5 || tag == 6) {
+                i += 9;
+                k++;
+            } else if (tag == 7 || tag == 8 || tag == 16 || tag == 19 || tag == 20) {
+                ref[k] = u2(b, i + 1);
+                i += 3;
+            } else if (tag == 15) {
+                i += 4;
+            } else {
+                ref[k] = u2(b, i + 1);
+                i += 5;
+            }
+        }
+        ByteArrayOutputStream out = new ByteArrayOutputStream();
+        boolean found = false;
+        for (int k = 1; k < count; k++) {
+            if (b[pos[k]] == 10 && "java/lang/System".equals(utf[ref[ref[k]]])) {
+                int nat = u2(b, pos[k] + 3);
+                if ("exit".equals(utf[ref[nat]]) && "(I)V".equals(utf[u2(b, pos[nat] + 3)])) {
+                    b[pos[k] + 1] = (byte) ((count + 1) >> 8);
+                    b[pos[k] + 2] = (byte) (count + 1);
+                    found = true;
+                }
+            }
+        }
+        if (!found) {
+            return b;
+        }
+        byte[] name = Exit.class.getName().replace('.', '/').getBytes(StandardCharsets.UTF_8);
+        out.write(b, 0, 8);
+        out.write((count + 2) >> 8);
+        out.write(count + 2);
+        out.write(b, 10, i - 10);
+        out.write(1);
+        out.write(name.length >> 8);
+        out.write(name.length);
+        out.write(name, 0, name.length);
+        out.write(7);
+        out.write(count >> 8);
+        out.write(count);
+        out.write(b, i, b.length - i);
+        return out.toByteArray();
+    }
+
+    static void reset(ClassLoader loader) {
+        try {
+            Field taxa = Class.forName("phylonet.coalescent.GlobalMaps", true, loader).getField("taxonIdentifier");
+            Constructor<?> fresh = taxa.getType().getDeclaredConstructor();
+            fresh.setAccessible(true);
+            taxa.set(null, fresh.newInstance());
+        } catch (ReflectiveOperationException e) {
+            //not an ASTRAL version with GlobalMaps
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        Loader loader = new Loader(new URL[] {new File(args[0]).toURI().toURL()});
+        Thread.currentThread().setContextClassLoader(loader);
+        Method astral = Class.forName(args[1], true, loader).getMethod("main", String[].class);
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] job = line.split("\t");
+            String status = "OK";
+            try (PrintStream log = new PrintStream(new FileOutputStream(job[2]))) {
+                System.setOut(log);
+                System.setErr(log);
+                reset(loader);
+                astral.invoke(null, (Object) new String[] {"-i", job[0], "-o", job[1], "-t", "0"});
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                if (!(cause instanceof Exit) || ((Exit) cause).status != 0) {
+                    status = "ERR " + cause;
+                }
+            } catch (Throwable e) {
+                status = "ERR " + e;
+            } finally {
+                System.setOut(out);
+                System.setErr(err);
+            }
+            out.println(status.replace("\n", " "));
+            out.flush();
+        }
+    }
+}
+"""
+
+def javaversion(java="java"):
+    """Major version of java (8 for 1.8), 0 if it does not run"""
+    try:
+        text = subprocess.run([java,"-version"],stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True).stdout
+    except OSError:
+        return 0
+    m = re.search(r'version "(\d+)(?:\.(\d+))?',text)
+    if not m:
+        return 0
+    return int(m.group(2) or 0) if m.group(1) == "1" else int(m.group(1))
+
+def mainclass(astjar):
+    """Main-Class of the ASTRAL jar manifest"""
+    with zipfile.ZipFile(astjar) as z:
+        for line in z.read("META-INF/MANIFEST.MF").decode().splitlines():
+            if line.startswith("Main-Class:"):
+                return line.split(":",1)[1].strip()
+    return "phylonet.coalescent.CommandLine"
+
+class AstralService(object):
+    """Long running ASTRAL JVM behind a unix socket. Jobs in any process send their input, output and log files
+    and are run one at a time, the JVM is restarted if it exits"""
+    def __init__(self, astjar, sockpath=None, heap=None):
+        self.astjar = os.path.realpath(astjar)
+        self.sockpath = sockpath or os.getenv(SOCKETENV) or os.path.join(tempfile.gettempdir(),"arts-astral-%s.sock"%os.getpid())
+        self.heap = heap or os.getenv("ARTS_ASTRAL_HEAP",HEAP)
+        self.proc = None
+        self.server = None
+        self.workdir = tempfile.mkdtemp(prefix="arts-astral-")
+        self.lock = Lock()
+
+    def startworker(self):
+        if not os.path.isfile(os.path.join(self.workdir,"AstralWorker.java")):
+            with open(os.path.join(self.workdir,"AstralWorker.java"),"w") as ofil:
+                ofil.write(WORKER)
+        #single file source launch (java 11+ with jdk.compiler). The jar is not on the classpath, the worker loads it itself
+        cmd = ["java","-Xmx%s"%self.heap,os.path.join(self.workdir,"AstralWorker.java"),self.astjar,mainclass(self.astjar)]
+        self.proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,universal_newlines=True,bufsize=1)
+        log.info("AstralService: started JVM (pid %s, heap %s)"%(self.proc.pid,self.heap))
+
+    def run(self, infile, outfile, logfile):
+        """Species tree of gene trees in infile. Returns True if outfile was written"""
+        with self.lock:
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    self.startworker()
+                self.proc.stdin.write("%s\t%s\t%s\n"%(infile,outfile,logfile))
+                self.proc.stdin.flush()
+                status = self.proc.stdout.readline().strip()
+            except (IOError,OSError) as e:
+                status = "ERR %s"%e
+            if not status and self.proc:
+                #JVM exited during the job (e.g. System.exit in ASTRAL), the next job starts a new one
+                self.proc.wait()
+                self.proc = None
+            if status != "OK":
+                log.warning("AstralService: failed %s (%s)"%(infile,status or "JVM exited"))
+                return False
+            return os.path.isfile(outfile)
+
+    def warmup(self):
+        """Run a small input so the first job does not pay for JVM startup and JIT of the java runtime"""
+        fname = os.path.join(self.workdir,"warmup")
+        with open(fname+".nwk","w") as ofil:
+            ofil.write("((A,B),(C,D),E);\n((A,C),(B,D),E);\n((A,B),(C,E),D);\n")
+        return self.run(fname+".nwk",fname+".tree",fname+".log")
+
+    def start(self):
+        """Start JVM and socket server thread, sets $ARTS_ASTRAL_SOCKET for this process and its children.
+        Without java 11+ or if the JVM does not start no server is started and jobs run java as a subprocess"""
+        version = javaversion()
+        if version < 11:
+            log.warning("AstralService: needs java 11 or newer (found %s), jobs fall back to java subprocess"%(version or "none"))
+            return self
+        try:
+            ok = self.warmup()
+        except OSError as e:
+            log.warning("AstralService: could not start JVM (%s), jobs fall back to java subprocess"%e)
+            return self
+        if not ok:
+            log.warning("AstralService: warmup job failed, jobs fall back to java subprocess")
+            return self
+        if os.path.exists(self.sockpath):
+            os.remove(self.sockpath)
+        service = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    req = json.loads(self.rfile.readline().decode())
+                    ok = req.get("jar") == service.astjar and service.run(req["input"],req["output"],req["log"])
+                except (ValueError,KeyError) as e:
+                    log.warning("AstralService: bad request (%s)"%e)
+                    ok = False
+                self.wfile.write((json.dumps({"ok":bool(ok)})+"\n").encode())
+        self.server = socketserver.ThreadingUnixStreamServer(self.sockpath,Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever,daemon=True).start()
+        os.environ[SOCKETENV] = self.sockpath
+        log.info("AstralService: listening on %s"%self.sockpath)
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if os.getenv(SOCKETENV) == self.sockpath:
+            del os.environ[SOCKETENV]
+        if os.path.exists(self.sockpath):
+            os.remove(self.sockpath)
+        if self.proc and self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        shutil.rmtree(self.workdir,ignore_errors=True)
+
+def runastral(infile, outfile, logfile, astjar, sockpath=None):
+    """Species tree through a running service ($ARTS_ASTRAL_SOCKET). Returns False if there is none or it failed"""
+    sockpath = sockpath or os.getenv(SOCKETENV)
+    if not sockpath or not os.path.exists(sockpath):
+        return False
+    req = {"jar":os.path.realpath(astjar),"input":os.path.realpath(infile),"output":os.path.realpath(outfile),"log":os.path.realpath(logfile)}
+    try:
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.connect(sockpath)
+        with sock, sock.makefile("rwb") as fil:
+            fil.write((json.dumps(req)+"\n").encode())
+            fil.flush()
+            reply = json.loads(fil.readline().decode())
+    except (IOError,OSError,ValueError) as e:
+        log.warning("AstralService: not available at %s (%s)"%(sockpath,e))
+        return False
+    return bool(reply.get("ok")) and os.path.isfile(outfile)
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Run a persistent ASTRAL JVM that ARTS jobs use through a unix socket""")
+    parser.add_argument("astjar", help="ASTRAL jar file")
+    parser.add_argument("-s", "--socket", help="Socket path, set $ARTS_ASTRAL_SOCKET to this for jobs (default: $ARTS_ASTRAL_SOCKET or tmp/arts-astral-<pid>.sock)", default=None)
+    parser.add_argument("-mx", "--heap", help="Java heap size (default: $ARTS_ASTRAL_HEAP or 3000M)", default=None)
+    args = parser.parse_args()
+    service = AstralService(args.astjar,args.socket,args.heap).start()
+    if not service.server:
+        service.stop()
+        raise SystemExit(1)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, re, subprocess, setlog, numpy as np
+
+global log
+log = setlog.init(toconsole=True)
+
+#In-process port of 'trimal -automated1' (trimAl v2.0, Capella-Gutierrez et al. 2009)
+#Kept columns match the trimal binary, artspipeline1 falls back to the binary on alignments it rejects
+GAP = ord("-")
+#trimAl default similarity matrices: BLOSUM62 for aa and identity for nucleotides
+AASYMBOLS = "ARNDCQEGHILKMFPSTWYV"
+BLOSUM62 = [[4,-1,-2,-2,0,-1,-1,0,-2,-1,-1,-1,-1,-2,-1,1,0,-3,-2,0],
+            [-1,5,0,-2,-3,1,0,-2,0,-3,-2,2,-1,-3,-2,-1,-1,-3,-2,-3],
+            [-2,0,6,1,-3,0,0,0,1,-3,-3,0,-2,-3,-2,1,0,-4,-2,-3],
+            [-2,-2,1,6,-3,0,2,-1,-1,-3,-4,-1,-3,-3,-1,0,-1,-4,-3,-3],
+            [0,-3,-3,-3,9,-3,-4,-3,-3,-1,-1,-3,-1,-2,-3,-1,-1,-2,-2,-1],
+            [-1,1,0,0,-3,5,2,-2,0,-3,-2,1,0,-3,-1,0,-1,-2,-1,-2],
+            [-1,0,0,2,-4,2,5,-2,0,-3,-3,1,-2,-3,-1,0,-1,-3,-2,-2],
+            [0,-2,0,-1,-3,-2,-2,6,-2,-4,-4,-2,-3,-3,-2,0,-2,-2,-3,-3],
+            [-2,0,1,-1,-3,0,0,-2,8,-3,-3,-1,-2,-1,-2,-1,-2,-2,2,-3],
+            [-1,-3,-3,-3,-1,-3,-3,-4,-3,4,2,-3,1,0,-3,-2,-1,-3,-1,3],
+            [-1,-2,-3,-4,-1,-2,-3,-4,-3,2,4,-2,2,0,-3,-2,-1,-2,-1,1],
+            [-1,2,0,-1,-3,1,1,-2,-1,-3,-2,5,-1,-3,-1,0,-1,-3,-2,-2],
+            [-1,-1,-2,-3,-1,0,-2,-3,-2,1,2,-1,5,0,-2,-1,-1,-1,-1,1],
+            [-2,-3,-3,-3,-2,-3,-3,-3,-1,0,0,-3,0,6,-4,-2,-2,1,3,-1],
+            [-1,-2,-2,-1,-3,-1,-1,-2,-2,-3,-3,-1,-2,-4,7,-1,-1,-4,-3,-2],
+            [1,-1,1,0,-1,0,0,0,-1,-2,-2,0,-1,-2,-1,4,1,-3,-2,-2],
+            [0,-1,0,-1,-1,-1,-1,-2,-2,-1,-1,-1,-1,-2,-1,1,5,-2,-2,0],
+            [-3,-3,-4,-4,-2,-2,-3,-2,-2,-3,-2,-3,-1,1,-4,-3,-2,11,2,-3],
+            [-2,-2,-2,-3,-2,-1,-2,-3,2,-1,-1,-2,-1,3,-3,-2,-2,2,7,-1],
+            [0,-3,-3,-3,-1,-2,-2,-3,-3,3,1,-2,1,-1,-2,-2,0,-3,-1,4]]
+NTSYMBOLS = "ACGTU"
+#degenerate codes share 1/4 (two bases) or 1/6 (three bases) with their bases
+NTCODES = [("R","AG"),("Y","CTU"),("K","GTU"),("M","AC"),("S","CG"),("W","ATU"),("B","CGTU"),("D","AGTU"),("H","ACTU"),("V","ACG")]
+
+def readfasta(text):
+    """Names (up to the first space, comma or colon as trimal reads them) and sequences from fasta text"""
+    names = []
+    seqs = []
+    for line in text.splitlines():
+        if line.startswith(">"):
+            names.append(re.split(r"[ \t,:]",line[1:].strip())[0])
+            seqs.append([])
+        elif seqs:
+            seqs[-1].append("".join(line.split()))
+    return names,["".join(x) for x in seqs]
+
+def tomatrix(seqs):
+    """Alignment as (sequences x columns) uint8 matrix"""
+    if len(set(len(x) for x in seqs)) > 1:
+        raise ValueError("Sequences are not aligned")
+    return np.frombuffer("".join(seqs).encode("ascii"),dtype=np.uint8).reshape(len(seqs),-1)
+
+def seqtype(aln):
+    """'aa', 'nt' or 'ntdeg' as trimAl checkAlignmentType, sequences with any N count as aa"""
+    counts = np.bincount(aln.ravel(),minlength=256)
+    counts[ord("A"):ord("Z")+1] += counts[ord("a"):ord("z")+1]
+    count = lambda x: int(sum(counts[ord(c)] for c in x))
+    known = set("ACGTURYKMSWBDHV"+AASYMBOLS+"BJXZ*O-?.")
+    unknown = [chr(i) for i in np.flatnonzero(counts) if not chr(i).islower() and chr(i) not in known]
+    if unknown:
+        raise ValueError("Undefined alignment symbols %s"%",".join(unknown))
+    deg = count("RYKMSWBDHV")
+    dna = count("ACGT")+deg
+    rna = count("ACGU")+deg
+    aa = count(AASYMBOLS)+count("BJXZ*")+count("UO")
+    if aa > dna and aa > rna:
+        return "aa"
+    return "ntdeg" if deg else "nt"
+
+def distances(kind):
+    """Symbols and euclidean distances between columns of the similarity matrix"""
+    if kind == "aa":
+        symbols = AASYMBOLS
+        sim = np.array(BLOSUM62,dtype=np.float32)
+    else:
+        symbols = NTSYMBOLS+("".join(x for x,y in NTCODES) if kind == "ntdeg" else "")
+        sim = np.identity(len(symbols),dtype=np.float32)
+        for code,bases in NTCODES[:len(symbols)-len(NTSYMBOLS)]:
+            row = symbols.index(code)
+            w = np.float32(1/4. if len(bases.replace("U",""))==2 else 1/6.)
+            sim[row,row] = w
+            for x in bases:
+                sim[row,symbols.index(x)] = w
+    #float sums in the order trimAl adds them
+    sq = (sim[:,:,None]-sim[:,None,:])**2
+    dist = np.sqrt(np.cumsum(sq,axis=0,dtype=np.float32)[-1].astype(np.float64)).astype(np.float32)
+    return [ord(x) for x in symbols],dist
+
+def identities(aln, indet):
+    """Pairwise identity over columns where either sequence has a residue (case sensitive as trimAl)"""
+    empty = ((aln==GAP)|(aln==indet)).astype(np.float32)
+    #integer counts are exact in float
+    dst = aln.shape[1]-np.dot(empty,empty.T)
+    hit = np.zeros(dst.shape,dtype=np.float32)
+    for x in np.flatnonzero(np.bincount(aln.ravel(),minlength=256)):
+        if x not in (GAP,indet):
+            m = (aln==x).astype(np.float32)
+            hit += np.dot(m,m.T)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return np.where(dst>0,hit/dst,0).astype(np.float32)
+
+def selectmethod(ident):
+    """gappyout or strict based on sequence identities (trimAl selectMethod)"""
+    nseqs = len(ident)
+    if nseqs < 2:
+        return "gappyout"
+    ident = ident.copy()
+    np.fill_diagonal(ident,0)
+    avg = np.cumsum(ident,axis=1,dtype=np.float32)[:,-1]/np.float32(nseqs-1)
+    avgseq = float(np.cumsum(avg,dtype=np.float32)[-1]/np.float32(nseqs))
+    maxseq = float(np.cumsum(ident.max(axis=1),dtype=np.float32)[-1]/np.float32(nseqs))
+    if avgseq >= 0.55:
+        return "gappyout"
+    elif avgseq <= 0.38:
+        return "strict"
+    elif nseqs <= 20:
+        return "gappyout"
+    elif maxseq >= 0.5 and maxseq <= 0.65:
+        return "gappyout"
+    return "strict"
+
+def gapcutpoint(gaps, nseqs):
+    """Number of gaps per column above which columns are removed (trimAl calcCutPoint2ndSlope)"""
+    hist = np.bincount(gaps)
+    ncols = np.float32(len(gaps))
+    nseqs = np.float32(nseqs)
+    maxiter = len(hist)
+    second = [np.float32(-1)]*maxiter
+    maxslope = np.float32(-1)
+    cut = 0
+    while hist[cut] == 0:
+        cut += 1
+    act = 0
+    while act < maxiter:
+        while hist[act] == 0:
+            act += 1
+        pprev = act
+        if act+1 >= maxiter:
+            break
+        act += 1
+        while hist[act] == 0:
+            act += 1
+        prev = act
+        if act+1 >= maxiter:
+            break
+        act += 1
+        while hist[act] == 0:
+            act += 1
+        second[act] = (np.float32(act-pprev)/nseqs)/(np.float32(hist[act]+hist[prev])/ncols)
+        if second[pprev] != -1:
+            if second[act]/second[pprev] > maxslope:
+                maxslope = second[act]/second[pprev]
+                cut = pprev
+        elif second[prev] != -1:
+            if second[act]/second[prev] > maxslope:
+                maxslope = second[act]/second[prev]
+                cut = pprev
+        act = prev
+    return cut
+
+def similarity(aln, ident, kind):
+    """Bounds of the mean distance conservation score (trimAl MDK) of each column and a function for exact scores"""
+    nseqs,ncols = aln.shape
+    symbols,dist = distances(kind)
+    #symbol index of each residue (any case), -1 for gaps and indeterminations, -2 for symbols not in the matrix
+    table = np.full(256,-2,dtype=np.int16)
+    table[symbols] = table[[x+32 for x in symbols]] = np.arange(len(symbols))
+    indet = ord("X" if kind == "aa" else "N")
+    table[[GAP,indet,indet+32]] = -1
+    idx = table[aln]
+    #trimAl compares column gaps to 80% of the columns (not sequences), these columns score 0
+    used = np.sum(aln==GAP,axis=0) < np.float32(0.8)*np.float32(ncols)
+    bad = np.any(idx==-2,axis=0)&used
+    if np.any(bad):
+        raise ValueError("Undefined symbol in column %s"%(np.flatnonzero(bad)[0]+1))
+    valid = (idx>=0)&used
+    idx[~valid] = 0
+    weights = np.float32(1)-ident
+    first,second = np.triu_indices(nseqs,1)
+    pairweights = weights[first,second][:,None]
+
+    def exact(cols):
+        #float sums over sequence pairs in trimAl order, numpy adds rows one by one along axis 0 (of 2 or more columns)
+        mdk = np.zeros(len(cols),dtype=np.float32)
+        step = max(2,2**22//max(1,len(first)))
+        for i in range(0,len(cols),step):
+            part = np.append(cols[i:i+step],cols[i:i+step][:1])
+            colvalid = valid[:,part]
+            colidx = idx[:,part]
+            pairs = colvalid[first]&colvalid[second]
+            code = (colidx*np.int16(len(dist)))[first]+colidx[second]
+            num = np.sum(pairweights*dist.ravel().take(code)*pairs,axis=0,dtype=np.float32)
+            den = np.sum(pairweights*pairs,axis=0,dtype=np.float32)
+            with np.errstate(divide="ignore",invalid="ignore"):
+                mdk[i:i+step] = np.where(den!=0,np.exp(-(num/den).astype(np.float64)),0)[:-1]
+        return mdk
+
+    #same sums from weighted residue counts, each pair is counted twice
+    np.fill_diagonal(weights,0)
+    present = np.flatnonzero(np.bincount(idx[valid],minlength=len(symbols)))
+    if not len(present):
+        return np.zeros(ncols),np.zeros(ncols),exact
+    onehot = np.stack([valid&(idx==t) for t in present],axis=2).astype(np.float32)
+    weighted = np.dot(weights,onehot.reshape(nseqs,-1)).reshape(onehot.shape)
+    den = np.sum(np.where(valid,np.dot(weights,valid.astype(np.float32)),0),axis=0)/2
+    #distance from the residue of each sequence to the weighted residues of the others
+    paired = np.dot(weighted.reshape(-1,len(present)),dist[np.ix_(present,present)].T).reshape(onehot.shape)
+    num = np.einsum("jcs,jcs->c",onehot,paired)/2
+    #float sums of n positive terms are within n*2^-24 of the exact sum, for these sums and for trimAl's
+    eps = 2.0**-24
+    count = np.sum(valid,axis=0)
+    nterms = count*(count-1)/2.0+nseqs*(len(present)+2)+len(present)+8
+    with np.errstate(divide="ignore",invalid="ignore"):
+        q = np.where(den>0,num.astype(np.float64)/den,0)
+        gamma = np.where(nterms*eps<0.5,nterms*eps/(1-nterms*eps),np.inf)
+        err = q*(2.05*gamma+2*eps)+3*eps
+        low = np.where(den>0,np.exp(-q-err),0)
+        high = np.where(den>0,np.exp(-q+err),0)
+    return low,high,exact
+
+def strictcolumns(gaps, gapcut, low, high, exact):
+    """Columns kept by trimAl -strict, exact scores are only computed where the bounds are not decisive"""
+    ncols = len(gaps)
+    known = np.zeros(ncols,dtype=bool)
+    def refine(cols):
+        cols = cols[~known[cols]]
+        if len(cols):
+            low[cols] = high[cols] = exact(cols)
+            known[cols] = True
+    cols = np.flatnonzero(gaps<=gapcut)
+    first20 = last80 = np.float32(0)
+    if len(cols):
+        j = np.arange(1,len(cols)+1)
+        pct = (j.astype(np.float32)/np.float32(len(cols))).astype(np.float64)*100.0
+        #r-th smallest score lies between the r-th smallest bounds, columns in that range get exact scores
+        points = {}
+        for x in (20.0,80.0):
+            if np.any(pct<=x):
+                r = len(cols)-j[pct<=x][-1]
+                lo,hi = np.sort(low[cols])[r],np.sort(high[cols])[r]
+                points[x] = (r,cols[(high[cols]>=lo)&(low[cols]<=hi)],np.sum(high[cols]<lo))
+        if points:
+            refine(np.unique(np.concatenate([x[1] for x in points.values()])))
+        values = dict((x,np.float32(np.sort(low[near])[r-below])) for x,(r,near,below) in points.items())
+        first20,last80 = values.get(20.0,first20),values.get(80.0,last80)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        inic,fin = np.log10(np.float64(first20)),np.log10(np.float64(last80))
+        simcut = np.float32(np.power(10.0,((inic-fin)/10)+fin))
+    refine(np.flatnonzero((low<simcut)&(high>=simcut)))
+    rej = [bool(x) for x in (gaps>gapcut)|(low<simcut)]
+    keep = [not x for x in rej]
+    def rescue(i, near, most):
+        if rej[i]:
+            keep[i] = sum(rej[x] for x in near) <= most
+    #rejected columns are rescued by kept neighbours, judged on the first pass only
+    num = min(ncols,5)
+    if num > 2:
+        rescue(0,(1,2),0)
+        rescue(1,(0,2,3) if num > 3 else (0,2),0)
+        rescue(2,(0,1,3,4) if num > 4 else (0,1,3) if num > 3 else (0,1),1 if num > 4 else 0)
+    if num > 4:
+        for i in range(3,ncols-2):
+            rescue(i,(i-2,i-1,i+1,i+2),1)
+        rescue(ncols-2,(ncols-4,ncols-3,ncols-1),0)
+        rescue(ncols-1,(ncols-3,ncols-2),0)
+    #blocks shorter than 5 columns are removed
+    start = 0
+    for i in range(ncols+1):
+        if i == ncols or not keep[i]:
+            if i-start < 5:
+                keep[start:i] = [False]*(i-start)
+            start = i+1
+    return np.array(keep,dtype=bool)
+
+def automated1(names, seqs):
+    """Trim alignment with the heuristic of trimal -automated1. Returns names, sequences and kept column indices"""
+    aln = tomatrix(seqs)
+    if not aln.size:
+        raise ValueError("Empty alignment")
+    kind = seqtype(aln)
+    gaps = np.sum(aln==GAP,axis=0)
+    gapcut = gapcutpoint(gaps,len(aln))
+    ident = identities(aln,ord("X" if kind == "aa" else "N"))
+    method = selectmethod(ident)
+    if method == "gappyout":
+        keep = gaps <= gapcut
+    else:
+        keep = strictcolumns(gaps,gapcut,*similarity(aln,ident,kind))
+    #sequences and then columns without residues are removed as trimAl does without -keepseqs
+    rows = np.flatnonzero(np.any((aln!=GAP)&keep,axis=1))
+    if len(rows) < len(names):
+        log.warning("AutoTrim: removed %s sequences composed only by gaps"%(len(names)-len(rows)))
+    cols = np.flatnonzero(keep&np.any(aln[rows]!=GAP,axis=0))
+    if not len(cols):
+        raise ValueError("No columns left after trimming")
+    log.debug("AutoTrim: %s kept %s of %s columns"%(method,len(cols),aln.shape[1]))
+    trimmed = aln[rows][:,cols]
+    return [names[i] for i in rows],[x.tobytes().decode("ascii") for x in trimmed],cols
+
+def writefasta(names, seqs, outfile, width=60):
+    with open(outfile,"w") as ofil:
+        for name,seq in zip(names,seqs):
+            ofil.write(">%s\n%s\n"%(name,"\n".join(seq[i:i+width] for i in range(0,len(seq),width))))
+
+def trimtext(text, outfile):
+    """Trim fasta alignment text (e.g. mafft stdout) and write the trimmed fasta"""
+    names,seqs = readfasta(text)
+    if not names:
+        raise ValueError("No sequences to trim")
+    names,seqs,cols = automated1(names,seqs)
+    writefasta(names,seqs,outfile)
+    return cols
+
+def trimfile(infile, outfile):
+    with open(infile,"r") as fil:
+        return trimtext(fil.read(),outfile)
+
+def trimalcolumns(infile, outfile):
+    """Kept columns reported by the trimal binary, for validation"""
+    out = subprocess.check_output(["trimal","-automated1","-in",infile,"-out",outfile,"-colnumbering"]).decode()
+    return np.array([int(x) for x in out.split("\t",1)[-1].replace(",","").split()],dtype=int)
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Trim alignments as 'trimal -automated1' does""")
+    parser.add_argument("input", help="Input alignment fasta (or comma separated list with --compare)")
+    parser.add_argument("output", help="Output trimmed fasta (or output directory with --compare)")
+    parser.add_argument("-c", "--compare", help="Also run trimal and report differences in kept columns", action='store_true')
+    args = parser.parse_args()
+    if not args.compare:
+        trimfile(args.input,args.output)
+    else:
+        for fname in args.input.split(","):
+            base = os.path.join(args.output,os.path.split(fname)[-1])
+            cols = trimfile(fname,base+".autotrim")
+            tcols = trimalcolumns(fname,base+".trimal")
+            diff = len(set(cols)^set(tcols))
+            print("%s\t%s\t%s\t%s"%(fname,len(cols),len(tcols),"OK" if not diff else "DIFF %s columns"%diff))
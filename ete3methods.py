@@ -14,8 +14,17 @@
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
-import re, os
-from ete3 import Tree, EvolTree
+import re, os, nwktree
+#ete3 is only needed for the compatibility path, mergetrees uses nwktree unless $ARTS_ETE3 is set
+try:
+    from ete3 import Tree, EvolTree
+except ImportError:
+    Tree = EvolTree = None
+
+def useete3():
+    if str(os.getenv("ARTS_ETE3",False)).lower() not in ("1","true","yes"):
+        return False
+    return EvolTree is not None
 
 def maketree(x):
     with open(x,"r") as fil:
@@ -90,6 +99,27 @@ def writetree(T):
 #     T.render(infile+".png", w=width, units="px")
 
 def mergetrees(sptree,tlist,org,outgroup=None):
+    if useete3():
+        return mergetrees_ete3(sptree,tlist,org,outgroup)
+    sptree=nwktree.readtree(sptree)
+    sptree.relabel("SP",outgroup,qorg=org)
+    treedict = {}
+    sptline = sptree.writetree()
+    #species tree lookups for splitdups and rangerdtl
+    spindex = nwktree.TreeIndex(sptree)
+    spset = spindex.leafbyname
+
+    for HKtree in tlist:
+        hk = os.path.splitext(os.path.split(HKtree)[-1])[0] #get from filename
+        temp = nwktree.readtree(HKtree)
+        for gid,x in nwktree.splitdups(temp,org,spset,outgroup).items():
+            pfx=""
+            if not temp.hasroot:
+                pfx="[&U]"
+            treedict[hk+"_@_"+gid] = "%s\n%s%s\n" % (sptline,pfx,x)
+    return (treedict,spindex)
+
+def mergetrees_ete3(sptree,tlist,org,outgroup=None):
     sptree=maketree(sptree)
     sptree=relabeltree(sptree,"SP",outgroup,qorg=org)
     treedict = {}
@@ -106,7 +136,7 @@ def mergetrees(sptree,tlist,org,outgroup=None):
                 pfx="[&U]"
             treedict[hk+"_@_"+gid] = "%s\n%s%s\n" % (sptline,pfx,writetree(x))
             # treedict2[hk+"_@_"+gid] = x
-    return (treedict,sptree)
+    return (treedict,nwktree.TreeIndex(nwktree.NwkTree.fromete(sptree)))
 
 def splitdups2(T,org,sptree,outgroup=None):
     trees={}
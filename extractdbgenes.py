@@ -14,7 +14,9 @@
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
-import os, argparse, ast, setlog, tempfile, json, sqlite3 as sql, numpy as np
+import os, argparse, ast, itertools, setlog, tempfile, json, sqlite3 as sql, numpy as np
+from seqstore import connectdb
+from makehmmsql import checkindexdb
 
 global log
 log = setlog.init(toconsole=True)
@@ -35,9 +37,11 @@ def writeall(outdir, db, pct=0.5, pct2=0.5, ev=0.1, bs=0, bh=True, filt2=None, t
     if not outdir.endswith("/"):
         outdir += "/"
 
-    conn = sql.connect(db)
+    conn, owned = connectdb(db)
+    checkindexdb(conn)
     cur = conn.cursor()
-    hkcore=[str(x[0]) for x in cur.execute("SELECT DISTINCT hmmhit FROM HMMhits")]
+    #models in order of first hit (independent of which index sqlite picks for DISTINCT)
+    hkcore=[str(x[0]) for x in cur.execute("SELECT hmmhit FROM HMMhits GROUP BY hmmhit ORDER BY MIN(rowid)")]
     orgs=[str(x[0]) for x in cur.execute("SELECT DISTINCT orgname FROM HMMhits")]
     orgs = list(orgs)
     oarry = np.zeros((len(hkcore), len(orgs)))
@@ -50,25 +54,31 @@ def writeall(outdir, db, pct=0.5, pct2=0.5, ev=0.1, bs=0, bh=True, filt2=None, t
     if bs:
         addwhere += " AND score>%s"%bs
     # Combine tables into view and write full hits, fragment hits, genematrix
+    cur.execute("DROP VIEW IF EXISTS allgenes")
     cur.execute("CREATE TEMP VIEW allgenes AS SELECT A.*,B.* FROM HMMhits A INNER JOIN Seqs B ON A.seqid=B.seqid WHERE evalue<=%s"%ev + addwhere)
+    #One ordered scan over all models, rows arrive grouped by hmmhit in hkcore order
+    cur.execute("""SELECT g.* FROM (SELECT hmmhit,orgname,seqid,genecov,hmmcov,MAX(iscore),genelen,source,loc_start,loc_end,loc_strand,description,score,naseq,aaseq
+        FROM allgenes GROUP BY hmmhit,seqid) g INNER JOIN (SELECT hmmhit,MIN(rowid) AS rnk FROM HMMhits GROUP BY hmmhit) r ON g.hmmhit=r.hmmhit
+        ORDER BY r.rnk,g.seqid""")
+    modelrows = itertools.groupby(cur, key=lambda x: x[0])
+    group = next(modelrows, (None, ()))
+    orgidx = {org: j for j, org in enumerate(orgs)}
+    hitpos = ([], []) # (model, org) index of each counted seq
     for i, hkgn in enumerate(hkcore):
-        results = cur.execute(
-            "SELECT orgname,seqid,genecov,hmmcov,MAX(iscore),genelen,source,loc_start,loc_end,loc_strand,description,score,naseq,aaseq FROM allgenes WHERE hmmhit=? GROUP BY seqid",
-            (hkgn,)).fetchall()
-        with open(outdir + hkgn + ".faa", "w") as aafil, open(outdir + hkgn + ".fna", "w") as nafil:
-            orgseqs = {} # store here before writing to check for top hit
-            for x in results:
+        orgseqs = {} # store here before writing to check for top hit
+        if group[0] == hkgn:
+            for x in group[1]:
+                x = x[1:]
                 # add to genematrix
-                j = orgs.index(x[0])
+                j = orgidx[x[0]]
                 seqs = (x[-2], x[-1])
                 # separate fragments and full length
                 if filt2 and hkgn in filt2.keys() and float(filt2[hkgn]) > float(x[4]):
                     continue
                 if x[2] >= pct or x[3] >= pct2:
-                    oarry[i, j] += 1
+                    hitpos[0].append(i)
+                    hitpos[1].append(j)
                     seqid = idprfx+str(x[1])
-                    # aafil.write(">%s|%s\n%s\n" % (x[0], seqid, seqs[1]))
-                    # nafil.write(">%s|%s\n%s\n" % (x[0], seqid, seqs[0]))
                     if str(x[0]) not in orgseqs:
                         orgseqs[str(x[0])] = {}
                         orgseqs[str(x[0])]["all"] = []
@@ -82,19 +92,23 @@ def writeall(outdir, db, pct=0.5, pct2=0.5, ev=0.1, bs=0, bh=True, filt2=None, t
                     if seqid not in coredict["seqs"].keys():
                         coredict["seqs"][seqid] = [seqid,hkgn,str(x[6]),x[7],x[8],x[9],x[10],x[11]]
                     coredict["core"][hkgn]["seqs"].append(seqid)
-            #write out stored seqs
-            for org in orgseqs.keys():
-                if topseq:
-                    seqrow = orgseqs[org]["max"]
-                    aafil.write(">%s|%s\n%s\n" % (org, seqrow[1], seqrow[2]))
-                    nafil.write(">%s|%s\n%s\n" % (org, seqrow[1], seqrow[3]))
-                else:
-                    seqrow = orgseqs[org]["all"]
-                    for row in seqrow:
-                        aafil.write(">%s|%s\n%s\n" % (org, row[1], row[2]))
-                        nafil.write(">%s|%s\n%s\n" % (org, row[1], row[3]))
-
+            group = next(modelrows, (None, ()))
+        #write out stored seqs in one block per file
+        aalines = []
+        nalines = []
+        for org in orgseqs.keys():
+            if topseq:
+                seqrows = [orgseqs[org]["max"]]
+            else:
+                seqrows = orgseqs[org]["all"]
+            for row in seqrows:
+                aalines.append(">%s|%s\n%s\n" % (org, row[1], row[2]))
+                nalines.append(">%s|%s\n%s\n" % (org, row[1], row[3]))
+        with open(outdir + hkgn + ".faa", "w") as aafil, open(outdir + hkgn + ".fna", "w") as nafil:
+            aafil.write("".join(aalines))
+            nafil.write("".join(nalines))
         log.debug("Wrote (%d of %d): %s" % (i + 1, len(hkcore), hkgn))
+    np.add.at(oarry, (np.array(hitpos[0], dtype=int), np.array(hitpos[1], dtype=int)), 1)
     with open(outdir + "genematrix.txt", "w") as gmfil:
         gmfil.write("#Gene\tMedianCount\tStDev\tSinglesRatio\tUbiquity\t" + "\t".join(orgs) + "\n")
         singleslist = []
@@ -121,7 +135,8 @@ def writeall(outdir, db, pct=0.5, pct2=0.5, ev=0.1, bs=0, bh=True, filt2=None, t
         log.info("Single genes found: %s"%singleslist)
     with open(outdir + "coreresults.json","w") as cfil:
         json.dump(coredict,cfil,indent=2)
-    conn.close()
+    if owned:
+        conn.close()
     return coredict
 
 
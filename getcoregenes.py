@@ -15,6 +15,7 @@
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
 import os, argparse, ast, setlog, tempfile, json, sqlite3 as sql, numpy as np
+from makehmmsql import checkindexdb
 
 global log
 log = setlog.init(toconsole=True)
@@ -171,6 +172,7 @@ def run(db, bh=True, wg=True, co=False, pct=0.7, pct2=0.7, maxcopy=10.0, thrsh=0
             with open(lo, "r") as fil:
                 for line in fil:
                     limitlist.append(line.strip())
+        checkindexdb(db)
         hkcore, orgs = getcore(db, ev, bs, thrsh, pct, pct2, maxcopy, bh, limitlist)
         log.info("Found %d core genes: %s" % (len(hkcore), hkcore))
         if not co:
@@ -15,17 +15,19 @@
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
 import os, argparse, setlog, tempfile, sqlite3 as sql
+from seqstore import connectdb
 
 global log
 log = setlog.init(toconsole=True)
 
 def writeall(db,outdir,allcopy):
-	conn=sql.connect(db)
+	conn, owned = connectdb(db)
 	cur=conn.cursor()
 
 	rnagenes=[x[0] for x in cur.execute("SELECT DISTINCT hmmhit FROM RNAhits")]
 
 	#Combine tables into view and write full hits, fragment hits, genematrix
+	cur.execute("DROP VIEW IF EXISTS allgenes")
 	cur.execute("CREATE TEMP VIEW allgenes AS SELECT A.*,B.* FROM RNAhits A INNER JOIN Seqs B ON A.seqid=B.seqid")
 	for i,rna in enumerate(rnagenes):
 		cur.execute("SELECT orgname,GROUP_CONCAT(seqid),GROUP_CONCAT(naseq) FROM allgenes WHERE hmmhit=? GROUP BY orgname",(rna,))
@@ -41,10 +43,11 @@ def writeall(db,outdir,allcopy):
 					seqlist=sorted([(y,seqlist.count(y),idlist[seqlist.index(y)]) for y in set(seqlist)],key=lambda k: (len(k[0]),k[1]),reverse=True)
 					nafil.write(">%s|%s\n%s\n"%(x[0],str(seqlist[0][2]),str(seqlist[0][0])))
 		log.info("Finished RNA_"+rna+".fna")
-	conn.close()
+	if owned:
+		conn.close()
 
 def runfile(db, allcopy=False, outdir=None):
-	if db and os.path.exists(db):
+	if db and (isinstance(db, sql.Connection) or os.path.exists(db)):
 		#correct bad inputs
 		if not outdir:
 			outdir = tempfile.mkdtemp(prefix="results_",dir="./")
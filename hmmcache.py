@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, time, shutil, hashlib, tempfile, subprocess, setlog
+
+global log
+log = setlog.init(toconsole=True)
+
+class HmmCache(object):
+    """Content addressed store of merged and hmmpressed model files shared between jobs, evicted LRU by total size.
+    Disabled unless a cache directory or $ARTS_HMMCACHE is set"""
+    #entries used more recently than this may belong to running jobs and are not evicted
+    INUSE = 86400
+
+    def __init__(self, cachedir=None, maxsize=None):
+        self.cachedir = cachedir or os.getenv("ARTS_HMMCACHE",None)
+        self.maxsize = float(maxsize or os.getenv("ARTS_HMMCACHE_SIZE",5e9))
+        self.enabled = bool(self.cachedir)
+        if self.enabled and not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    @staticmethod
+    def filehash(flist, tag=""):
+        h = hashlib.sha1(tag.encode())
+        for fname in flist:
+            with open(fname,"rb") as fil:
+                for block in iter(lambda: fil.read(1<<20), b""):
+                    h.update(block)
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def getentry(self, key, build):
+        """Return directory of cache entry, on a miss build(tmpdir) fills it (returns False on failure)"""
+        edir = os.path.join(self.cachedir,key)
+        if os.path.isdir(edir):
+            os.utime(edir,None)
+            log.debug("HmmCache: using %s"%edir)
+            return edir
+        tmpdir = tempfile.mkdtemp(prefix="tmp_",dir=self.cachedir)
+        if not build(tmpdir):
+            shutil.rmtree(tmpdir,ignore_errors=True)
+            return False
+        try:
+            os.rename(tmpdir,edir)
+        except OSError:
+            #another job added the same entry first
+            shutil.rmtree(tmpdir,ignore_errors=True)
+        log.debug("HmmCache: added %s"%edir)
+        self.evict(keep=key)
+        return edir
+
+    def merged(self, hmmdbs):
+        """Models of all hmm files converted to HMMER3 format in one file"""
+        def build(tmpdir):
+            with open(os.path.join(tmpdir,"models.hmm"),"w") as ofil, open(os.devnull,"w") as devnull:
+                for fname in hmmdbs:
+                    ofil.flush()
+                    if subprocess.call(["hmmconvert",fname],stdout=ofil,stderr=devnull):
+                        log.error("HmmCache: could not convert %s"%fname)
+                        return False
+            return True
+        edir = self.getentry(self.filehash(hmmdbs,"merged"),build)
+        return os.path.join(edir,"models.hmm") if edir else False
+
+    def pressed(self, hmmdb):
+        """Copy of hmm file with hmmpress binaries (for hmmscan)"""
+        def build(tmpdir):
+            shutil.copyfile(hmmdb,os.path.join(tmpdir,"models.hmm"))
+            with open(os.devnull,"w") as devnull:
+                return not subprocess.call(["hmmpress",os.path.join(tmpdir,"models.hmm")],stdout=devnull,stderr=devnull)
+        edir = self.getentry(self.filehash([hmmdb],"pressed"),build)
+        return os.path.join(edir,"models.hmm") if edir else False
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until total size is below maxsize, entries in use are kept"""
+        entries = []
+        total = 0
+        for key in os.listdir(self.cachedir):
+            edir = os.path.join(self.cachedir,key)
+            if not os.path.isdir(edir):
+                continue
+            #leftovers of interrupted builds
+            if key.startswith("tmp_"):
+                if time.time()-os.path.getmtime(edir) > 86400:
+                    shutil.rmtree(edir,ignore_errors=True)
+                continue
+            size = sum(os.path.getsize(os.path.join(d,x)) for d,subdirs,files in os.walk(edir) for x in files)
+            total += size
+            if key != keep:
+                entries.append((os.path.getmtime(edir),size,edir))
+        for mtime,size,edir in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if time.time()-mtime < self.INUSE:
+                log.warning("HmmCache: %s is over size limit, remaining entries are in use"%self.cachedir)
+                break
+            log.debug("HmmCache: evicting %s"%edir)
+            shutil.rmtree(edir,ignore_errors=True)
+            total -= size
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Add merged or pressed hmm models to cache""")
+    parser.add_argument("input", help="Comma separated list of hmm files")
+    parser.add_argument("-cd", "--cachedir", help="Cache directory (default: $ARTS_HMMCACHE)", default=None)
+    parser.add_argument("-ms", "--maxsize", help="Maximum cache size in bytes (default: $ARTS_HMMCACHE_SIZE or 5e9)", type=float, default=None)
+    parser.add_argument("-p", "--press", help="hmmpress merged models", action='store_true')
+    args = parser.parse_args()
+    cache = HmmCache(args.cachedir,args.maxsize)
+    if not cache.enabled:
+        parser.error("Cache directory is required (--cachedir or $ARTS_HMMCACHE)")
+    hmmdb = cache.merged(args.input.split(","))
+    if hmmdb and args.press:
+        hmmdb = cache.pressed(hmmdb)
+    print(hmmdb)
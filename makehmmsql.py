@@ -13,26 +13,117 @@
 #
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
-import argparse, ast, os, setlog, sqlite3 as sql
+import argparse, os, setlog, sqlite3 as sql
 import time, numpy as np
+from seqstore import connectdb
 
 global log
 log = setlog.init(toconsole=True)
 
-def gethmmcov(clist):
-    for cl in clist:
-        spots = set()
-        spots2 = set()
-        for x in cl[2].split('&'):
-            xt=ast.literal_eval(x)
-            spots|=set(range(xt[0],xt[1]))     #spots|=set(xrange(xt[0],xt[1]))
-        for x in cl[3].split('&'):
-            xt=ast.literal_eval(x)
-            spots2|=set(range(xt[0],xt[1]))    #spots2|=set(xrange(xt[0],xt[1]))
-        yield int(cl[0]),cl[1],len(spots)+1,len(spots2)+1
+#PRAGMA user_version of databases with hit indexes
+SCHEMAVERSION = 1
+
+def readdomtbl(fname,ev=1e-4,bs=0.0,filt2=None):
+    """Yield hit rows from hmmer domtblout that pass evalue / bitscore filters"""
+    with open(fname,"r") as ifil:
+        for line in ifil:
+            if line[0]=="#" or not line.strip():
+                continue
+            x = line.split(None,22)
+            org,seqid = x[0].split("|")
+            if filt2 and x[3] in filt2 and filt2[x[3]]>float(x[7]):
+                continue
+            if float(x[6]) < ev and float(x[7]) > bs:  #global quality filter
+                yield [x[3],org,int(seqid),int(x[15]),int(x[16]),int(x[5]),int(x[19]),int(x[20]),int(x[2]),float(x[6]),float(x[7]),float(x[8]),float(x[13]),0,0,0]
+
+def intervalunion(groups,starts,ends,ngroups):
+    """Total length covered by [start,end) intervals of each group (sort and sweep)"""
+    total = np.zeros(ngroups,dtype=np.int64)
+    if not len(groups):
+        return total
+    order = np.lexsort((starts,groups))
+    lo = min(starts.min(),ends.min())
+    s = starts[order]-lo
+    e = ends[order]-lo
+    #offset each group past the previous one so a single running max sweeps all groups
+    goff = groups[order]*(max(s.max(),e.max())+1)
+    reach = np.maximum.accumulate(goff+e)
+    prev = np.empty_like(reach)
+    prev[0] = -1
+    prev[1:] = reach[:-1]
+    np.add.at(total,groups[order],np.maximum(goff+e-np.maximum(goff+s,prev),0))
+    return total
+
+def hmmcoverage(recs):
+    """Set hmmcov and genecov of rows from union of hmm / gene coords per seqid and model"""
+    gids = {}
+    groups = np.fromiter((gids.setdefault((x[2],x[0]),len(gids)) for x in recs),dtype=np.int64,count=len(recs))
+    cols = np.array([x[3:9] for x in recs],dtype=np.int64).reshape(-1,6)
+    hmmcov = intervalunion(groups,cols[:,0],cols[:,1],len(gids))+1
+    genecov = intervalunion(groups,cols[:,3],cols[:,4],len(gids))+1
+    for x,hc,gc in zip(recs,(hmmcov[groups]/cols[:,2]).tolist(),(genecov[groups]/cols[:,5]).tolist()):
+        x[14] = hc
+        x[15] = gc
+
+def indexdb(db):
+    """Add hit table indexes used by extraction queries and set schema version (migrates existing dbs)"""
+    conn, owned = connectdb(db)
+    csr = conn.cursor()
+    try:
+        oldversion = csr.execute("PRAGMA user_version").fetchone()[0]
+        tables = set(x[0] for x in csr.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        for tabletitle in ("HMMhits","RNAhits"):
+            if tabletitle in tables:
+                csr.execute("CREATE INDEX IF NOT EXISTS %s_hmmhit ON %s (hmmhit,seqid)"%(tabletitle,tabletitle))
+                csr.execute("CREATE INDEX IF NOT EXISTS %s_seqid ON %s (seqid,evalue)"%(tabletitle,tabletitle))
+        #Seqs join uses seqid as rowid alias, only dbs without INTEGER PRIMARY KEY need an index
+        if "Seqs" in tables and not [x for x in csr.execute("PRAGMA table_info(Seqs)") if x[1]=="seqid" and x[5]]:
+            csr.execute("CREATE INDEX IF NOT EXISTS Seqs_seqid ON Seqs (seqid)")
+        if oldversion < SCHEMAVERSION:
+            log.info("Migrated db schema version %d to %d"%(oldversion,SCHEMAVERSION))
+            csr.execute("PRAGMA user_version=%d"%SCHEMAVERSION)
+        conn.commit()
+    except sql.OperationalError as ex:
+        log.warning("Could not add indexes to db: %s"%ex)
+    if owned:
+        conn.close()
+
+def checkindexdb(db):
+    """Read path: index only dbs from before SCHEMAVERSION that are writable, built dbs are indexed by run()"""
+    conn, owned = connectdb(db)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMAVERSION:
+            return
+        dbfile = [x[2] for x in conn.execute("PRAGMA database_list") if x[1]=="main"][0]
+        try:
+            #rewriting the same version fails on read-only files and connections
+            conn.execute("PRAGMA user_version=%d"%version)
+        except sql.OperationalError:
+            dbfile = ""
+        if not dbfile or not os.access(dbfile,os.W_OK) or not os.access(os.path.dirname(os.path.abspath(dbfile)),os.W_OK):
+            log.info("Database has no hit indexes and is read-only, add them with: makehmmsql.py -m <db>")
+            return
+        indexdb(conn)
+    finally:
+        if owned:
+            conn.close()
+
+def markbesthits(csr,tabletitle,scope=""):
+    """Flag all hits of the model with lowest evalue for each seqid (first hit on ties), scope limits seqids updated"""
+    where = " WHERE seqid IN (%s)"%scope if scope else ""
+    try:
+        csr.execute("""UPDATE %s SET flags=(CASE WHEN (seqid,hmmhit) IN
+            (SELECT seqid,hmmhit FROM (SELECT seqid,hmmhit,ROW_NUMBER() OVER (PARTITION BY seqid ORDER BY evalue,rowid) AS rnk FROM %s%s) WHERE rnk=1)
+            THEN 10 ELSE 0 END)%s"""%(tabletitle,tabletitle,where,where))
+    except sql.OperationalError as ex:
+        #sqlite < 3.25 has no window functions
+        log.debug("Window function query failed (%s), using group by"%ex)
+        csr.execute("UPDATE "+tabletitle+" SET flags=0"+where) # clear all previous
+        csr.execute("UPDATE "+tabletitle+" SET flags=10 WHERE seqid||hmmhit IN (SELECT seqid||hmmhit FROM "+tabletitle+where+" GROUP BY seqid HAVING evalue==MIN(evalue))")
 
 def run(fname,ofil,ev=1e-4,bs=0.0,rna=False,filt2=None):
-    conn = sql.connect(ofil)
+    conn, owned = connectdb(ofil)
     csr = conn.cursor()
     tabletitle="HMMhits"
     if rna:
@@ -53,64 +144,58 @@ def run(fname,ofil,ev=1e-4,bs=0.0,rna=False,filt2=None):
                 x=line.strip().split()
                 temp[x[0]]=float(x[1])
         filt2=temp
-    #Add hmmhits:
-    with open(fname,"r") as ifil:
-        recs=[]
-        for line in ifil:
-            if line[0]!="#":
-                x = line.split()
-                org,seqid = x[0].split("|")
-                if filt2 and x[3] in filt2.keys() and filt2[x[3]]>float(x[7]):
-                    continue
-                if float(x[6]) < ev and float(x[7]) > bs:  #global quality filter
-                    recs.append([x[3],org,int(seqid),int(x[15]),int(x[16]),int(x[5]),int(x[19]),int(x[20]),int(x[2]),float(x[6]),float(x[7]),float(x[8]),float(x[13]),0,0,0])
-        else:
-            csr.executemany("INSERT INTO "+tabletitle+" VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",recs)
-            log.info("Added %d records"%len(recs))
-            del recs
-    # Remove duplicate rows
+    #duplicate hits are skipped on insert by unique index, first copy is kept
+    dedupcols = "hmmhit,seqid,hmmstart,hmmend,geneStart,geneEnd"
     try:
+        csr.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_dedup ON %s (%s)"%(tabletitle,tabletitle,dedupcols))
+    except sql.IntegrityError:
         log.info("Removing duplicates...")
-        csr.execute("DELETE FROM "+tabletitle+" WHERE rowid NOT IN (SELECT min(t.rowid) FROM "+tabletitle+" t GROUP BY hmmhit,seqid,hmmstart,hmmend,geneStart,geneEnd)")
-        log.info("Marking best hits...")
-        csr.execute("UPDATE "+tabletitle+" SET flags=0") # clear all previous
-        csr.execute("UPDATE "+tabletitle+" SET flags=10 WHERE seqid||hmmhit IN (SELECT seqid||hmmhit FROM "+tabletitle+" GROUP BY seqid HAVING evalue==MIN(evalue))")
-    except sql.OperationalError as ex:
-        log.error("exception:"%ex)
+        csr.execute("DELETE FROM %s WHERE rowid NOT IN (SELECT min(t.rowid) FROM %s t GROUP BY %s)"%(tabletitle,tabletitle,dedupcols))
+        csr.execute("CREATE UNIQUE INDEX %s_dedup ON %s (%s)"%(tabletitle,tabletitle,dedupcols))
+    lastid = csr.execute("SELECT IFNULL(MAX(rowid),0) FROM "+tabletitle).fetchone()[0]
+    csr.executemany("INSERT OR IGNORE INTO "+tabletitle+" VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",readdomtbl(fname,ev,bs,filt2))
+
+    #only seqid / model groups with new hits need coverage and best hits updated
+    csr.execute("DROP TABLE IF EXISTS temp.newgroups")
+    csr.execute("CREATE TEMP TABLE newgroups AS SELECT DISTINCT hmmhit,seqid FROM %s WHERE rowid>?"%tabletitle,(lastid,))
+    log.info("Added %d records"%csr.execute("SELECT COUNT(*) FROM %s WHERE rowid>?"%tabletitle,(lastid,)).fetchone()[0])
 
-    temptable="temp_%d%d"%(os.getpid(),time.time()) # make temporary table name 
     try:
         log.info("Calculating total coverage...")
-        
-        #get hmmalign coords:
-        csr.execute("SELECT seqid,hmmhit,Group_concat('('||hmmstart||','||hmmend||')','&'),Group_concat('('||geneStart||','||geneEnd||')','&') FROM "+tabletitle+" GROUP BY seqid,hmmhit")
-        seqcovs=gethmmcov(csr.fetchall())
-        csr.execute("CREATE TEMP TABLE %s_cov (seqid int, hmmhit text, hmmcov real, genecov real)"%temptable)
-        csr.executemany("INSERT INTO %s_cov VALUES (?,?,?,?)"%temptable,seqcovs)
+        rows = csr.execute("SELECT t.rowid,t.* FROM newgroups g JOIN %s t ON t.hmmhit=g.hmmhit AND t.seqid=g.seqid"%tabletitle).fetchall()
+        recs = [list(x[1:]) for x in rows]
+        hmmcoverage(recs)
+        csr.executemany("UPDATE "+tabletitle+" SET hmmcov=?,genecov=? WHERE rowid=?",((x[14],x[15],r[0]) for x,r in zip(recs,rows)))
+        del rows, recs
+    except ValueError as ex:
+        log.error("Aborting coverage calculation, Error:%s"%ex)
+    indexdb(conn)
 
-        sqlcmd="""
-            CREATE TABLE %s AS SELECT A.hmmhit,A.orgname,A.seqid,A.hmmstart,A.hmmend,A.hmmlen,A.geneStart,A.geneEnd,A.genelen,A.evalue,A.score,A.bias,A.iscore,A.flags,1.*B.hmmcov/A.hmmlen as hmmcov,1.*B.genecov/A.genelen as genecov
-            FROM %s A INNER JOIN %s_cov B ON A.seqid=B.seqid AND A.hmmhit=B.hmmhit""" % (temptable,tabletitle,temptable)
-        csr.execute(sqlcmd)
-        csr.execute("DROP TABLE "+tabletitle)
-        # csr.execute("DROP TABLE %s_cov"%temptable)
-        csr.execute("ALTER TABLE "+temptable+" RENAME TO "+tabletitle)
-        # print "Compacting db size..."
-        # csr.execute("VACUUM")
+    try:
+        log.info("Marking best hits...")
+        markbesthits(csr,tabletitle,"SELECT seqid FROM newgroups")
     except sql.OperationalError as ex:
-        log.error("Aborting coverage calculation, Error:%s"%ex)
+        log.error("exception:%s"%ex)
+
+    csr.execute("DROP TABLE IF EXISTS temp.newgroups")
+    conn.commit()
+    if owned:
+        conn.close()
 
-    conn.commit()    
-    conn.close()
-            
 # Commandline Execution
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""Combine hmmresults into single sql db""")
     parser.add_argument("input", help="Input Hmm result file")
-    parser.add_argument("out", help="Output database")
+    parser.add_argument("out", help="Output database", nargs="?", default=None)
     parser.add_argument("-r", "--rna", help="Add to RNA table instead of HK gene table", action='store_true')
     parser.add_argument("-e", "--evalue", help="Remove hits > evalue default(1e-4)", type=float, default=1e-4)
     parser.add_argument("-b", "--bitscore", help="Remove hits < bitscore default(0)", type=float, default=0)
     parser.add_argument("-f2", "--filter", help="Use per-model bitscore cutoffs dictated in file (format: modelname value)", default=None)
+    parser.add_argument("-m", "--migrate", help="Only add indexes to existing database given as input (no hmm results are added)", action='store_true')
     args = parser.parse_args()
-    run(args.input,args.out,args.evalue,args.bitscore,args.rna,args.filter)
\ No newline at end of file
+    if args.migrate:
+        indexdb(args.input)
+    elif args.out:
+        run(args.input,args.out,args.evalue,args.bitscore,args.rna,args.filter)
+    else:
+        parser.error("Output database is required")
\ No newline at end of file
@@ -15,12 +15,163 @@
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
 import argparse, sys, os, time, setlog, sqlite3 as sql
-import io
+import io, numpy as np
 
 global log
 log = setlog.init(toconsole=True)
 
-def runlist(finput,ofil,transonly=False,orgname=False):
+SEQSTABLE = "CREATE TABLE Seqs (seqid INTEGER PRIMARY KEY, orgname text, gene text, description text, source text, loc_start int, loc_end int, loc_strand int, lastscan int, naseq text, aaseq text)"
+
+#2-bit base codes shifted per codon position, summed they give the codon index (0-63)
+#bases other than ACGT/U add 64 so codons needing the ambiguous codon table are >= 64
+CODONPOS = np.full((3,256),64,dtype=np.uint8)
+for i,b in enumerate(b"ACGT"):
+    for pos,shift in enumerate((4,2,0)):
+        CODONPOS[pos,b] = CODONPOS[pos,b+32] = i<<shift
+CODONPOS[:,ord("U")] = CODONPOS[:,ord("u")] = CODONPOS[:,ord("T")]
+codontables = {}
+
+def codontable(transtab=1):
+    """Get (amino acid, start codon) lookup arrays indexed by 2-bit encoded codon for NCBI translation table"""
+    if transtab not in codontables:
+        from Bio.Data import CodonTable
+        table = CodonTable.unambiguous_dna_by_id[transtab]
+        aa = np.full(256,ord("X"),dtype=np.uint8)
+        aa[:64] = ord("*")
+        starts = np.zeros(256,dtype=bool)
+        for i in range(64):
+            codon = "ACGT"[i>>4]+"ACGT"[(i>>2)&3]+"ACGT"[i&3]
+            if codon in table.forward_table:
+                aa[i] = ord(table.forward_table[codon])
+            starts[i] = codon in table.start_codons
+        codontables[transtab] = (aa,starts)
+    return codontables[transtab]
+
+def translateseq(naseq,transtab=1,to_stop=True,cds=False):
+    """Translate single sequence with Biopython (used for codons with ambiguous bases)"""
+    from Bio.Seq import Seq
+    from Bio.Data import CodonTable
+    naseq = naseq[:len(naseq)//3*3]
+    prfx = ""
+    if cds and naseq[:3].upper() in CodonTable.unambiguous_dna_by_id[transtab].start_codons:
+        prfx = "M"
+        naseq = naseq[3:]
+    try:
+        return prfx+str(Seq(naseq).translate(to_stop=to_stop,table=transtab))
+    except CodonTable.TranslationError as e:
+        log.error("Unable to get amino acid translation for reccord: %s"%e)
+        return ""
+
+def translateall(naseqs,transtab=1,to_stop=True,cds=False):
+    """Translate list of nucleotide seqs in one pass with numpy codon lookup.
+    to_stop: end at first stop codon. cds: translate alternative start codon of first position as M"""
+    try:
+        aa,starts = codontable(transtab)
+    except KeyError:
+        log.warning("Unknown translation table %s, using standard table"%transtab)
+        aa,starts = codontable(1)
+        transtab = 1
+    ncodons = np.array([len(x)//3 for x in naseqs],dtype=np.int64)
+    ends = np.cumsum(ncodons)
+    begins = ends-ncodons
+    buf = np.frombuffer("".join(x[:len(x)//3*3] for x in naseqs).encode("ascii","replace"),dtype=np.uint8)
+    idx = CODONPOS[0][buf[0::3]]
+    idx += CODONPOS[1][buf[1::3]]
+    idx += CODONPOS[2][buf[2::3]]
+    ambig = idx >= 64
+    prot = aa[idx]
+    if cds:
+        first = begins[ncodons>0]
+        prot[first[starts[idx[first]]]] = ord("M")
+    if to_stop:
+        #stop at first stop codon within each seq
+        stops = np.flatnonzero(prot == ord("*"))
+        nxt = np.searchsorted(stops,begins)
+        stopat = np.append(stops,len(prot))[nxt]
+        ends = np.minimum(ends,stopat)
+    protstr = prot.tobytes().decode("ascii")
+    ambigpos = np.flatnonzero(ambig)
+    hasambig = np.searchsorted(ambigpos,begins) < np.searchsorted(ambigpos,begins+ncodons)
+    aaseqs = []
+    for i,naseq in enumerate(naseqs):
+        if hasambig[i]:
+            aaseqs.append(translateseq(naseq,transtab,to_stop,cds))
+        else:
+            aaseqs.append(protstr[begins[i]:ends[i]])
+    return aaseqs
+
+def readrecs(fname,org,transonly=False):
+    """Yield Seqs table rows for each record of .fna file (protein from paired org.faa or translation)"""
+    aminod=None
+    temp=None
+    fp,fn = os.path.split(fname)
+    #test if .faa exists for .fna pair and get seqs in dictionary
+    if len(fp):
+        fp+="/"
+    if os.path.isfile(fp+org+".faa"):
+        with open(fp+org+".faa","r") as faafil:
+            aminod=[]
+            reci=-1
+            for line in faafil:
+                if line[0]==">":
+                    idx=line.index(" ")
+                    gn = line[1:idx]
+                    # if gn not in aminod:
+                    #     aminod[gn]=""
+                    reci+=1
+                    aminod.append([gn,""])
+                else:
+                    aminod[reci][1]+=line.strip()
+
+    #Read each file and collect sequences
+    recs=[]
+    transtabs=[]
+    with open(fname,"r") as ifil:
+        transtab=1
+        for line in ifil:
+            if line[0]==">":
+                if temp: #add last temp
+                    recs.append(temp)
+                    transtabs.append(transtab)
+                    transtab=1
+                line=line.replace('"','').replace("'","")
+                idx=line.index(" ")
+                gn = line[1:idx]
+                source = line[1:idx].split("|")[-1]
+                ds = line[idx+1:].strip()
+                if "_PLASMID_" in ds:
+                    source+="_PLASMID"
+                if "transl_table=" in ds:
+                    try:
+                        transtab=int(ds.split("transl_table=")[-1])
+                    except ValueError:
+                        log.debug("found translation table but is invalid")
+                if "|loc|" in ds:
+                    idx = ds.index("|loc|")+5
+                    locs = [int(x) for x in ds[idx:].split()[:3]]
+                else:
+                    locs = (0,0,0)
+                temp = [org,gn,ds,source,locs[0],locs[1],locs[2],int(time.time()),""]
+            elif temp:
+                temp[-1]+=line.strip().upper()
+        if temp:
+            recs.append(temp)
+            transtabs.append(transtab)
+
+    #Add amino acid seqs from .faa pair, translate the rest in one batch per translation table
+    totrans={}
+    for i,xrow in enumerate(recs):
+        if not transonly and aminod and i < len(aminod) and aminod[i][0] == xrow[1]:
+            xrow.append(aminod[i][1])
+        else:
+            totrans.setdefault(transtabs[i],[]).append(i)
+    for transtab,idxs in totrans.items():
+        for i,aseq in zip(idxs,translateall([recs[i][-1] for i in idxs],transtab)):
+            recs[i].append(aseq)
+    for xrow in recs:
+        yield xrow
+
+def runlist(finput,ofil,transonly=False,orgname=False,bulk=False):
     if type(finput) is list:
         flist=[x.strip() for x in finput if os.path.exists(x.strip())]
     elif isinstance(finput, io.IOBase):       #elif type(finput) is file:
@@ -39,18 +190,29 @@ def runlist(finput,ofil,transonly=False,orgname=False):
         csr = conn.cursor()
         #Make table if doesnt exist:
         try:    
-            sqlcmd="CREATE TABLE Seqs (seqid INTEGER PRIMARY KEY, orgname text, gene text, description text, source text, loc_start int, loc_end int, loc_strand int, lastscan int, naseq text, aaseq text)"
-            csr.execute(sqlcmd)
+            csr.execute(SEQSTABLE)
             log.info("Creating db...")
         except sql.OperationalError as ex:
             log.info("Table exists. Adding to database...")
-            
+        insertcmd = "INSERT INTO Seqs VALUES (NULL,?,?,?,?,?,?,?,?,?,?)"
+        if bulk:
+            #Bulk build: no journal / fsync, large page cache, duplicates skipped on insert by unique index
+            log.info("Bulk load mode...")
+            csr.execute("PRAGMA journal_mode=OFF")
+            csr.execute("PRAGMA synchronous=OFF")
+            csr.execute("PRAGMA cache_size=-500000")
+            csr.execute("PRAGMA temp_store=MEMORY")
+            try:
+                csr.execute("CREATE UNIQUE INDEX IF NOT EXISTS Seqs_dedup ON Seqs (orgname,gene,description,loc_start,loc_end,loc_strand)")
+            except sql.IntegrityError:
+                log.info("Removing duplicates...")
+                csr.execute("DELETE FROM Seqs WHERE seqid NOT IN (SELECT min(t.seqid) FROM Seqs t GROUP BY orgname,gene,description,loc_start,loc_end,loc_strand)")
+                csr.execute("CREATE UNIQUE INDEX Seqs_dedup ON Seqs (orgname,gene,description,loc_start,loc_end,loc_strand)")
+            insertcmd = "INSERT OR IGNORE INTO Seqs VALUES (NULL,?,?,?,?,?,?,?,?,?,?)"
+
         # ex4istingrecs=set(str(x[0])+"@"+str(x[1]) for x in csr.execute("SELECT orgname,gene FROM Seqs"))
         #read each file
         for nr,fname in enumerate(flist):
-            recs=[]
-            temp=None
-            aminod=None
             fp,fn = os.path.split(fname)
             org,ext = os.path.splitext(fn)
             if orgname:
@@ -59,81 +221,25 @@ def runlist(finput,ofil,transonly=False,orgname=False):
             #skip .faa files, test type for gbk or fasta
             if ext.lower()==".faa":
                 continue
-            elif ext.lower()==".fna":
-                #test if .faa exists for .fna pair and get seqs in dictionary
-                if len(fp):
-                    fp+="/"
-                if os.path.isfile(fp+org+".faa"):
-                    with open(fp+org+".faa","r") as faafil:
-                        aminod=[]
-                        reci=-1
-                        for line in faafil:
-                            if line[0]==">":
-                                idx=line.index(" ")
-                                gn = line[1:idx]
-                                # if gn not in aminod:
-                                #     aminod[gn]=""
-                                reci+=1
-                                aminod.append([gn,""])
-                            else:
-                                aminod[reci][1]+=line.strip()
-
-                def addamino(xrow,i,transtab=1):
-                    if not transonly and aminod and aminod[i][0] == xrow[1]:
-                        xrow.append(aminod[i][1])
-                    else:
-                        from Bio.Seq import Seq
-                        from Bio import Data
-                        try:
-                            aseq=Seq(xrow[-1]).translate(to_stop=True,table=transtab)
-                            xrow.append(str(aseq))
-                        except Data.CodonTable.TranslationError as e:
-                            log.error("Unable to get amino acid translation for reccord: %s,%s"%e)
-                    return xrow
-                #Read each file and collect sequences
-                with open(fname,"r") as ifil:
-                    reci=-1
-                    transtab=1
-                    for line in ifil:
-                        if line[0]==">":
-                            if temp: #add last temp
-                                recs.append(addamino(temp,reci))
-                                transtab=1
-                            reci+=1
-                            line=line.replace('"','').replace("'","")
-                            idx=line.index(" ")
-                            gn = line[1:idx]
-                            source = line[1:idx].split("|")[-1]
-                            ds = line[idx+1:].strip()
-                            if "_PLASMID_" in ds:
-                                source+="_PLASMID"
-                            if "transl_table=" in ds:
-                                try:
-                                    transtab=int(ds.split("transl_table=")[-1])
-                                except ValueError:
-                                    log.debug("found translation table but is invalid")
-                            if "|loc|" in ds:
-                                idx = ds.index("|loc|")+5
-                                locs = [int(x) for x in ds[idx:].split()[:3]]
-                            else:
-                                locs = (0,0,0)
-                            temp = [org,gn,ds,source,locs[0],locs[1],locs[2],int(time.time()),""]
-                        elif temp:
-                            temp[-1]+=line.strip().upper()
-                    if temp:
-                        recs.append(addamino(temp,reci))
-
             #Insert into database
-            if len(recs)>1:
-                csr.executemany("INSERT INTO Seqs VALUES (NULL,?,?,?,?,?,?,?,?,?,?)",recs)
-            elif len(recs):
-                csr.execute("INSERT INTO Seqs VALUES (NULL,?,?,?,?,?,?,?,?,?,?)",recs[0])
-            log.info("added %d of %d files (%s  - %d reccords)" % (nr+1,numrecs,fname,len(recs)))
-        try:
-            log.info("Removing duplicates...")
-            csr.execute("DELETE FROM Seqs WHERE seqid NOT IN (SELECT min(t.seqid) FROM Seqs t GROUP BY orgname,gene,description,loc_start,loc_end,loc_strand)")
-        except sql.OperationalError as ex:
-            log.error("failed sql operation: %s"%ex)
+            start = time.time()
+            rows = 0
+            if ext.lower()==".fna" and bulk:
+                csr.executemany(insertcmd,readrecs(fname,org,transonly))
+                rows = max(csr.rowcount,0)
+            elif ext.lower()==".fna":
+                recs = list(readrecs(fname,org,transonly))
+                csr.executemany(insertcmd,recs)
+                rows = len(recs)
+            log.info("added %d of %d files (%s  - %d reccords, %d rows/sec)" % (nr+1,numrecs,fname,rows,rows/max(time.time()-start,1e-6)))
+        if bulk:
+            csr.execute("DROP INDEX IF EXISTS Seqs_dedup")
+        else:
+            try:
+                log.info("Removing duplicates...")
+                csr.execute("DELETE FROM Seqs WHERE seqid NOT IN (SELECT min(t.seqid) FROM Seqs t GROUP BY orgname,gene,description,loc_start,loc_end,loc_strand)")
+            except sql.OperationalError as ex:
+                log.error("failed sql operation: %s"%ex)
         conn.commit()
         conn.close()
         return True
@@ -148,5 +254,6 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--out", help="Output sqlite file (default: seqsql.db)", default="seqsql.db")
     parser.add_argument("-org", "--orgname", help="Organism name (default: filename)", default="")
     parser.add_argument("-t", "--trans", help="Only store translation of DNA for protein seqs (default: False)", action='store_true')
+    parser.add_argument("-bk", "--bulk", help="Bulk load mode for building large reference databases, no journal and duplicates skipped on insert (default: False)", action='store_true')
     args = parser.parse_args()
-    runlist(args.input,args.out,args.trans,args.orgname)
\ No newline at end of file
+    runlist(args.input,args.out,args.trans,args.orgname,args.bulk)
\ No newline at end of file
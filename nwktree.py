@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, re, setlog, numpy as np
+
+global log
+log = setlog.init(toconsole=True)
+
+#Lightweight replacement of the ete3 calls used by ete3methods. Operations follow the ete3 implementations
+#(resolve_polytomy, set_outgroup, ladderize, delete, format 3 writer) so output strings are identical
+TOKENS = re.compile(r"\[[^\]]*\]|[(),;]|[^(),;\[\]]+")
+ILLEGAL = re.compile("[:;(),\[\]\t\n\r=]")
+DEFAULT_DIST = 1.0
+
+class NwkTree(object):
+    """Tree held in index arrays: parent, children, name, dist (plus gid and genus set by relabel).
+    Node 0 is created first but the root can change, detached nodes are kept with parent -1"""
+    def __init__(self):
+        self.parent = []
+        self.children = []
+        self.name = []
+        self.dist = []
+        self.gid = []
+        self.genus = []
+        self.root = 0
+        self.hasroot = False
+
+    def addnode(self, parent=-1, name="", dist=DEFAULT_DIST):
+        self.parent.append(parent)
+        self.children.append([])
+        self.name.append(name)
+        self.dist.append(dist)
+        self.gid.append(None)
+        self.genus.append(None)
+        i = len(self.parent)-1
+        if parent >= 0:
+            self.children[parent].append(i)
+        return i
+
+    @classmethod
+    def parse(cls, text):
+        """Tree from newick text. Internal labels are read as support values as ete3 format 0 does and dropped"""
+        text = re.sub("[\n\r\t]+","",text.strip())
+        if text.count("(") != text.count(")"):
+            raise ValueError("Parentheses do not match. Broken tree structure?")
+        T = cls()
+        node = T.addnode()
+        stack = []
+        for tok in TOKENS.findall(text):
+            if tok == "(":
+                stack.append(node)
+                node = T.addnode(node)
+            elif tok == ",":
+                node = T.addnode(stack[-1])
+            elif tok == ")":
+                node = stack.pop()
+            elif tok == ";":
+                break
+            elif tok[0] != "[":
+                name,sep,dist = tok.partition(":")
+                if not T.children[node]:
+                    T.name[node] = name.strip()
+                if dist.strip():
+                    T.dist[node] = float(dist)
+        for i,kids in enumerate(T.children):
+            if not kids and not T.name[i]:
+                raise ValueError("Empty leaf node found")
+        return T
+
+    @classmethod
+    def fromete(cls, etree):
+        """Copy of an ete3 tree (names, dists and relabel features)"""
+        T = cls()
+        stack = [(etree,-1)]
+        while stack:
+            node,parent = stack.pop()
+            i = T.addnode(parent,node.name,node.dist)
+            T.gid[i] = getattr(node,"gid",None)
+            T.genus[i] = getattr(node,"genus",None)
+            stack.extend((x,i) for x in reversed(node.children))
+        T.hasroot = getattr(etree,"hasroot",False)
+        return T
+
+    def copy(self):
+        T = NwkTree()
+        T.parent = list(self.parent)
+        T.children = [list(x) for x in self.children]
+        T.name = list(self.name)
+        T.dist = list(self.dist)
+        T.gid = list(self.gid)
+        T.genus = list(self.genus)
+        T.root = self.root
+        T.hasroot = self.hasroot
+        return T
+
+    def preorder(self, i=None):
+        i = self.root if i is None else i
+        out = []
+        stack = [i]
+        while stack:
+            x = stack.pop()
+            out.append(x)
+            stack.extend(reversed(self.children[x]))
+        return out
+
+    def postorder(self, i=None):
+        i = self.root if i is None else i
+        out = []
+        stack = [i]
+        while stack:
+            x = stack.pop()
+            out.append(x)
+            stack.extend(self.children[x])
+        return out[::-1]
+
+    def leaves(self, i=None):
+        return [x for x in self.preorder(i) if not self.children[x]]
+
+    def leafnames(self):
+        return [self.name[x] for x in self.leaves()]
+
+    def leaf(self, name):
+        """First leaf with name or None"""
+        for x in self.leaves():
+            if self.name[x] == name:
+                return x
+        return None
+
+    def findnode(self, name):
+        """First descendant of the root with name in level order or None"""
+        level = [self.root]
+        while level:
+            level = [y for x in level for y in self.children[x]]
+            for x in level:
+                if self.name[x] == name:
+                    return x
+        return None
+
+    def ancestors(self, i):
+        out = []
+        i = self.parent[i]
+        while i >= 0:
+            out.append(i)
+            i = self.parent[i]
+        return out
+
+    def lca(self, i, j):
+        anc = set([i]+self.ancestors(i))
+        while j not in anc:
+            j = self.parent[j]
+        return j
+
+    def distance(self, i, anc=None):
+        """Branch length from node up to its ancestor (default root), summed from the node up as ete3 does"""
+        anc = self.root if anc is None else anc
+        d = 0.0
+        while i != anc:
+            d += self.dist[i]
+            i = self.parent[i]
+        return d
+
+    def resolve(self):
+        """Make bifurcating as ete3 resolve_polytomy: children c0..cn of a polytomy become (((cn-1,cn),...c1),c0)"""
+        for node in self.preorder():
+            kids = self.children[node]
+            if len(kids) > 2:
+                self.children[node] = []
+                nxt = node
+                for ch in kids[:-2]:
+                    new = self.addnode(nxt,dist=0.0)
+                    self.children[nxt].append(ch)
+                    self.parent[ch] = nxt
+                    nxt = new
+                for ch in kids[-2:]:
+                    self.children[nxt].append(ch)
+                    self.parent[ch] = nxt
+        return self
+
+    def relabel(self, prfx, outgroup=None, qorg=None):
+        """Name internal nodes prfx+number, split leaf names into name|gid, set genus of reference leaves
+        and root on a single OUTGROUP leaf. Same as ete3methods.relabeltree without copying"""
+        i = 0
+        og = 0
+        match = None
+        self.hasroot = False
+        if not len(self.name[self.root]):
+            self.name[self.root] = str(prfx)+str(i)
+            i += 1
+        for node in self.postorder()[:-1]:
+            if not len(self.name[node]):
+                self.name[node] = str(prfx)+str(i)
+                i += 1
+            else:
+                y = self.name[node].split("|")
+                self.name[node] = y[0].replace("-","_")
+                if len(y) > 1:
+                    self.gid[node] = y[1]
+                if qorg and qorg not in self.name[node]:
+                    self.genus[node] = self.name[node].split("_")[1]
+                else:
+                    self.genus[node] = None
+            if "OUTGROUP" in self.name[node] or (outgroup and outgroup in self.name[node]):
+                outgroup = self.name[node]
+                match = node
+                og += 1
+        if og == 1:
+            self.setoutgroup(match)
+            self.hasroot = True
+        return self
+
+    def setoutgroup(self, og):
+        """Root on branch above node og (ete3 set_outgroup)"""
+        root = self.root
+        pog = self.parent[og]
+        n = og
+        while self.parent[n] != root:
+            n = self.parent[n]
+        self.children[root].remove(n)
+        if len(self.children[root]) != 1:
+            conn = self.addnode(dist=0.0)
+            self.children[conn] = self.children[root]
+            for ch in self.children[conn]:
+                self.parent[ch] = conn
+            self.children[root] = []
+        else:
+            conn = self.children[root][0]
+        if pog != root:
+            #reverse parent links along the path, each node takes the branch length of its former child
+            padre = pog
+            hijo = self.parent[padre]
+            prev = -1
+            buf = self.dist[padre]
+            while hijo != root:
+                self.children[padre].append(hijo)
+                self.children[hijo].remove(padre)
+                buf,self.dist[hijo] = self.dist[hijo],buf
+                self.parent[padre] = prev
+                prev = padre
+                padre = hijo
+                hijo = self.parent[padre]
+            self.children[padre].append(conn)
+            self.parent[conn] = padre
+            self.parent[padre] = prev
+            self.dist[conn] += buf
+            og2 = pog
+            self.children[pog].remove(og)
+            self.dist[og2] = 0
+        else:
+            og2 = conn
+        self.parent[og] = root
+        self.parent[og2] = root
+        self.children[root] = [og,og2]
+        mid = (self.dist[og2]+self.dist[og])/2
+        self.dist[og] = mid
+        self.dist[og2] = mid
+
+    def delete(self, i):
+        """Remove node, children go to its parent and a parent left with one child is removed (ete3 delete)"""
+        p = self.parent[i]
+        if p < 0:
+            return
+        for ch in self.children[i]:
+            self.children[p].append(ch)
+            self.parent[ch] = p
+        self.children[i] = []
+        self.children[p].remove(i)
+        self.parent[i] = -1
+        if len(self.children[p]) < 2:
+            g = self.parent[p]
+            if g >= 0:
+                for ch in self.children[p]:
+                    self.children[g].append(ch)
+                    self.parent[ch] = g
+                self.children[p] = []
+                self.children[g].remove(p)
+                self.parent[p] = -1
+
+    def prune(self, remove):
+        """Delete leaves for which remove(node) is true, in preorder"""
+        for x in self.leaves():
+            if remove(x):
+                self.delete(x)
+        return self
+
+    def subtrees(self, keeps):
+        """Newick as written by writetree() of the tree left after prune() of all leaves not in keep, for each
+        set of leaves in keeps. The tree is not changed and each pruned tree is written in one postorder pass.
+        Leaves are deleted in preorder: a node is removed when all but one child subtree are gone and its remaining
+        child is appended to the grandparent's children, so such a child comes after the unchanged children in
+        the order of its last move. Branch lengths of removed nodes are dropped"""
+        root = self.root
+        post = self.postorder()
+        order = {x:i for i,x in enumerate(x for x in post if not self.children[x])}
+        label = {x:self.label(x) for x in post}
+        n = len(self.parent)
+        out = []
+        for keep in keeps:
+            text = [None]*n     #newick of each surviving subtree
+            size = [0]*n
+            moved = [-1]*n      #time a surviving subtree was last appended to its parent (-1 if never)
+            dead = [-1]*n       #time the last leaf of a removed subtree was deleted
+            for x in post:
+                kids = self.children[x]
+                if not kids:
+                    if x in keep:
+                        text[x] = label[x]
+                        size[x] = 1
+                    else:
+                        dead[x] = order[x]
+                    continue
+                alive = [y for y in kids if text[y] is not None]
+                if len(alive) == 2:
+                    a,b = alive
+                    if moved[a] >= 0 and (moved[b] < 0 or moved[b] < moved[a]):
+                        a,b = b,a
+                    if size[b] < size[a]:
+                        a,b = b,a
+                    text[x] = "("+text[a]+","+text[b]+")"+(label[x] if x != root else "")
+                    size[x] = size[a]+size[b]
+                elif len(alive) > 1 or (alive and x == root):
+                    alive = [y for y in alive if moved[y] < 0]+sorted((y for y in alive if moved[y] >= 0),key=moved.__getitem__)
+                    alive.sort(key=size.__getitem__)
+                    text[x] = "("+",".join(text[y] for y in alive)+")"+(label[x] if x != root else "")
+                    size[x] = sum(size[y] for y in alive)
+                elif alive:
+                    y = alive[0]
+                    text[x] = text[y]
+                    size[x] = size[y]
+                    moved[x] = max(moved[y],max(dead[z] for z in kids if text[z] is None))
+                else:
+                    dead[x] = max(dead[y] for y in kids)
+            out.append((text[root] or label[root])+";")
+        return out
+
+    def ladderize(self):
+        """Sort children by number of leaves, smallest first (stable)"""
+        size = {}
+        for x in self.postorder():
+            kids = self.children[x]
+            if kids:
+                kids.sort(key=size.__getitem__)
+                size[x] = sum(size[y] for y in kids)
+            else:
+                size[x] = 1
+        return self
+
+    def label(self, i):
+        """Name and branch length as written by ete3 format 3 and read back (dists rounded to 6 digits)"""
+        name = ILLEGAL.sub("_",self.name[i]) or "NoName"
+        return "%s:%0.16f"%(name.strip(),float("%0.6g"%self.dist[i]))
+
+    def write(self):
+        """Newick without root label as ete3methods.writetree, call ladderize first for a constant order"""
+        root = self.root
+        if not self.children[root]:
+            return self.label(root)+";"
+        out = []
+        stack = [(root,False)]
+        while stack:
+            node,closing = stack.pop()
+            if closing:
+                out.append(")")
+                if node != root:
+                    out.append(self.label(node))
+            elif node is None:
+                out.append(",")
+            elif self.children[node]:
+                out.append("(")
+                stack.append((node,True))
+                for j,ch in enumerate(reversed(self.children[node])):
+                    if j:
+                        stack.append((None,False))
+                    stack.append((ch,False))
+            else:
+                out.append(self.label(node))
+        return "".join(out)+";"
+
+    def writetree(self):
+        return self.ladderize().write()
+
+class TreeIndex(object):
+    """Lookups on a finished species tree built once per job: leaf and node by name, O(1) lowest common
+    ancestor from an Euler tour with a sparse table of depth minima, distances to the root and leaf ranges"""
+    def __init__(self, T):
+        self.tree = T
+        self.name = T.name
+        self.genus = T.genus
+        root = T.root
+        #leaves under a node are a range of the leaves in preorder
+        pre = T.preorder()
+        self.leaforder = [x for x in pre if not T.children[x]]
+        lo = {}
+        n = 0
+        for x in pre:
+            lo[x] = n
+            n += not T.children[x]
+        size = {}
+        for x in reversed(pre):
+            size[x] = sum(size[y] for y in T.children[x]) or 1
+        self.leafrange = {x:(lo[x],lo[x]+size[x]) for x in pre}
+        #Euler tour: each node is listed on entry and again after each of its children
+        euler = []
+        depth = []
+        self.first = {}
+        stack = [(root,0,True)]
+        while stack:
+            x,d,enter = stack.pop()
+            euler.append(x)
+            depth.append(d)
+            if enter:
+                self.first[x] = len(euler)-1
+                for ch in reversed(T.children[x]):
+                    stack.append((x,d,False))
+                    stack.append((ch,d+1,True))
+        self.euler = euler
+        self.depth = depth
+        #sparse table: level k holds the tour position of the minimum depth in [i, i+2^k)
+        pos = np.arange(len(euler))
+        dep = np.array(depth)
+        table = [pos]
+        k = 1
+        while (1 << k) <= len(euler):
+            prev = table[-1]
+            a = prev[:len(euler)-(1 << k)+1]
+            b = prev[(1 << (k-1)):(1 << (k-1))+len(a)]
+            table.append(np.where(dep[a] <= dep[b],a,b))
+            k += 1
+        self.table = [x.tolist() for x in table]
+        #root distances summed from each node upwards as ete3 get_distance does, so values are identical
+        nodes = np.array(pre,dtype=np.int64)
+        parent = np.array(T.parent,dtype=np.int64)
+        dist = np.array(T.dist,dtype=float)
+        rd = np.zeros(len(T.parent))
+        acc = np.zeros(len(nodes))
+        cur = nodes.copy()
+        live = cur != root
+        while live.any():
+            acc[live] += dist[cur[live]]
+            cur[live] = parent[cur[live]]
+            live = cur != root
+        rd[nodes] = acc
+        self.rootdist = rd.tolist()
+        self.leafbyname = {}
+        for x in self.leaforder:
+            self.leafbyname.setdefault(T.name[x],x)
+        #first descendant with a name in level order (rangerdtl.findnodebyname)
+        self.nodebyname = {}
+        level = [root]
+        while level:
+            level = [y for x in level for y in T.children[x]]
+            for x in level:
+                self.nodebyname.setdefault(T.name[x],x)
+
+    def leaf(self, name):
+        return self.leafbyname.get(name)
+
+    def node(self, name):
+        return self.nodebyname.get(name)
+
+    def leaves(self, x):
+        lo,hi = self.leafrange[x]
+        return self.leaforder[lo:hi]
+
+    def ancestors(self, x):
+        return self.tree.ancestors(x)
+
+    def lca(self, i, j):
+        l,r = self.first[i],self.first[j]
+        if l > r:
+            l,r = r,l
+        k = (r-l+1).bit_length()-1
+        a = self.table[k][l]
+        b = self.table[k][r-(1 << k)+1]
+        return self.euler[a if self.depth[a] <= self.depth[b] else b]
+
+    def distance(self, i, anc=None):
+        """Branch length from node up to its ancestor (default root), summed along the path as ete3 get_distance"""
+        if anc is None:
+            return self.rootdist[i]
+        return self.tree.distance(i,anc)
+
+def readtree(fname):
+    """First line of a tree file with RAxML labels and quotes removed, made bifurcating (ete3methods.maketree)"""
+    with open(fname,"r") as fil:
+        x = fil.readline()
+    x = re.sub("\[I\d+?\]|\"|'|QUERY___","",x)
+    return NwkTree.parse(x).resolve()
+
+def splitdups(T, org, spset, outgroup=None):
+    """Newick of the gene tree for each query gene id with other query copies and species not in spset removed.
+    T is relabeled once (T.hasroot tells if it was rooted) and all copies are written with subtrees()"""
+    gids = []
+    for x in T.leaves():
+        if org in T.name[x]:
+            gid = T.name[x].split("|")[-1]
+            if gid not in gids:
+                gids.append(gid)
+    if not gids:
+        return {}
+    T.relabel("G",outgroup)
+    leaves = T.leaves()
+    common = set(x for x in leaves if T.name[x] in spset)
+    query = [x for x in leaves if org in T.name[x]]
+    keeps = [common.difference(x for x in query if k not in (T.gid[x] or "")) for k in gids]
+    return dict(zip(gids,T.subtrees(keeps)))
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Relabel, root and write a newick tree as input for ranger-dtl (as ete3methods.mergetrees)""")
+    parser.add_argument("input", help="Newick tree file")
+    parser.add_argument("-p", "--prefix", help="Prefix of internal node names (default: SP)", default="SP")
+    parser.add_argument("-og", "--outgroup", help="Root on leaf containing this name (default: OUTGROUP)", default=None)
+    parser.add_argument("-q", "--queryorg", help="Query organism, all other leaves get a genus (default: None)", default=None)
+    parser.add_argument("-c", "--compare", help="Also write the tree with ete3 and report differences", action='store_true')
+    args = parser.parse_args()
+    T = readtree(args.input).relabel(args.prefix,args.outgroup,args.queryorg)
+    line = T.writetree()
+    print(("[&U]" if not T.hasroot else "")+line)
+    if args.compare:
+        import ete3methods
+        E = ete3methods.relabeltree(ete3methods.maketree(args.input),args.prefix,args.outgroup,args.queryorg)
+        print("OK" if ete3methods.writetree(E) == line else "DIFF %s"%ete3methods.writetree(E))
@@ -14,7 +14,7 @@
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
-import os
+import os, re, io, multiprocessing as mp
 from Bio import SeqIO
 import setlog
 import unicodedata
@@ -22,6 +22,234 @@ import unicodedata
 global log
 log = setlog.init(toconsole=True)
 
+#Lines that end the FEATURES table (same as Biopython's GenBank scanner)
+SEQHEADERS = ("ORIGIN","CONTIG","BASE COUNT","WGS","TSA","TLS","WGS_SCAFLD")
+LOCRANGE = re.compile(r"^[<>]?(\d+)(?:(\.\.|\^)[<>]?(\d+))?$")
+UPPERTAB = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz",b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+COMPTAB = bytes.maketrans(b"ACGTRYKMBVDHSWNacgtrykmbvdhswn",b"TGCAYRMKVBHDSWNtgcayrmkvbhdswn")
+
+class GbkLocation(object):
+    """Feature location as 0-based (start, end, strand) parts in the order they are extracted"""
+    __slots__ = ("parts","start","end","strand")
+    def __init__(self,parts):
+        self.parts = parts
+        self.start = min(x[0] for x in parts)
+        self.end = max(x[1] for x in parts)
+        strands = set(x[2] for x in parts)
+        self.strand = parts[0][2] if len(strands)==1 else None
+
+class GbkFeature(object):
+    """Minimal stand-in for Biopython SeqFeature used by the streaming parser"""
+    __slots__ = ("type","location","qualifiers")
+    def __init__(self,ftype,location,qualifiers):
+        self.type = ftype
+        self.location = location
+        self.qualifiers = qualifiers
+
+    def extract(self,seq):
+        if not len(seq):
+            raise ValueError("Record has no sequence data, cannot extract %s feature"%self.type)
+        outseq = bytearray()
+        for start,end,strand in self.location.parts:
+            if strand == -1:
+                outseq += seq[start:end].translate(COMPTAB)[::-1]
+            else:
+                outseq += seq[start:end]
+        return outseq.decode("ascii","ignore")
+
+class GbkRecord(object):
+    """Minimal stand-in for Biopython SeqRecord, sequence is held in a single bytearray"""
+    def __init__(self):
+        self.id = None
+        self.name = ""
+        self.description = ""
+        self.annotations = {}
+        self.features = []
+        self.seq = bytearray()
+
+def splitlocation(locstr):
+    """Split location string on top level commas"""
+    parts = []
+    depth = 0
+    last = 0
+    for i,ch in enumerate(locstr):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and not depth:
+            parts.append(locstr[last:i])
+            last = i+1
+    parts.append(locstr[last:])
+    return parts
+
+def parselocation(locstr):
+    """Parse GenBank location into list of 0-based (start, end, strand) parts (handles join, order, complement)"""
+    if locstr.startswith("complement(") and locstr.endswith(")"):
+        return [(x[0],x[1],-x[2]) for x in reversed(parselocation(locstr[11:-1]))]
+    for op in ("join(","order("):
+        if locstr.startswith(op) and locstr.endswith(")"):
+            parts = []
+            for x in splitlocation(locstr[len(op):-1]):
+                parts.extend(parselocation(x))
+            return parts
+    m = LOCRANGE.match(locstr)
+    if not m:
+        raise ValueError("Unsupported feature location: %s"%locstr)
+    if not m.group(2):
+        return [(int(m.group(1))-1,int(m.group(1)),1)]
+    elif m.group(2) == "^":
+        return [(int(m.group(1)),int(m.group(1)),1)]
+    return [(int(m.group(1))-1,int(m.group(3)),1)]
+
+def parsefeature(ftype,lines):
+    """Make GbkFeature from location and qualifier lines (qualifier values cleaned as in Biopython)"""
+    lines = [x for x in lines if x]
+    i = 1
+    locstr = lines[0].strip()
+    while locstr.endswith(",") or locstr.count("(") > locstr.count(")"):
+        locstr += lines[i]
+        i += 1
+    qualifiers = {}
+    quals = []
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line[0] == "/":
+            idx = line.find("=")
+            if idx == -1:
+                quals.append([line[1:],None])
+                continue
+            value = line[idx+1:].lstrip() if line[idx+1:].lstrip().startswith('"') else line[idx+1:]
+            if len(value) > 1 and value[0] == '"':
+                while value[-1] != '"' and i < len(lines):
+                    value += " " + lines[i]
+                    i += 1
+            quals.append([line[1:idx],value])
+        elif quals and quals[-1][1] is not None:
+            quals[-1][1] += " " + line
+    for key,value in quals:
+        if value is None:
+            if key not in qualifiers:
+                qualifiers[key] = [""]
+            continue
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        value = value.replace('""','"')
+        if key == "translation":
+            value = "".join(value.split())
+        qualifiers.setdefault(key,[]).append(value)
+    return GbkFeature(ftype,GbkLocation(parselocation("".join(locstr.split()))),qualifiers)
+
+def parseheader(lines,rec):
+    """Set record name, id, description, source and organism from header lines"""
+    entries = []
+    for line in lines:
+        if not line:
+            continue
+        if line[:12].strip():
+            entries.append([line[:12].strip(),line[12:].strip(),[]])
+        elif entries:
+            entries[-1][2].append(line[12:])
+    accessions = []
+    version = ""
+    for key,data,cont in entries:
+        if key == "LOCUS":
+            x = data.split()
+            rec.name = x[0] if len(x) else ""
+        elif key == "ORGANISM":
+            lineage = ""
+            for line in cont:
+                if lineage or ";" in line or line.strip() in ("Bacteria.","Archaea.","Eukaryota.","Unclassified.","Viruses.","cellular organisms.","other sequences.","unclassified sequences."):
+                    lineage += line
+                elif line.strip() != ".":
+                    data += " " + line.strip()
+            rec.annotations["organism"] = data
+        elif key in ("DEFINITION","SOURCE","ACCESSION","VERSION"):
+            for line in cont:
+                data += " " + line
+            if key == "DEFINITION":
+                if data.endswith("."):
+                    data = data[:-1]
+                rec.description = rec.description+" "+data if rec.description else data
+            elif key == "SOURCE":
+                rec.annotations["source"] = data[:-1] if data.endswith(".") else data
+            elif key == "ACCESSION":
+                accessions.extend(x for x in data.replace(";"," ").split() if x not in accessions)
+            else:
+                version = " ".join(data.split()).split(" GI:")[0]
+    #id from versioned accession, accession, or locus name
+    if version.count(".") == 1 and version.split(".")[1].isdigit():
+        if version.split(".")[0] not in accessions:
+            accessions.append(version.split(".")[0])
+        rec.id = "%s.%d"%(accessions[0],int(version.split(".")[1]))
+    elif version:
+        rec.id = version
+    elif accessions:
+        rec.id = accessions[0]
+    else:
+        rec.id = rec.name
+    return rec
+
+def streamrecords(filename):
+    """Incrementally scan GenBank file yielding GbkRecord objects without building Biopython objects"""
+    with open(filename,"r") as handle:
+        for rec in scanrecords(handle):
+            yield rec
+
+def scanrecords(handle):
+    """Scan records from open GenBank handle. FEATURES are parsed per feature and ORIGIN is read into one bytearray"""
+    rec = None
+    state = None
+    header = []
+    flines = None
+    ftype = ""
+    for line in handle:
+        if state is None:
+            if line.startswith("LOCUS"):
+                rec = GbkRecord()
+                header = [line.rstrip()]
+                state = "header"
+            continue
+        if line.startswith("//"):
+            if state == "header":
+                parseheader(header,rec)
+            elif flines:
+                rec.features.append(parsefeature(ftype,flines))
+            rec.seq = rec.seq.translate(UPPERTAB,b" \t\r\n")
+            yield rec
+            rec = None
+            state = None
+            flines = None
+            continue
+        if state == "origin":
+            rec.seq += line[10:].encode("ascii","ignore")
+        elif state == "header":
+            if line.startswith("FEATURES"):
+                parseheader(header,rec)
+                state = "features"
+            elif line[:12].rstrip() in SEQHEADERS:
+                parseheader(header,rec)
+                state = "origin" if line.startswith("ORIGIN") else "misc"
+            else:
+                header.append(line.rstrip())
+        elif state == "features":
+            if line[:12].rstrip() in SEQHEADERS:
+                if flines:
+                    rec.features.append(parsefeature(ftype,flines))
+                flines = None
+                state = "origin" if line.startswith("ORIGIN") else "misc"
+            elif line[:21] == " "*21 or not line.strip():
+                if flines is not None:
+                    flines.append(line[21:].strip())
+            else:
+                if flines:
+                    rec.features.append(parsefeature(ftype,flines))
+                ftype = line[2:21].strip()
+                flines = [line[21:].rstrip()]
+        elif line.startswith("ORIGIN"):
+            state = "origin"
+
 def getheader(seq_record,recnum,userecnum=False):
     """Get record header information"""
     if len(seq_record.id) and not userecnum:
@@ -60,14 +288,135 @@ def appendheader(seqtitle, desc, lnum, qual, loc, recnum):
     #return gi + "|" + seqtitle + " " + desc + "|" + gdesc2 + "|" + gdesc + "|loc|" + str(loc[0]) + " " + str(loc[1] + 1) + " " + str(loc[2]) + " # ID=1_" + str(lnum) + ";"
 
 
-def convertgenes(filename, outdir="./", rename=False,usetrans=False,plasmid=False,userecnum=False,clust=False,cutoff=10):
-    """Parse all gbk records and output nuc and prot sequences for each CDS in multi-fasta format"""
+def recordgenes(seq_record,recnum,locus_num,userecnum=False,clust_or_reg="region",version=5,cutoff=10,features=("CDS","rRNA")):
+    """Collect CDS/rRNA sequences and clusters of one record. Header lnum is assigned when the record is written"""
+    seqtitle, seqdesc = getheader(seq_record,recnum,userecnum)
+    rec = {"name":seq_record.name,"seqtitle":seqtitle,"seqdesc":seqdesc,"recnum":recnum,"genes":[],"clusters":[],
+           "cdscount":0,"bpcount":0,"bpend":1,"orgname":"","genus":""}
+    bpcount = 0
+    bpend = 1
+    for seq_feature in seq_record.features:
+        plasmidTitle=""
+        if "source" in seq_feature.type.lower() and "plasmid" in seq_feature.qualifiers.keys():
+            plasmidTitle="_PLASMID_"+str(seq_feature.qualifiers["plasmid"])
+        if seq_feature.type in features:
+            outseq = seq_feature.extract(seq_record.seq)
+            if len(outseq) > cutoff:
+                bpend = int(seq_feature.location.end)
+                bpstart = int(seq_feature.location.start)
+                #Fix for CDS joins that span multiple strands (defaults to 1)
+                if seq_feature.location.strand:
+                    bpstrand = int(seq_feature.location.strand)
+                else:
+                    bpstrand = 1
+                bpcount += bpend - bpstart
+                seqsuffix = plasmidTitle
+                seqsuffix += "|Type="+seq_feature.type
+                if "transl_table" in seq_feature.qualifiers:
+                    seqsuffix += "|transl_table="+seq_feature.qualifiers["transl_table"][0]
+                #keep only qualifiers used by appendheader and the query bundle
+                qual = {k:seq_feature.qualifiers[k] for k in ("db_xref","product","gene","transl_table") if k in seq_feature.qualifiers}
+                rec["genes"].append((qual,[bpstart, bpend, bpstrand],seqsuffix,str(outseq),bool(plasmidTitle)))
+            if seq_feature.type == "CDS":
+                rec["cdscount"] += 1
+
+        #get cluster if present
+        if clust_or_reg in seq_feature.type.lower() and "repeat" not in clust_or_reg:
+            note = seq_feature.qualifiers.get("note",[])
+            product = seq_feature.qualifiers.get("product",[])
+            bpend = int(seq_feature.location.end)
+            bpstart = int(seq_feature.location.start)
+            if version == 5:
+                if "region_number" in seq_feature.qualifiers:
+                    clustnum = str(locus_num) + "_" + seq_feature.qualifiers["region_number"][0]
+                    rec["clusters"].append([clustnum, str(",".join(product)), seqtitle, bpstart, bpend])
+            else:
+                for x in note:
+                    if "Cluster number:" in x:
+                        clustnum = x.split(":")[-1].strip()
+                        rec["clusters"].append([clustnum,str(",".join(product)),seqtitle,bpstart,bpend])
+
+    rec["bpcount"] = bpcount
+    rec["bpend"] = bpend
+    if "organism" in seq_record.annotations:
+        rec["orgname"]=seq_record.annotations["organism"]
+        rec["genus"] = rec["orgname"].replace("_"," ").split()[0]
+    elif "source" in seq_record.annotations:
+        rec["orgname"]=seq_record.annotations["source"]
+        rec["genus"] = rec["orgname"].replace("_"," ").split()[0]
+    return rec
+
+def writerecord(rec,lnum,nuc_handle,clust_handle,bundle=None):
+    """Write genes of a collected record numbering headers from lnum, returns next lnum"""
+    for qual,loc,seqsuffix,outseq,plasmid in rec["genes"]:
+        seqdetails = appendheader(rec["seqtitle"], rec["seqdesc"], lnum, qual, loc, rec["recnum"])
+        seqdetails += seqsuffix
+        #Remove non-unicode chars
+        #seqdetails = "".join([x if ord(x) < 128 else '-' for x in str(seqdetails)])
+        seqdetails = str(seqdetails).encode('ascii','ignore').decode('ascii','ignore')    #seqdetails = str(seqdetails).decode('ascii','ignore')
+        nuc_handle.write(">%s\n%s\n" % (seqdetails, outseq))
+        if bundle is not None:
+            bundle.append((seqdetails,loc,plasmid,qual.get("transl_table",["1"])[0],outseq))
+        lnum += 1
+    for row in rec["clusters"]:
+        clust_handle.write("%s\t%s\t%s\t%s\t%s\n" % tuple(row))
+    log.info("Record #%s CDS bp coverage: %s%%"%(rec["recnum"],(rec["bpcount"] * 100 / rec["bpend"])))
+    return lnum
+
+def recordoffsets(filename):
+    """Get byte offset and length of each record (LOCUS to //) in genbank file"""
+    offsets = []
+    start = None
+    pos = 0
+    with open(filename,"rb") as fil:
+        for line in fil:
+            if start is None and line.startswith(b"LOCUS"):
+                start = pos
+            pos += len(line)
+            if start is not None and line.startswith(b"//"):
+                offsets.append((start,pos-start))
+                start = None
+    return offsets
+
+def parsechunk(args):
+    """Pool worker: parse a block of records read from byte offsets and collect their genes"""
+    filename, offsets, recnum, kwargs = args
+    stream = kwargs.pop("stream",False)
+    recs = []
+    with open(filename,"rb") as fil:
+        for start,length in offsets:
+            fil.seek(start)
+            handle = io.TextIOWrapper(io.BytesIO(fil.read(length)))
+            if stream:
+                seq_record = next(scanrecords(handle))
+            else:
+                seq_record = SeqIO.read(handle,"genbank")
+            recs.append(recordgenes(seq_record,recnum,recnum,**kwargs))
+            recnum += 1
+    return recs
+
+def poolrecords(filename,offsets,cpu,stream=False,**kwargs):
+    """Parse records concurrently with a process pool, yields collected records in file order"""
+    csize = max(1,min(50,len(offsets)//(cpu*4)))
+    chunks = [(filename,offsets[i:i+csize],i+1,dict(kwargs,stream=stream)) for i in range(0,len(offsets),csize)]
+    log.info("Parsing %s records with %s processes"%(len(offsets),cpu))
+    pool = mp.Pool(cpu)
+    try:
+        for recs in pool.imap(parsechunk,chunks):
+            for rec in recs:
+                yield rec
+    finally:
+        pool.close()
+        pool.join()
+
+def convertgenes(filename, outdir="./", rename=False,usetrans=False,plasmid=False,userecnum=False,clust=False,cutoff=10,stream=False,cpu=1,bundle=None):
+    """Parse all gbk records and output nuc and prot sequences for each CDS in multi-fasta format.
+    If bundle list is given, (header, loc, plasmid, transl_table, seq) of each written gene is appended to it"""
     #get locus num and names
     locus_names = {}
     log.info("Starting %s..."%filename)
     fpath, fname = os.path.split(filename)
     fname, ext = os.path.splitext(fname)
-    reclist = SeqIO.parse(filename, "genbank")
     #### temporary measure ? ####
     if ".final.gbk" in filename:
         version = 4
@@ -81,92 +430,40 @@ def convertgenes(filename, outdir="./", rename=False,usetrans=False,plasmid=Fals
         clust_or_reg = "cluster"
     genus = "unknown"
     orgname = "unknown"
+    opts = {"userecnum":userecnum,"clust_or_reg":clust_or_reg,"version":version,"cutoff":cutoff}
+    offsets = recordoffsets(filename) if cpu > 1 else []
+    if len(offsets) > 1:
+        #Draft assemblies: parse records in parallel, lnum is renumbered in file order when writing
+        reclist = poolrecords(filename,offsets,cpu,stream=stream,**opts)
+    else:
+        if stream:
+            #Streaming parser slices features straight from ORIGIN bytes, avoids SeqRecord/SeqFeature construction
+            log.info("Using streaming genbank parser")
+            seqrecs = streamrecords(filename)
+        else:
+            seqrecs = SeqIO.parse(filename, "genbank")
+        reclist = (recordgenes(seq_record,i+1,i+1,**opts) for i,seq_record in enumerate(seqrecs))
 
     if not outdir.endswith("/"):
         outdir+="/"
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
     lnum = 1
-    clusters = 0
     cdscount = 0
     recnum = 0
-    features=["CDS","rRNA"]
     clusters=[]
     with open(outdir + fname + ".clust.tsv", "w") as clust_handle, open(outdir + fname + ".fna", "w") as nuc_handle:
         clust_handle.write("#cluster_number\tproduct\tscaffold/record_number\tstart\tend\n")
-        locus_num = 0
-        for seq_record in reclist:
-            locus_num += 1
+        as_dir = os.path.abspath(os.path.join(filename, os.pardir))
+        for rec in reclist:
             recnum += 1
-            as_dir = os.path.abspath(os.path.join(filename, os.pardir))
-            locus_name_path = os.path.join(as_dir, seq_record.name)
-            locus_names[locus_name_path] = locus_num
-            seqtitle, seqdesc = getheader(seq_record,recnum,userecnum)
-            bpcount = 0
-            bpend = 1
-            for seq_feature in seq_record.features:
-                plasmidTitle=""
-                if "source" in seq_feature.type.lower() and "plasmid" in seq_feature.qualifiers.keys():
-                    plasmidTitle="_PLASMID_"+str(seq_feature.qualifiers["plasmid"])
-                if seq_feature.type in features:
-                    outseq = seq_feature.extract(seq_record.seq)
-                    if len(outseq) > cutoff:
-                        bpend = int(seq_feature.location.end)
-                        bpstart = int(seq_feature.location.start)
-                        #Fix for CDS joins that span multiple strands (defaults to 1)
-                        if seq_feature.location.strand:
-                            bpstrand = int(seq_feature.location.strand)
-                        else:
-                            bpstrand = 1
-                        bpcount += bpend - bpstart
-                        seqdetails = appendheader(seqtitle, seqdesc, lnum, seq_feature.qualifiers,
-                                                  [bpstart, bpend, bpstrand], recnum)
-                        seqdetails+=plasmidTitle
-                        seqdetails+="|Type="+seq_feature.type
-                        if "transl_table" in seq_feature.qualifiers:
-                            seqdetails += "|transl_table="+seq_feature.qualifiers["transl_table"][0]
-
-                        #Remove non-unicode chars
-                        #seqdetails = "".join([x if ord(x) < 128 else '-' for x in str(seqdetails)])
-                        seqdetails = str(seqdetails).encode('ascii','ignore').decode('ascii','ignore')    #seqdetails = str(seqdetails).decode('ascii','ignore')
-                        nuc_handle.write(">%s\n%s\n" % (seqdetails, outseq))
-                        lnum += 1
-                    if seq_feature.type == "CDS":
-                        cdscount += 1
-
-                #get cluster if present
-                if clust_or_reg in seq_feature.type.lower() and "repeat" not in clust_or_reg:
-                    note = seq_feature.qualifiers.get("note",[])
-                    product = seq_feature.qualifiers.get("product",[])
-                    bpend = int(seq_feature.location.end)
-                    bpstart = int(seq_feature.location.start)
-                    if version == 5:
-                        if "region_number" in seq_feature.qualifiers:
-                            clustnum = str(locus_num) + "_" + seq_feature.qualifiers["region_number"][0]
-                            clusters.append([clustnum, str(",".join(product)), seqtitle, bpstart, bpend])
-                            clust_handle.write("%s\t%s\t%s\t%s\t%s\n" % tuple(clusters[-1]))
-                    else:
-                        for x in note:
-                            if "Cluster number:" in x:
-                                clustnum = x.split(":")[-1].strip()
-                                clusters.append([clustnum,str(",".join(product)),seqtitle,bpstart,bpend])
-                                clust_handle.write("%s\t%s\t%s\t%s\t%s\n"%tuple(clusters[-1]))
-
-
-                    # if not clustnum:
-                    #     clustnum = clusters
-
-            log.info("Record #%s CDS bp coverage: %s%%"%(recnum,(bpcount * 100 / bpend)))
-
-            if "organism" in seq_record.annotations:
-                orgname=seq_record.annotations["organism"]
-                genus = orgname.replace("_"," ").split()[0]
-            elif "source" in seq_record.annotations:
-                orgname=seq_record.annotations["source"]
-                genus = orgname.replace("_"," ").split()[0]
-            else:
-                orgname=""
-                genus=""
+            locus_name_path = os.path.join(as_dir, rec["name"])
+            locus_names[locus_name_path] = recnum
+            lnum = writerecord(rec,lnum,nuc_handle,clust_handle,bundle)
+            cdscount += rec["cdscount"]
+            clusters.extend(rec["clusters"])
+            orgname = rec["orgname"]
+            genus = rec["genus"]
     if rename:
         os.rename(outdir + fname + ".fna", outdir + rename + ".fna")
         os.rename(outdir + fname + ".clust.tsv", outdir + rename + ".clust.tsv")
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, re, json, subprocess, setlog
+
+global log
+log = setlog.init(toconsole=True)
+
+TOKENS = re.compile(r"\[[^\]]*\]|'[^']*'|\{\d+\}|:[^(),;:{}\[\]]*|[(),;]|[^(),;:{}\[\]']+")
+
+def parsenewick(text):
+    """Nested dict tree {name, length, edge, children}, keeps jplace {edge} numbers, drops [comments]"""
+    root = {"name":"","length":None,"edge":None,"children":[]}
+    node = root
+    stack = []
+    for tok in TOKENS.findall(text.strip()):
+        if tok == "(":
+            child = {"name":"","length":None,"edge":None,"children":[]}
+            node["children"].append(child)
+            stack.append(node)
+            node = child
+        elif tok == ",":
+            child = {"name":"","length":None,"edge":None,"children":[]}
+            stack[-1]["children"].append(child)
+            node = child
+        elif tok == ")":
+            node = stack.pop()
+        elif tok == ";":
+            break
+        elif tok[0] == ":":
+            node["length"] = tok[1:]
+        elif tok[0] == "{":
+            node["edge"] = int(tok[1:-1])
+        elif tok[0] == "[":
+            continue
+        else:
+            node["name"] = tok.strip("'")
+    return root
+
+def writenewick(root):
+    """Newick string of nested dict tree"""
+    out = []
+    stack = [(root,False)]
+    while stack:
+        node,closing = stack.pop()
+        if closing:
+            out.append(")")
+        elif node == ",":
+            out.append(",")
+            continue
+        elif node["children"]:
+            out.append("(")
+            stack.append((node,True))
+            for i,child in enumerate(reversed(node["children"])):
+                if i:
+                    stack.append((",",False))
+                stack.append((child,False))
+            continue
+        out.append(node["name"])
+        if node["length"] is not None:
+            out.append(":"+node["length"])
+    return "".join(out)+";"
+
+def prune(root, names):
+    """Remove leaves with given names, nodes left with one child are merged into it"""
+    parents = {}
+    leaves = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in node["children"]:
+            parents[id(child)] = node
+            stack.append(child)
+        if not node["children"] and node["name"] in names:
+            leaves.append(node)
+    for leaf in leaves:
+        node = leaf
+        parent = parents.get(id(node))
+        while parent is not None:
+            parent["children"] = [x for x in parent["children"] if x is not node]
+            if parent["children"]:
+                break
+            node, parent = parent, parents.get(id(parent))
+        if parent is not None and len(parent["children"]) == 1:
+            child = parent["children"][0]
+            grand = parents.get(id(parent))
+            if grand is None:
+                #single child of root becomes root
+                child["length"] = None
+                root.update(child)
+                for x in root["children"]:
+                    parents[id(x)] = root
+            else:
+                if parent["length"] is not None or child["length"] is not None:
+                    child["length"] = "%.10g"%(float(parent["length"] or 0)+float(child["length"] or 0))
+                grand["children"] = [child if x is parent else x for x in grand["children"]]
+                parents[id(child)] = grand
+    return root
+
+def graft(root, placements):
+    """Attach (edge_num, distal_length, pendant_length, name) placements on the numbered edges.
+    Placements on the root edge go under a new root node. Returns None if an edge is not in the tree"""
+    edges = {}
+    parents = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node["edge"] is not None:
+            edges[node["edge"]] = node
+        for child in node["children"]:
+            parents[id(child)] = node
+            stack.append(child)
+    byedge = {}
+    for edge,distal,pendant,name in placements:
+        byedge.setdefault(edge,[]).append((float(distal),float(pendant),name))
+    for edge,plist in byedge.items():
+        if edge not in edges:
+            log.error("Placement edge %s not found in tree"%edge)
+            return None
+        node = edges[edge]
+        parent = parents.get(id(node))
+        if parent is None:
+            #root edge, the old root moves down and the chain above it becomes the root
+            node = dict(root)
+            for child in node["children"]:
+                parents[id(child)] = node
+            edges[edge] = node
+        total = float(node["length"] or 0)
+        #chain of new nodes along the edge ordered from the distal end
+        lower = node
+        prevdist = 0.0
+        for distal,pendant,name in sorted(plist):
+            distal = min(max(distal,prevdist),total)
+            lower["length"] = "%.10g"%(distal-prevdist)
+            new = {"name":"","length":None,"edge":None,"children":[lower,{"name":name,"length":"%.10g"%pendant,"edge":None,"children":[]}]}
+            lower = new
+            prevdist = distal
+        if parent is None:
+            lower["length"] = "%.10g"%(total-prevdist) if root["length"] is not None else None
+            root.clear()
+            root.update(lower)
+            continue
+        lower["length"] = "%.10g"%(total-prevdist)
+        parent["children"] = [lower if x is node else x for x in parent["children"]]
+    return root
+
+def jplacetrees(fname, groups):
+    """Labelled newick for each group {name:[query names]} from best placements in a jplace file, groups that fail to graft are omitted"""
+    with open(fname,"r") as fil:
+        jp = json.load(fil)
+    fields = jp["fields"]
+    idx = {x:fields.index(x) for x in ("edge_num","like_weight_ratio","distal_length","pendant_length")}
+    best = {}
+    for pl in jp["placements"]:
+        p = max(pl["p"],key=lambda x: x[idx["like_weight_ratio"]])
+        for name in pl.get("n",[])+[x[0] for x in pl.get("nm",[])]:
+            best[name] = (p[idx["edge_num"]],p[idx["distal_length"]],p[idx["pendant_length"]],name)
+    trees = {}
+    for group,names in groups.items():
+        tree = graft(parsenewick(jp["tree"]),[best[x] for x in names if x in best])
+        #groups that could not be grafted are left out so the gene tree is reported as failed
+        if tree is not None:
+            trees[group] = writenewick(tree)
+    return trees
+
+#Placement backends place aligned query sequences into a reference tree. place() returns {group:labelled newick}
+#for groups {group:[query names]}, all groups are placed with one call of the backend
+class RaxmlPlacement(object):
+    """RAxML EPA (raxmlHPC -f v), queries are all sequences of the alignment missing from the reference tree"""
+    name = "raxml"
+    def place(self, sdir, algnfile, reftree, groups, cpu=1):
+        cmd = ["raxmlHPC-SSE3","-f","v","-m","GTRGAMMA","-p","12345","-w",sdir,"-t",reftree,"-s",algnfile,"-n",os.path.split(reftree)[-1]]
+        with open(os.devnull,"w") as devnull:
+            subprocess.call(cmd,stdout=devnull)
+        labledtree = os.path.join(sdir,"RAxML_labelledTree.%s"%os.path.split(reftree)[-1])
+        if not os.path.exists(labledtree):
+            log.error("RAxML-EPA: error, could not process %s"%algnfile)
+            return {}
+        with open(labledtree,"r") as fil:
+            tree = fil.readline()
+        if len(groups) == 1:
+            return {k:tree for k in groups}
+        tree = re.sub("\[I\d+?\]|\"|'|QUERY___","",tree)
+        allnames = set(x for names in groups.values() for x in names)
+        return {k:writenewick(prune(parsenewick(tree),allnames-set(names))) for k,names in groups.items()}
+
+class EpangPlacement(object):
+    """EPA-ng, reference and query alignments are split from the combined alignment and placed in one run"""
+    name = "epang"
+    def place(self, sdir, algnfile, reftree, groups, cpu=1):
+        queries = set(x for names in groups.values() for x in names)
+        ref = os.path.join(sdir,"ref.fasta")
+        qry = os.path.join(sdir,"query.fasta")
+        with open(algnfile,"r") as fil, open(ref,"w") as rfil, open(qry,"w") as qfil:
+            ofil = rfil
+            for line in fil:
+                if line[0] == ">":
+                    ofil = qfil if line[1:].split(None,1)[0] in queries else rfil
+                ofil.write(line)
+        cmd = ["epa-ng","--ref-msa",ref,"--tree",reftree,"--query",qry,"--model","GTR+G","--outdir",sdir,"--redo","--threads",str(cpu)]
+        with open(os.devnull,"w") as devnull:
+            subprocess.call(cmd,stdout=devnull,stderr=devnull)
+        jplace = os.path.join(sdir,"epa_result.jplace")
+        if not os.path.exists(jplace):
+            log.error("EPA-ng: error, could not process %s"%algnfile)
+            return {}
+        return jplacetrees(jplace,groups)
+
+BACKENDS = {x.name:x for x in (RaxmlPlacement,EpangPlacement)}
+
+def getbackend(name=None):
+    """Placement backend by name or $ARTS_PLACEMENT (default: raxml)"""
+    name = name or os.getenv("ARTS_PLACEMENT","raxml")
+    if name not in BACKENDS:
+        log.warning("Unknown placement backend %s, using raxml"%name)
+        name = "raxml"
+    return BACKENDS[name]()
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Convert jplace placements to labelled newick trees (one per query group)""")
+    parser.add_argument("input", help="jplace file")
+    parser.add_argument("outprefix", help="Output prefix, writes <outprefix><group>.tree")
+    parser.add_argument("-g", "--groups", help="Query names of each group as json {group:[names]} (default: one group 'all')", default=None)
+    args = parser.parse_args()
+    if args.groups:
+        with open(args.groups,"r") as fil:
+            groups = json.load(fil)
+    else:
+        with open(args.input,"r") as fil:
+            groups = {"all":[y for x in json.load(fil)["placements"] for y in x.get("n",[])+[z[0] for z in x.get("nm",[])]]}
+    for k,tree in jplacetrees(args.input,groups).items():
+        with open("%s%s.tree"%(args.outprefix,k),"w") as ofil:
+            ofil.write(tree+"\n")
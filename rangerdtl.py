@@ -20,13 +20,10 @@ from numpy import median
 global log
 log = setlog.init(toconsole=True)
 
+#sptree arguments are nwktree.TreeIndex of the species tree returned by ete3methods.mergetrees
 def findnodebyname(orgname,intree):
-    found = False
-    for x in intree.iter_descendants():
-        if x.name == orgname:
-            found = x
-            break
-    return found
+    found = intree.node(orgname)
+    return False if found is None else found
 
 def gettransfers(rdtlrslt,sptree):
     orgrecs={}
@@ -40,8 +37,8 @@ def gettransfers(rdtlrslt,sptree):
                 rx = x[-1]
                 dxnode = findnodebyname(dx,sptree)
                 rxnode = findnodebyname(rx,sptree)
-                distdx = dxnode.get_distance(dxnode.get_common_ancestor(rxnode))
-                distrx = rxnode.get_distance(rxnode.get_common_ancestor(dxnode))
+                distdx = sptree.distance(dxnode,sptree.lca(dxnode,rxnode))
+                distrx = sptree.distance(rxnode,sptree.lca(rxnode,dxnode))
                 if dx not in orgrecs:
                     orgrecs[dx] = []
                 if rx not in orgrecs:
@@ -90,9 +87,9 @@ def rdtlresults(treedict,mcpu=1):
     return results
 
 def filtertransfers(orgrecs,sptree,orgname,medfilt=False):
-    orgleaf = sptree.get_leaves_by_name(orgname)[0]
-    orglist = {x.name:"@%s"%orgleaf.get_distance(x) for x in orgleaf.get_ancestors()}
-    orglist[orgleaf.name] = ""
+    orgleaf = sptree.leaf(orgname)
+    orglist = {sptree.name[x]:"@%s"%sptree.distance(orgleaf,x) for x in sptree.ancestors(orgleaf)}
+    orglist[orgname] = ""
     orgrecs2 = {}
     # orgrecs2={k:v for k,v in orgrecs.items() if any(k in x for x in orglist)}
     for k,v in orgrecs.items():
@@ -108,11 +105,11 @@ def filtertransfers(orgrecs,sptree,orgname,medfilt=False):
 # Get only transfers with query org in LCA, rx or dx
 def getorgtransfers(rdtlrslt,sptree,qorg):
     orgrecs = {}
-    orgleaf = sptree.get_leaves_by_name(qorg)[0]
+    orgleaf = sptree.leaf(qorg)
     #Get list of ancestors and only use monophyletic
-    temp = {anc.name:set(x.genus for x in anc.get_leaves() if x.genus) for anc in orgleaf.get_ancestors()}
-    orglist = [anc for anc,v in temp.items() if len(v)<=1]
-    orglist.append(orgleaf.name)
+    temp = {sptree.name[anc]:set(sptree.genus[x] for x in sptree.leaves(anc) if sptree.genus[x]) for anc in sptree.ancestors(orgleaf)}
+    orglist = set(anc for anc,v in temp.items() if len(v)<=1)
+    orglist.add(qorg)
     for k,rslt in rdtlrslt.items():
         hkgene,gid=k.split("_@_")
         for line in rslt.split("\n"):
@@ -131,10 +128,10 @@ def getorgtransfers(rdtlrslt,sptree,qorg):
                     lca = line.split("]")[0].split("[")[1]
                     #Get LCA distance from root
                     x = lca.split(", ")
-                    org1 = sptree.get_leaves_by_name(x[0])[0]
-                    org2 = sptree.get_leaves_by_name(x[1])[0]
-                    anc = org1.get_common_ancestor(org2)
-                    lcadist = sptree.get_distance(anc)
+                    org1 = sptree.leaf(x[0])
+                    org2 = sptree.leaf(x[1])
+                    anc = sptree.lca(org1,org2)
+                    lcadist = sptree.distance(anc)
                     orgrecs[dx].append([hkgene,gid,dx,"D",rx,lca,lcadist])
                     orgrecs[rx].append([hkgene,gid,rx,"R",dx,lca,lcadist])
     return orgrecs
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, re, json, hashlib, setlog, numpy as np
+
+global log
+log = setlog.init(toconsole=True)
+
+BUNDLENAME = "refbundle.npz"
+#reference files compiled into the bundle (optional files are skipped when missing)
+SOURCES = ("model_metadata.json","genematrix.txt","coremodels.hmm","coremodels_exp.hmm")
+CUTKEYS = ("GA","TC","NC")
+
+def getcutvals(fname):
+    cut_vals={}
+    with open(fname,"r") as fil:
+        non_decimal = re.compile(r'[^\d.]+')
+        for line in fil:
+            if line.startswith("NAME"):
+                modelname=line.split()[1]
+                if modelname not in cut_vals:
+                    cut_vals[modelname]={}
+            if line.startswith("GA ") or line.startswith("TC ") or line.startswith("NC "):
+                cv=line.split()
+                cut_vals[modelname][cv[0]]=[float(non_decimal.sub('',cv[1])),float(non_decimal.sub('',cv[2]))]
+    return cut_vals
+
+def getmodeldata(fname="",hmmname=""):
+    modeldata = {}
+    log.debug("Getting model metadata...")
+    if ".json" in fname.lower() and os.path.exists(fname):
+        with open(fname,"r") as fil:
+            modeldata = json.load(fil)
+    elif ".tsv" in fname.lower() and os.path.exists(fname):
+        with open(fname,"r") as fil:
+            for line in fil:
+                if not line.startswith("#"):
+                    x = line.strip().split("\t")
+                    if x[0] not in modeldata:
+                        modeldata[x[0]] = x[1:]
+    elif ".hmm" in hmmname.lower() and os.path.exists(hmmname):
+        with open(hmmname,"r") as fil:
+            x = ["N/A","N/A","N/A","N/A","N/A","N/A","N/A","N/A"]
+            for line in fil:
+                if line.startswith("ACC"):
+                    x[0] = " ".join(line.split()[1:])
+                if line.startswith("NAME"):
+                    x[1] = " ".join(line.split()[1:])
+                if line.startswith("DESC"):
+                    x[2] = " ".join(line.split()[1:])
+                if line.startswith("TC"):
+                    x[4] = line.split()[1]
+                if line.startswith("HMM "):
+                    if x[0] not in modeldata:
+                        modeldata[x[0]] = x[1:]
+                    x = ["N/A","N/A","N/A","N/A","N/A","N/A","N/A","N/A"]
+    else:
+        log.error("Could not get model metadata, ensure file is .json, .tsv, or .hmm")
+        return False
+    return modeldata
+
+def parsegmatrix(fname,avgs=True):
+    temp={}
+    with open(fname,"r") as fil:
+        for line in fil:
+            if line.startswith("#Gene"):
+                temp["_orgs"]=line.strip().split("\t")[5:]
+            if line.startswith("#Singles"):
+                if "," in line:
+                    temp["_singles"]=set(line.strip().split("\t")[1].split(","))
+            elif not line.startswith("#"):
+                x = line.strip().split("\t")
+                if avgs:
+                    temp[x[0]]=[float(v) for v in x[1:5]]
+                    # temp[x[0]].append(float(x[4])/len(x[5:]))
+                    temp[x[0]].extend([float(v) for v in x[5:]])
+                else:
+                    temp[x[0]]=[float(x[1])]
+    return temp
+
+def filehash(fname):
+    h = hashlib.sha1()
+    with open(fname,"rb") as fil:
+        for block in iter(lambda: fil.read(1<<20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def compilebundle(refdir):
+    """Parse reference metadata, cutoffs and gene matrix once and store them in refdir/refbundle.npz"""
+    arrays = {}
+    names = []
+    hashes = []
+    stamps = []
+    for name in SOURCES:
+        path = os.path.join(refdir,name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            names.append(name)
+            hashes.append(filehash(path))
+            stamps.append([st.st_size,st.st_mtime_ns])
+    arrays["src_names"] = np.array(names,dtype=str)
+    arrays["src_hashes"] = np.array(hashes,dtype=str)
+    arrays["src_stamps"] = np.array(stamps,dtype=np.int64).reshape(-1,2)
+    if "model_metadata.json" in names:
+        with open(os.path.join(refdir,"model_metadata.json"),"rb") as fil:
+            arrays["modeldata"] = np.frombuffer(fil.read(),dtype=np.uint8)
+    for name in ("coremodels.hmm","coremodels_exp.hmm"):
+        if name in names:
+            cut_vals = getcutvals(os.path.join(refdir,name))
+            vals = np.full((len(cut_vals),len(CUTKEYS),2),np.nan)
+            for i,cv in enumerate(cut_vals.values()):
+                for j,k in enumerate(CUTKEYS):
+                    if k in cv:
+                        vals[i,j] = cv[k]
+            key = os.path.splitext(name)[0]
+            arrays["cutnames_"+key] = np.array(list(cut_vals.keys()),dtype=str)
+            arrays["cutvals_"+key] = vals
+    if "genematrix.txt" in names:
+        gm = parsegmatrix(os.path.join(refdir,"genematrix.txt"))
+        arrays["gm_orgs"] = np.array(gm.pop("_orgs",[]),dtype=str)
+        if "_singles" in gm:
+            arrays["gm_singles"] = np.array(sorted(gm.pop("_singles")),dtype=str)
+        arrays["gm_names"] = np.array(list(gm.keys()),dtype=str)
+        arrays["gm_offsets"] = np.cumsum([0]+[len(x) for x in gm.values()]).astype(np.int64)
+        arrays["gm_values"] = np.array([v for x in gm.values() for v in x],dtype=np.float64)
+    tmpfile = os.path.join(refdir,"refbundle_tmp.npz")
+    np.savez(tmpfile,**arrays)
+    os.rename(tmpfile,os.path.join(refdir,BUNDLENAME))
+    log.info("Compiled reference bundle %s (%s)"%(os.path.join(refdir,BUNDLENAME),", ".join(names)))
+
+class RefBundle(object):
+    """Compiled reference data, arrays are only read from the npz file when first used"""
+    def __init__(self, refdir):
+        self.refdir = refdir
+        self.data = np.load(os.path.join(refdir,BUNDLENAME),allow_pickle=False)
+        self._modeldata = None
+
+    @classmethod
+    def load(cls, refdir):
+        """Bundle of refdir if present and matching the source files, otherwise None"""
+        if not refdir or not os.path.isfile(os.path.join(refdir,BUNDLENAME)):
+            return None
+        try:
+            bundle = cls(refdir)
+            if bundle.isvalid():
+                return bundle
+            log.warning("Reference bundle is out of date, rebuild with: refbundle.py %s"%refdir)
+        except (IOError,ValueError,KeyError) as e:
+            log.warning("Could not load reference bundle (%s)"%e)
+        return None
+
+    def isvalid(self):
+        """Source files unchanged: same size and mtime, otherwise same content hash (stamps are then updated)"""
+        names = list(self.data["src_names"])
+        if [x for x in SOURCES if os.path.isfile(os.path.join(self.refdir,x))] != names:
+            return False
+        stamps = self.data["src_stamps"].copy()
+        for i,(name,h) in enumerate(zip(names,self.data["src_hashes"])):
+            path = os.path.join(self.refdir,name)
+            st = os.stat(path)
+            if [st.st_size,st.st_mtime_ns] != list(stamps[i]):
+                if filehash(path) != h:
+                    return False
+                stamps[i] = [st.st_size,st.st_mtime_ns]
+        if (stamps != self.data["src_stamps"]).any():
+            self.updatestamps(stamps)
+        return True
+
+    def updatestamps(self, stamps):
+        """Rewrite bundle with new source size / mtime so touched but unchanged files are not hashed on every load"""
+        arrays = {k:self.data[k] for k in self.data.files}
+        arrays["src_stamps"] = stamps
+        tmpfile = os.path.join(self.refdir,"refbundle_tmp_%s.npz"%os.getpid())
+        try:
+            np.savez(tmpfile,**arrays)
+            os.rename(tmpfile,os.path.join(self.refdir,BUNDLENAME))
+            self.data = np.load(os.path.join(self.refdir,BUNDLENAME),allow_pickle=False)
+        except (IOError,OSError) as e:
+            log.debug("Could not update reference bundle stamps (%s)"%e)
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def modeldata(self):
+        """Same as getmodeldata of model_metadata.json, None if not compiled. Parsed once, callers get a copy to extend"""
+        if "modeldata" not in self.data.files:
+            return None
+        if self._modeldata is None:
+            self._modeldata = json.loads(self.data["modeldata"].tobytes().decode("utf-8"))
+        return dict(self._modeldata)
+
+    def cutvals(self, hmmname):
+        """Same as getcutvals of a reference hmm file, None if not compiled"""
+        key = os.path.splitext(os.path.split(hmmname)[1])[0]
+        if os.path.realpath(os.path.split(hmmname)[0]) != os.path.realpath(self.refdir) or "cutvals_"+key not in self.data.files:
+            return None
+        cut_vals = {}
+        for name,vals in zip(self.data["cutnames_"+key].tolist(),self.data["cutvals_"+key]):
+            cut_vals[name] = {k:vals[j].tolist() for j,k in enumerate(CUTKEYS) if not np.isnan(vals[j,0])}
+        return cut_vals
+
+    def genematrix(self):
+        """Same as parsegmatrix of reference genematrix.txt, None if not compiled"""
+        if "gm_names" not in self.data.files:
+            return None
+        gm = {"_orgs":self.data["gm_orgs"].tolist()}
+        if "gm_singles" in self.data.files:
+            gm["_singles"] = set(self.data["gm_singles"].tolist())
+        offsets = self.data["gm_offsets"]
+        values = self.data["gm_values"].tolist()
+        for i,name in enumerate(self.data["gm_names"].tolist()):
+            gm[name] = values[offsets[i]:offsets[i+1]]
+        return gm
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Compile reference directory metadata, cutoffs and gene matrix into refbundle.npz""")
+    parser.add_argument("refdir", help="Directory of precomputed reference files")
+    args = parser.parse_args()
+    compilebundle(args.refdir)
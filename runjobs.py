@@ -14,11 +14,11 @@
 # License: You should have received a copy of the GNU General Public License v3 with ARTS
 # A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
 
-import argparse, sys, time, os, logging, shutil
+import argparse, sys, time, os, logging, shutil, glob
 from Daemon import Daemon
 from logging.handlers import RotatingFileHandler
 from redis import Redis
-import artspipeline1
+import artspipeline1, astralservice
 
 class dictobj(object):
     """Convert dictionary to object"""
@@ -137,8 +137,26 @@ class ArtsDaemon(Daemon):
                  (self.redis.keys(),self.redis.llen("SQ"),self.redis.llen("PQ"),self.redis.llen("EQ"),self.redis.llen("DQ"))
         return report
 
+    def startastral(self):
+        """Persistent ASTRAL JVM shared by all jobs of this daemon (config ASTRAL_SERVICE, heap ASTRAL_HEAP)"""
+        if str(self.config.get("ASTRAL_SERVICE",False)).lower() not in ("1","true","yes"):
+            return None
+        astjar = self.config.get("ASTJAR",False)
+        if not astjar or not os.path.exists(astjar):
+            astjar = (glob.glob(os.path.join(self.pdir,"astral","*.jar")) or [False])[0]
+        if not astjar:
+            self.log.warning("ASTRAL_SERVICE is set but no astral jar was found")
+            return None
+        sockpath = os.path.join(os.path.dirname(os.path.realpath(self.pidfile)),"%s.astral.sock"%os.path.basename(self.pidfile))
+        try:
+            return astralservice.AstralService(astjar,sockpath,self.config.get("ASTRAL_HEAP",None)).start()
+        except (IOError,OSError) as e:
+            self.log.error("Could not start ASTRAL service: %s"%e)
+            return None
+
     def run(self):
         jobid = ""
+        astral = self.startastral()
         #Stop looping if pid file is removed
         while os.path.exists(self.pidfile):
             try:
@@ -184,7 +202,11 @@ class ArtsDaemon(Daemon):
                                    "tempdir":self.config.get("TEMPDIR",None), "resultdir":os.path.join(self.config["RESULTS_FOLDER"],jobargs["id"]), "prebuilttrees":False,
                                    "rnahmmdb":rnahmm, "thresh":jobargs.get("cut","TC"), "astral":self.config.get("ASTJAR",False), "toconsole":False,
                                    "multicpu":self.config.get("MCPU",1), "runantismash":asrun, "knownhmms":knownhmms, "dufhmms":dufhmms, "custcorehmms":custcorehmms,
-                                   "customhmms":custhmms, "antismashpath":aspath, "options":options, "bigscapepath":bcp, "runbigscape":run_bsc}
+                                   "customhmms":custhmms, "antismashpath":aspath, "options":options, "bigscapepath":bcp, "runbigscape":run_bsc,
+                                   "hmmcache":self.config.get("HMMCACHE",None), "stagecache":self.config.get("STAGECACHE",None),
+                                   "keepalign":str(self.config.get("KEEPALIGN",True)).lower() in ("1","true","yes"), #result page links aligned_core_genes.zip
+                                   "batch":str(self.config.get("BATCH",False)).lower() in ("1","true","yes"),
+                                   "fullsptree":str(self.config.get("FULLSPTREE",False)).lower() in ("1","true","yes")}
                         argobj = dictobj(argdict)
                         artspipeline1.call_startquery(argobj)
 
@@ -217,6 +239,8 @@ class ArtsDaemon(Daemon):
             time.sleep(3)
         #If finished send exit
         self.log.info("Pidfile not found, finishing last job and exiting")
+        if astral:
+            astral.stop()
         exit(0)
 
 def rundaemon(action, redis, pidfile, cpu=None, resultage=30, archiveage=100):
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, time, setlog, sqlite3 as sql, numpy as np
+import makeseqsql
+
+global log
+log = setlog.init(toconsole=True)
+
+def connectdb(db):
+    """Return (connection, owned) for a database path or an already open connection"""
+    if isinstance(db, sql.Connection):
+        return db, False
+    return sql.connect(db), True
+
+class SeqStore(object):
+    """In-memory columnar copy of the Seqs table. Metadata is held in numpy columns and
+    nucleotide / amino acid sequences in one concatenated buffer each with offsets"""
+    def __init__(self, rows=()):
+        seqid=[]
+        cols=[[] for x in range(8)]
+        naseqs=[]
+        aaseqs=[]
+        seen=set()
+        for i,row in enumerate(rows):
+            #Same duplicate rule as makeseqsql (orgname,gene,description,loc_start,loc_end,loc_strand), keeps first seqid
+            key=(row[0],row[1],row[2],row[4],row[5],row[6])
+            if key in seen:
+                continue
+            seen.add(key)
+            seqid.append(i+1)
+            for j in range(8):
+                cols[j].append(row[j])
+            naseqs.append(row[8])
+            aaseqs.append(row[9] if len(row) > 9 else "")
+        self.seqid = np.array(seqid,dtype=np.int64)
+        self.orgname = np.array(cols[0],dtype=object)
+        self.gene = np.array(cols[1],dtype=object)
+        self.description = np.array(cols[2],dtype=object)
+        self.source = np.array(cols[3],dtype=object)
+        self.loc_start = np.array(cols[4],dtype=np.int64)
+        self.loc_end = np.array(cols[5],dtype=np.int64)
+        self.loc_strand = np.array(cols[6],dtype=np.int64)
+        self.lastscan = np.array(cols[7],dtype=np.int64)
+        self.nabuf, self.naoffs = self._pack(naseqs)
+        self.aabuf, self.aaoffs = self._pack(aaseqs)
+        self.index = {x:i for i,x in enumerate(seqid)}
+
+    @staticmethod
+    def _pack(seqs):
+        offs = np.zeros(len(seqs)+1,dtype=np.int64)
+        offs[1:] = np.cumsum([len(x) for x in seqs])
+        return "".join(seqs).encode("ascii","replace"), offs
+
+    @classmethod
+    def fromfna(cls, flist, orgname=False, transonly=False):
+        """Build store from .fna files as makeseqsql.runlist would"""
+        def allrecs():
+            for fname in flist:
+                org,ext = os.path.splitext(os.path.split(fname)[1])
+                if ext.lower()==".fna":
+                    for row in makeseqsql.readrecs(fname,orgname if orgname else org,transonly):
+                        yield row
+        start = time.time()
+        store = cls(allrecs())
+        log.info("Loaded %d sequences into memory (%.2f sec)"%(len(store),time.time()-start))
+        return store
+
+    @classmethod
+    def fromgenes(cls, bundle, orgname):
+        """Build store from the gene bundle collected by parsegbk.convertgenes (translates all nucleotide seqs)"""
+        start = time.time()
+        rows = []
+        totrans = {}
+        now = int(time.time())
+        for i,(header,loc,plasmid,transtab,naseq) in enumerate(bundle):
+            gn,ds = header.replace('"','').replace("'","").split(" ",1)
+            source = gn.split("|")[-1]
+            if plasmid:
+                source += "_PLASMID"
+            try:
+                transtab = int(transtab)
+            except ValueError:
+                log.debug("found translation table but is invalid")
+                transtab = 1
+            rows.append([orgname,gn,ds.strip(),source,loc[0],loc[1],loc[2],now,naseq.upper()])
+            totrans.setdefault(transtab,[]).append(i)
+        for transtab,idxs in totrans.items():
+            for i,aseq in zip(idxs,makeseqsql.translateall([rows[i][-1] for i in idxs],transtab)):
+                rows[i].append(aseq)
+        store = cls(rows)
+        log.info("Loaded %d sequences into memory (%.2f sec)"%(len(store),time.time()-start))
+        return store
+
+    def __len__(self):
+        return len(self.seqid)
+
+    def naseq(self, i):
+        return self.nabuf[self.naoffs[i]:self.naoffs[i+1]].decode("ascii")
+
+    def aaseq(self, i):
+        return self.aabuf[self.aaoffs[i]:self.aaoffs[i+1]].decode("ascii")
+
+    def rows(self):
+        """Yield rows in Seqs table column order"""
+        for i in range(len(self)):
+            yield (int(self.seqid[i]),self.orgname[i],self.gene[i],self.description[i],self.source[i],int(self.loc_start[i]),
+                   int(self.loc_end[i]),int(self.loc_strand[i]),int(self.lastscan[i]),self.naseq(i),self.aaseq(i))
+
+    def writefasta(self, outfile, nuc=False, idprfx=""):
+        """Write fasta with the same headers as seqsql2fa.writefasta"""
+        if not len(self):
+            log.warning("No sequences to export for %s"%outfile)
+            return
+        buf, offs = (self.nabuf, self.naoffs) if nuc else (self.aabuf, self.aaoffs)
+        log.info("Writing sequences to disk...")
+        with open(outfile,"w") as ofil:
+            for i in range(len(self)):
+                ofil.write(">%s|%s%s %s|source|%s|loc|%s_%s_%s\n%s\n" % (self.orgname[i], idprfx, self.seqid[i], self.gene[i], self.source[i],
+                                                                          self.loc_start[i], self.loc_end[i], self.loc_strand[i], buf[offs[i]:offs[i+1]].decode("ascii")))
+
+    def tosql(self, db):
+        """Write store as Seqs table into database path or connection (use ":memory:" for in-process queries)"""
+        conn, owned = connectdb(db)
+        csr = conn.cursor()
+        csr.execute(makeseqsql.SEQSTABLE)
+        csr.executemany("INSERT INTO Seqs VALUES (?,?,?,?,?,?,?,?,?,?,?)",self.rows())
+        conn.commit()
+        if owned:
+            conn.close()
+        return conn
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Load .fna files into memory and export protein / nucleotide fasta and optional sqlite db""")
+    parser.add_argument("input", help="Comma separated list of .fna files")
+    parser.add_argument("outfile", help="Output prefix for .faa and .fna files")
+    parser.add_argument("-org", "--orgname", help="Organism name (default: filename)", default="")
+    parser.add_argument("-t", "--trans", help="Only store translation of DNA for protein seqs (default: False)", action='store_true')
+    parser.add_argument("-db", "--exportdb", help="Also export sqlite db to this file (default: None)", default=None)
+    args = parser.parse_args()
+    seqs = SeqStore.fromfna(args.input.split(","),args.orgname,args.trans)
+    seqs.writefasta(args.outfile+".faa")
+    seqs.writefasta(args.outfile+".fna",nuc=True)
+    if args.exportdb:
+        seqs.tosql(args.exportdb)
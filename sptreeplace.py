@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+
+import argparse, os, re, glob, subprocess, setlog, numpy as np
+import placement, astralservice
+from refbundle import parsegmatrix
+
+global log
+log = setlog.init(toconsole=True)
+
+#precomputed ASTRAL species tree of the reference single copy gene trees
+REFSPTREE = "refsptree.tree"
+
+def mlstline(x):
+    #same leaf names as the ASTRAL input written by artspipeline1.catTrees (seq ids removed)
+    return re.sub("\|[A-Z0-9][0-9]*","",x).replace("|","_")
+
+def nodearrays(root):
+    """Preorder list of nodes with parent index and depth (edges from root)"""
+    nodes = []
+    parent = []
+    depth = []
+    stack = [(root,-1)]
+    while stack:
+        node,p = stack.pop()
+        nodes.append(node)
+        parent.append(p)
+        depth.append(depth[p]+1 if p >= 0 else 0)
+        i = len(nodes)-1
+        for child in node["children"]:
+            stack.append((child,i))
+    return nodes,np.array(parent,dtype=int),np.array(depth,dtype=int)
+
+def lcamatrix(nodes, parent):
+    """Leaf names, lowest common ancestor of every leaf pair and the child of that ancestor on the row leaf's side"""
+    children = [[] for x in nodes]
+    for i,p in enumerate(parent):
+        if p >= 0:
+            children[p].append(i)
+    leafnodes = [i for i,x in enumerate(children) if not x]
+    col = {x:i for i,x in enumerate(leafnodes)}
+    lca = np.zeros((len(leafnodes),len(leafnodes)),dtype=int)
+    side = np.zeros_like(lca)
+    below = {}
+    for v in reversed(range(len(nodes))):
+        if not children[v]:
+            below[v] = np.array([col[v]])
+            lca[col[v],col[v]] = v
+            side[col[v],col[v]] = v
+            continue
+        kids = children[v]
+        for i,a in enumerate(kids):
+            for b in kids[i+1:]:
+                lca[below[a][:,None],below[b]] = v
+                lca[below[b][:,None],below[a]] = v
+                side[below[a][:,None],below[b]] = a
+                side[below[b][:,None],below[a]] = b
+        below[v] = np.concatenate([below.pop(x) for x in kids])
+    return [nodes[x]["name"] for x in leafnodes],lca,side
+
+def rootbinary(root):
+    """Resolve a multifurcating root (unrooted ASTRAL output) by rerooting on its first edge, splits are unchanged"""
+    if len(root["children"]) <= 2:
+        return root,None
+    rest = {"name":"","length":None,"edge":None,"children":root["children"][1:]}
+    return {"name":"","length":None,"edge":None,"children":[root["children"][0],rest]},rest
+
+def genedepths(text, query, taxa):
+    """Leaf indices in taxa and depth of the lowest common ancestor of each pair when the gene tree is rooted at query.
+    None if query is not a single leaf or a taxon occurs twice"""
+    nodes,parent,depth = nodearrays(placement.parsenewick(text))
+    names,lca,side = lcamatrix(nodes,parent)
+    if names.count(query) != 1 or len(set(names)) != len(names):
+        return None
+    keep = [i for i,x in enumerate(names) if x in taxa]
+    q = names.index(query)
+    d = depth[lca]
+    #path lengths between leaves, distance of a pair's path from query = depth of their ancestor rooted at query
+    dist = d.diagonal()[:,None]+d.diagonal()[None,:]-2*d
+    qd = (dist[q][:,None]+dist[q][None,:]-dist)//2
+    return np.array([taxa[names[i]] for i in keep],dtype=int),qd[np.ix_(keep,keep)].astype(np.int16)
+
+def quartetscores(sproot, genetexts, query):
+    """Number of gene tree quartets (query + three reference taxa) that agree with the species tree when query is
+    attached to each edge. Returns preorder nodes of sproot (binary root), scores by lower node of the edge and genes used"""
+    nodes,parent,depth = nodearrays(sproot)
+    names,lca,side = lcamatrix(nodes,parent)
+    taxa = {x:i for i,x in enumerate(names)}
+    sdepth = depth[lca].astype(np.int16)
+    above = np.zeros(len(nodes))
+    sub = np.zeros(len(nodes))
+    used = 0
+    for text in genetexts:
+        gene = genedepths(text,query,taxa)
+        if gene is None or len(gene[0]) < 3:
+            continue
+        used += 1
+        idx,gd = gene
+        sd = sdepth[np.ix_(idx,idx)]
+        sl = lca[np.ix_(idx,idx)]
+        ss = side[np.ix_(idx,idx)]
+        for x in range(len(idx)-1):
+            ys = np.arange(x+1,len(idx))
+            #triples x<y with z outside the clade of lca(x,y): lca(x,y) is their median node in the species tree
+            med = sd[x,ys][:,None] > sd[x][None,:]
+            dxy = gd[x,ys][:,None]
+            dxz = gd[x][None,:]
+            dyz = gd[ys]
+            #pair farthest from query in the gene tree, the remaining taxon is the one joined with query
+            withz = med & (dxy > dxz) & (dxy > dyz)
+            withx = med & (dyz > dxy) & (dyz > dxz)
+            withy = med & (dxz > dxy) & (dxz > dyz)
+            #query joined with z: edges outside the median's clade, with x or y: edges below the median on that side
+            above += np.bincount(sl[x,ys],weights=np.count_nonzero(withz,axis=1),minlength=len(nodes))
+            sub += np.bincount(ss[x,ys],weights=np.count_nonzero(withx,axis=1),minlength=len(nodes))
+            sub += np.bincount(ss[ys,x],weights=np.count_nonzero(withy,axis=1),minlength=len(nodes))
+    #score of edge above v: sub counts of v and its ancestors, above counts of all nodes except ancestors of v
+    cum = np.zeros(len(nodes))
+    for v in range(1,len(nodes)):
+        cum[v] = cum[parent[v]]+sub[v]-above[v]
+    scores = cum+above.sum()+above
+    scores[0] = -1
+    return nodes,scores,used
+
+def insertquery(sptext, genetexts, query):
+    """Species tree with query inserted on the best quartet scoring edge of the reference species tree.
+    Returns (newick, fraction of agreeing quartets) or (None,0) if no gene tree contains the query and three reference taxa"""
+    root = placement.parsenewick(sptext)
+    broot,rest = rootbinary(root)
+    nodes,scores,used = quartetscores(broot,genetexts,query)
+    if not used:
+        return None,0
+    best = nodes[int(np.argmax(scores))]
+    if best is rest:
+        #both root edges of the rerooted tree are the first edge of the original root
+        best = root["children"][0]
+    onodes,oparent,odepth = nodearrays(root)
+    par = onodes[oparent[[id(x) for x in onodes].index(id(best))]]
+    best["length"] = None if best["length"] is None else "%.10g"%(float(best["length"])/2)
+    new = {"name":"","length":best["length"],"edge":None,"children":[best,{"name":query,"length":None,"edge":None,"children":[]}]}
+    par["children"] = [new if x is best else x for x in par["children"]]
+    total = int(scores.max())
+    log.info("Species tree: placed %s using %s gene trees (%d agreeing quartets)"%(query,used,total))
+    return placement.writenewick(root),total
+
+def buildref(refdir, astjar, outfile=None):
+    """Species tree of the reference single copy gene trees with ASTRAL, written to refdir/refsptree.tree"""
+    if not refdir.endswith("/"):
+        refdir += "/"
+    outfile = outfile or refdir+REFSPTREE
+    singles = parsegmatrix(refdir+"genematrix.txt").get("_singles",set())
+    tlist = [refdir+"trees/%s.tree"%x for x in sorted(singles)]+glob.glob(refdir+"trees/RNA_16S_rRNA.tree")
+    catfile = outfile+".nwk"
+    with open(catfile,"w") as ofil:
+        for fname in tlist:
+            if os.path.exists(fname):
+                with open(fname,"r") as ifil:
+                    ofil.write(mlstline(ifil.readline()))
+    if not astralservice.runastral(catfile,outfile,outfile+".log",astjar):
+        with open(outfile+".log","w") as fil:
+            subprocess.call(["java","-Xmx%s"%os.getenv("ARTS_ASTRAL_HEAP",astralservice.HEAP),"-jar",astjar,"-i",catfile,"-o",outfile,"-t","0"],stderr=fil)
+    os.remove(catfile)
+    return outfile if os.path.isfile(outfile) else False
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Insert a query organism into a reference species tree by quartet scoring against its gene trees, or build the reference species tree""")
+    parser.add_argument("reftree", help="Reference species tree (or reference directory with --build)")
+    parser.add_argument("genetrees", nargs="?", help="Gene trees of the query, one newick per line with species names (allmlst_cat.nwk)")
+    parser.add_argument("-q", "--query", help="Query organism name", default=None)
+    parser.add_argument("-o", "--outfile", help="Output species tree (default: stdout, or refdir/%s with --build)"%REFSPTREE, default=None)
+    parser.add_argument("-b", "--build", help="Build refdir/%s from the reference gene trees with ASTRAL jar BUILD"%REFSPTREE, default=None)
+    args = parser.parse_args()
+    if args.build:
+        buildref(args.reftree,args.build,args.outfile)
+    else:
+        with open(args.reftree,"r") as fil, open(args.genetrees,"r") as gfil:
+            tree,score = insertquery(fil.readline(),gfil.readlines(),args.query)
+        if tree and args.outfile:
+            with open(args.outfile,"w") as ofil:
+                ofil.write(tree+"\n")
+        elif tree:
+            print(tree)
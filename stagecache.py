@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright (C) 2015,2016 Mohammad Alanjary
+# University of Tuebingen
+# Interfaculty Institute of Microbiology and Infection Medicine
+# Lab of Nadine Ziemert, Div. of Microbiology/Biotechnology
+# Funding by the German Centre for Infection Research (DZIF)
+#
+# This file is part of ARTS
+# ARTS is free software. you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version
+#
+# License: You should have received a copy of the GNU General Public License v3 with ARTS
+# A copy of the GPLv3 can also be found at: <http://www.gnu.org/licenses/>.
+
+import argparse, os, json, pickle, shutil, setlog
+from hmmcache import HmmCache
+
+global log
+log = setlog.init(toconsole=True)
+
+#Bump when stage outputs change so old entries are not reused
+STAGEVERSION = 1
+RESULTFILE = "result.pickle"
+
+class StageCache(HmmCache):
+    """Content addressed store of pipeline stage outputs (files and picklable result) shared between jobs.
+    Disabled unless a cache directory or $ARTS_STAGECACHE is set"""
+    def __init__(self, cachedir=None, maxsize=None):
+        cachedir = cachedir or os.getenv("ARTS_STAGECACHE",None)
+        self.enabled = bool(cachedir)
+        if self.enabled:
+            try:
+                HmmCache.__init__(self,cachedir,maxsize or os.getenv("ARTS_STAGECACHE_SIZE",2e10))
+            except OSError as e:
+                log.warning("Stage cache not available (%s)"%e)
+                self.enabled = False
+
+    @staticmethod
+    def stamps(flist):
+        """(path, size, mtime) of existing files, a cheap version of large reference files and tools"""
+        temp = []
+        for fname in flist:
+            if fname and os.path.isfile(fname):
+                st = os.stat(fname)
+                temp.append([os.path.realpath(fname),st.st_size,st.st_mtime_ns])
+        return temp
+
+    @staticmethod
+    def tools(names):
+        """Stamps of external programs found in PATH"""
+        return StageCache.stamps([shutil.which(x) for x in names])
+
+    def key(self, stage, flist=(), *values):
+        """Hash of stage name, content of input files and json serializable option values"""
+        if not self.enabled:
+            return None
+        tag = json.dumps([STAGEVERSION,stage,values],sort_keys=True,default=str)
+        return stage+"_"+self.filehash([x for x in flist if x and os.path.isfile(x)],tag)
+
+    def fetch(self, key, outdir):
+        """Copy files of a finished stage into outdir, returns stored result or None on a miss"""
+        if not key:
+            return None
+        edir = os.path.join(self.cachedir,key)
+        if not os.path.isfile(os.path.join(edir,RESULTFILE)):
+            return None
+        try:
+            os.utime(edir,None)
+            fdir = os.path.join(edir,"files")
+            for d,subdirs,files in os.walk(fdir):
+                odir = os.path.join(outdir,os.path.relpath(d,fdir))
+                if not os.path.isdir(odir):
+                    os.makedirs(odir)
+                for x in files:
+                    shutil.copyfile(os.path.join(d,x),os.path.join(odir,x))
+            with open(os.path.join(edir,RESULTFILE),"rb") as fil:
+                result = pickle.load(fil)
+        except (IOError,OSError,EOFError,pickle.UnpicklingError) as e:
+            #entry was evicted while copying or is incomplete
+            log.warning("StageCache: could not read %s (%s)"%(edir,e))
+            return None
+        log.info("StageCache: reusing %s"%key)
+        return result
+
+    def store(self, key, outdir, files=(), result=True):
+        """Add files (paths relative to outdir) and result of a finished stage"""
+        if not key:
+            return False
+        def build(tmpdir):
+            for x in files:
+                dst = os.path.join(tmpdir,"files",x)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.copyfile(os.path.join(outdir,x),dst)
+            with open(os.path.join(tmpdir,RESULTFILE),"wb") as fil:
+                pickle.dump(result,fil,protocol=2)
+            return True
+        try:
+            return self.getentry(key,build)
+        except (IOError,OSError) as e:
+            log.warning("StageCache: could not store %s (%s)"%(key,e))
+            return False
+
+# Commandline Execution
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""Evict least recently used stage results until the cache is below its size limit""")
+    parser.add_argument("-cd", "--cachedir", help="Cache directory (default: $ARTS_STAGECACHE)", default=None)
+    parser.add_argument("-ms", "--maxsize", help="Maximum cache size in bytes (default: $ARTS_STAGECACHE_SIZE or 2e10)", type=float, default=None)
+    args = parser.parse_args()
+    cache = StageCache(args.cachedir,args.maxsize)
+    if cache.enabled:
+        cache.evict()
+    else:
+        log.error("No cache directory set")
@@ -482,6 +482,10 @@ def getjobstatus(jobid):
                         bt += 1
                     if "Wrote (1 of " in line:
                         tt = line.split("Wrote (1 of ")[1].split(")")[0]
+                    if "BuildTree: Progress" in line:
+                        #finished and failed genes of the tree scheduler
+                        bt,tt = line.split("Progress")[-1].split(" of ")
+                        bt = int(bt)
             if tt:
                 status["buildtree"] = int(100*float(bt)/float(tt))
                 status["coretotal"] = int(tt)